@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import sys
+import csv
+import time
+import filecmp
+import argparse
+import operator
+import resource
+import itertools
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../data'))
+
+import convert_datastackexchange_query_result as convert_query_result
+import synthetic
+
+'''
+Measure `convert_datastackexchange_query_result.py` on a synthetic query
+result with millions of edges, against the previous implementation
+(`itertools.groupby` over rows, which needs input sorted by Tag1).
+
+The previous implementation gets sorted input; the new one gets both
+sorted and shuffled input, with several memory budgets (`--max-rows`).
+Outputs of all runs are compared. Every run is done in a separate process,
+to measure its peak memory.
+
+Example usage:
+    python3 bench_convert_query_result.py --edges 5000000 --max-rows 1048576 262144
+'''
+
+
+def convert_with_groupby(path_to_csv, path_to_output):
+    with open(path_to_output, 'w') as out_file:
+        with open(path_to_csv, 'r', newline='') as input_csv:
+            reader = csv.reader(input_csv)
+
+            it = iter(reader)
+            next(it)
+
+            for key, raw_row_items in itertools.groupby(it, operator.itemgetter(1)):
+                row_items = ['{},{}'.format(x[2], x[0]) for x in raw_row_items if int(x[2]) > int(key)]
+                row_items_repr = ' '.join(row_items)
+                print('{}: {}'.format(key, row_items_repr), file=out_file)
+
+
+def get_peak_memory_mib():
+    # Linux keeps `ru_maxrss` of the parent over `exec`, but not the high water mark.
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - start
+    return elapsed, get_peak_memory_mib()
+
+
+def run(function, *args):
+    # A fresh process, so that memory of the generator does not count.
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(measure, (function,) + args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark conversion of data.stackexchange query results.')
+    parser.add_argument('--edges', type=int, default=3000000, help='number of rows in the query result')
+    parser.add_argument('--tags', type=int, default=50000)
+    parser.add_argument('--max-rows', type=int, nargs='+', default=[convert_query_result.MAX_ROWS, 1 << 18])
+    parser.add_argument('--skip-old', action='store_true', help='do not run the previous implementation')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        inputs = dict()
+        for order in ('sorted', 'shuffled'):
+            inputs[order] = synthetic.write_query_result(os.path.join(tmp_dir, '{}.csv'.format(order)),
+                                                         args.edges, args.tags, sort=order == 'sorted')
+        print('query result: {} rows, {:.1f} MiB'.format(args.edges,
+              os.path.getsize(inputs['sorted']) / (1 << 20)))
+
+        results = []
+        if not args.skip_old:
+            out_path = os.path.join(tmp_dir, 'groupby.txt')
+            results.append(('groupby, sorted',) + run(convert_with_groupby, inputs['sorted'], out_path) +
+                           (out_path,))
+
+        for order in ('sorted', 'shuffled'):
+            for max_rows in args.max_rows:
+                out_path = os.path.join(tmp_dir, 'out_{}_{}.txt'.format(order, max_rows))
+                csr_dir = os.path.join(tmp_dir, 'csr_{}_{}'.format(order, max_rows))
+                title = '{}, max_rows={}'.format(order, max_rows)
+                results.append((title,) + run(convert_query_result.convert, [inputs[order]], out_path,
+                                              csr_dir, max_rows) + (out_path,))
+
+        print('{:<28} {:>8} {:>12} {:>10}'.format('', 'time, s', 'rows/s', 'RSS, MiB'))
+        for title, elapsed, max_rss, out_path in results:
+            same = filecmp.cmp(out_path, results[0][3], shallow=False)
+            print('{:<28} {:>8.2f} {:>12.0f} {:>10.1f}   {}'.format(title, elapsed, args.edges / elapsed,
+                  max_rss, 'same output' if same else 'OUTPUT DIFFERS'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import sys
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../visualization'))
+
+import get_tiling
+import tile_server
+import synthetic
+
+'''
+Measure how many requests and bytes HTTP caching of `tile_server.py` saves
+in browser sessions.
+
+A session loads the page and then pans and zooms the map in a random walk
+(the same walks for all clients). After every step, tiles which came into
+the viewport are requested, as `tiling_visualizer.html` does. Sessions of
+a client share its cache, like visits of the same user. Clients:
+    no cache - ignores validators and `Cache-Control`, and does not accept gzip;
+        this is what the server allowed before: every tile was sent again;
+    revalidate - keeps responses and revalidates them with ETags
+        (tile URLs without the version);
+    versioned - tile URLs carry the version of tiles, so tiles which the
+        client already has are not requested at all.
+
+Tiles up to `--prerender-zoom` are rendered into a directory in advance,
+deeper ones are rendered on demand.
+
+Example usage:
+    python3 bench_http_cache.py --tags 5000 --sessions 5 --steps 40
+'''
+
+SUFFIX = 'bench'
+VIEWPORT = (1280, 800)
+TILE_SIZE = 256
+CLIENTS = ('no cache', 'revalidate', 'versioned')
+
+
+def get_visible_tiles(zoom, center_x, center_y):
+    """
+    Return tiles in the viewport centered at (center_x, center_y), in [0, 1] map coordinates.
+    """
+    cnt_tiles = 1 << zoom
+    ranges = []
+    for center, size in ((center_x, VIEWPORT[0]), (center_y, VIEWPORT[1])):
+        center_px = center * cnt_tiles * TILE_SIZE
+        first = max(0, int((center_px - size / 2) // TILE_SIZE))
+        last = min(cnt_tiles - 1, int((center_px + size / 2 - 1) // TILE_SIZE))
+        ranges.append(range(first, last + 1))
+    return {(x, y, zoom) for x in ranges[0] for y in ranges[1]}
+
+
+def make_walk(seed, cnt_steps, min_zoom, max_zoom):
+    """
+    Return a list of views <zoom, center x, center y>: zooming in and out, and panning.
+    """
+    rnd = random.Random(seed)
+    zoom, center_x, center_y = min_zoom, 0.5, 0.5
+    walk = [(zoom, center_x, center_y)]
+    for _ in range(cnt_steps):
+        action = rnd.random()
+        if action < 0.2 and zoom < max_zoom:
+            zoom += 1
+        elif action < 0.35 and zoom > min_zoom:
+            zoom -= 1
+        else:
+            # Pan by a part of the viewport.
+            step = 0.4 * VIEWPORT[0] / (TILE_SIZE << zoom)
+            center_x = min(1, max(0, center_x + rnd.uniform(-step, step)))
+            center_y = min(1, max(0, center_y + rnd.uniform(-step, step)))
+        walk.append((zoom, center_x, center_y))
+    return walk
+
+
+class Browser:
+    """
+    A client of the tile server with an HTTP cache, see `CLIENTS`.
+    """
+
+    def __init__(self, test_client, kind):
+        self.test_client = test_client
+        self.kind = kind
+        # URL -> pair <ETag, whether the response is immutable>.
+        self.cache = dict()
+        self.stats = None
+
+
+    def start_session(self):
+        self.stats = {'requests': 0, 'not_modified': 0, 'from_cache': 0, 'bytes': 0}
+
+
+    def get(self, url):
+        entry = self.cache.get(url)
+        if entry is not None and entry[1]:
+            self.stats['from_cache'] += 1
+            return None
+
+        headers = dict()
+        if self.kind != 'no cache':
+            headers['Accept-Encoding'] = 'gzip'
+            if entry is not None and entry[0] is not None:
+                headers['If-None-Match'] = entry[0]
+
+        response = self.test_client.get(url, headers=headers)
+        self.stats['requests'] += 1
+        self.stats['bytes'] += len(response.get_data())
+        if response.status_code == 304:
+            self.stats['not_modified'] += 1
+        elif self.kind != 'no cache':
+            self.cache[url] = (response.headers.get('ETag'),
+                               'immutable' in response.headers.get('Cache-Control', ''))
+        return response
+
+
+    def run_session(self, walk):
+        self.start_session()
+        self.get('/')
+        self.get('/get_tile_variants')
+
+        query = ''
+        if self.kind == 'versioned':
+            query = '?v={}'.format(self.get('/tile_version/{}'.format(SUFFIX)).get_data(as_text=True))
+
+        shown = set()
+        for zoom, center_x, center_y in walk:
+            visible = get_visible_tiles(zoom, center_x, center_y)
+            # Images which stay in the viewport are not requested again.
+            for x, y, z in sorted(visible - shown):
+                self.get('/tiles_{}/{}_{}_{}.png{}'.format(SUFFIX, x, y, z, query))
+            shown = visible
+        return self.stats
+
+
+def prerender_tiles(tsv_path, info_path, max_zoom):
+    tiler = get_tiling.Tiler(get_tiling.load_tag_columns(tsv_path, info_path))
+    tile_store = get_tiling.DirectoryTileStore(get_tiling.get_tile_dir(SUFFIX))
+    manifest = {'max_zoom': max_zoom}
+    for meta_x, meta_y, zoom in get_tiling.get_metatile_tasks(tiler, max_zoom, tile_store, manifest):
+        img, _ = tiler.get_metatile(meta_x, meta_y, zoom)
+        get_tiling.render_tiles(img, meta_x, meta_y, zoom, tile_store)
+    manifest['labels'] = tiler.build_label_index().to_dict()
+    tile_store.commit(manifest)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark HTTP caching of the tile server.')
+    parser.add_argument('--tags', type=int, default=5000)
+    parser.add_argument('--prerender-zoom', type=int, default=4)
+    parser.add_argument('--max-zoom', type=int, default=6, help='deepest zoom level of sessions')
+    parser.add_argument('--sessions', type=int, default=5)
+    parser.add_argument('--steps', type=int, default=40, help='pans and zooms in a session')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tsv_path, info_path = synthetic.write_tiling_input(tmp_dir, SUFFIX, args.tags)
+        get_tiling.TILES_DIR_BASE = os.path.join(tmp_dir, 'tiles')
+        get_tiling.SNAPSHOT_DIR_BASE = os.path.join(tmp_dir, 'snapshot')
+        prerender_tiles(tsv_path, info_path, args.prerender_zoom)
+
+        # The server looks for tilings in the current directory.
+        os.chdir(tmp_dir)
+        tile_server.BASE_DIR = tile_server.PROCESSED_DIR = tmp_dir
+        tile_server.POINTS_TSV_FMT = os.path.join(tmp_dir, 'tsne_output_{}.tsv')
+        tile_server.RAW_POINTS_FMT = os.path.join(tmp_dir, 'raw_tsne_output_{}.txt')
+        tile_server.ADDITIONAL_INFO_FMT = os.path.join(tmp_dir, 'id_to_additional_info_{}.csv')
+        test_client = tile_server.app.test_client()
+
+        walks = [make_walk(seed, args.steps, 2, args.max_zoom) for seed in range(args.sessions)]
+        print('{} sessions of {} steps, zoom levels 2-{} ({}-{} rendered on demand)'.format(
+              args.sessions, args.steps, args.max_zoom, args.prerender_zoom + 1, args.max_zoom))
+        print('{:<12} {:<10} {:>9} {:>9} {:>11} {:>10}'.format('client', 'sessions', 'requests',
+              '304', 'from cache', 'KiB'))
+        for kind in CLIENTS:
+            browser = Browser(test_client, kind)
+            all_stats = []
+            for walk in walks:
+                all_stats.append(browser.run_session(walk))
+
+            for title, sessions in (('first', all_stats[:1]), ('later, avg', all_stats[1:])):
+                if not sessions:
+                    continue
+                average = {key: sum(stats[key] for stats in sessions) / len(sessions) for key in sessions[0]}
+                print('{:<12} {:<10} {:>9.1f} {:>9.1f} {:>11.1f} {:>10.1f}'.format(kind, title,
+                      average['requests'], average['not_modified'], average['from_cache'],
+                      average['bytes'] / 1024))
+
+
+if __name__ == '__main__':
+    main()
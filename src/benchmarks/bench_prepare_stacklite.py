@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import sys
+import csv
+import time
+import filecmp
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../data'))
+
+import numpy as np
+
+import interim
+import prepare_stacklite_data
+import synthetic
+
+'''
+Measure `prepare_stacklite_data.py` on synthetic StackLite-shaped data,
+against the previous implementation (two passes over question tags,
+removing duplicates with a list of recent pairs).
+
+Outputs of all runs are compared. Binary output (see `interim.py`)
+is measured separately.
+
+Example usage:
+    python3 bench_prepare_stacklite.py --posts 1000000 --workers 1 4
+'''
+
+
+def prepare_post_tags_two_passes(question_tags_path, tags_path, post_tag_path):
+    tag_to_id_mapping = dict()
+
+    with open(question_tags_path, 'r', newline='') as question_tags_file:
+        reader = csv.reader(question_tags_file)
+        all_tags = set()
+        for row in reader:
+            all_tags.add(row[1])
+        all_tags.remove('Tag')
+        tags = list(sorted(all_tags))
+
+        with open(tags_path, 'w', newline='') as tags_csv_file:
+            writer = csv.writer(tags_csv_file)
+            writer.writerow(['Id', 'Tag'])
+            for i, tag in enumerate(tags, 1):
+                tag_to_id_mapping[tag] = i
+                writer.writerow([i, tag])
+
+    with open(question_tags_path, 'r', newline='') as question_tags_file:
+        reader = csv.reader(question_tags_file)
+        with open(post_tag_path, 'w', newline='') as post_tag_csv_file:
+            writer = csv.writer(post_tag_csv_file)
+            queue = []
+            MAX_QUEUE_SIZE = 40
+            for i, row in enumerate(reader):
+                if i == 0:
+                    writer.writerow(['PostId', 'TagId'])
+                    continue
+                post_id = row[0]
+                tag = row[1]
+                if (post_id, tag) not in queue:
+                    writer.writerow([post_id, tag_to_id_mapping[tag]])
+                queue.append((post_id, tag))
+                if len(queue) > MAX_QUEUE_SIZE:
+                    queue.pop(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark preparation of StackLite data.')
+    parser.add_argument('--posts', type=int, default=300000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count() or 1])
+    parser.add_argument('--skip-old', action='store_true', help='do not run the previous implementation')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        raw_dir = os.path.join(tmp_dir, 'raw')
+        os.mkdir(raw_dir)
+        questions_path, question_tags_path = synthetic.write_stacklite_input(raw_dir, args.posts)
+        print('question_tags.csv: {:.1f} MiB'.format(os.path.getsize(question_tags_path) / (1 << 20)))
+
+        results = []
+        if not args.skip_old:
+            out_dir = os.path.join(tmp_dir, 'old')
+            os.mkdir(out_dir)
+            start = time.perf_counter()
+            prepare_stacklite_data.prepare_posts(questions_path, os.path.join(out_dir, 'posts.csv'))
+            prepare_post_tags_two_passes(question_tags_path, os.path.join(out_dir, 'tags.csv'),
+                                         os.path.join(out_dir, 'post_tag.csv'))
+            results.append(('two passes', time.perf_counter() - start, out_dir))
+
+        for workers in args.workers:
+            out_dir = os.path.join(tmp_dir, 'workers_{}'.format(workers))
+            os.mkdir(out_dir)
+            start = time.perf_counter()
+            prepare_stacklite_data.prepare(raw_dir, out_dir, workers, ('csv',))
+            results.append(('workers={}'.format(workers), time.perf_counter() - start, out_dir))
+
+        for workers in args.workers:
+            out_dir = os.path.join(tmp_dir, 'npy_workers_{}'.format(workers))
+            os.mkdir(out_dir)
+            start = time.perf_counter()
+            prepare_stacklite_data.prepare(raw_dir, out_dir, workers, ('npy',))
+            elapsed = time.perf_counter() - start
+
+            csv_dir = results[-1][2]
+            posts = interim.load_posts(out_dir)
+            post_tags = interim.load_post_tags(out_dir)
+            same = filecmp.cmp(os.path.join(out_dir, 'tags.csv'), os.path.join(csv_dir, 'tags.csv'),
+                               shallow=False) and \
+                np.array_equal(post_tags, np.loadtxt(os.path.join(csv_dir, 'post_tag.csv'),
+                                                     delimiter=',', skiprows=1, dtype=np.int64, ndmin=2)) and \
+                len(posts) == args.posts
+            print('{:<12} {:>8.2f} s   {}'.format('npy, w={}'.format(workers), elapsed,
+                  'same output' if same else 'OUTPUT DIFFERS'))
+
+        for title, elapsed, out_dir in results:
+            same = all(filecmp.cmp(os.path.join(out_dir, name), os.path.join(results[0][2], name),
+                                   shallow=False)
+                       for name in ('posts.csv', 'tags.csv', 'post_tag.csv'))
+            print('{:<12} {:>8.2f} s   {}'.format(title, elapsed,
+                  'same output' if same else 'OUTPUT DIFFERS'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import sys
+import csv
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../visualization'))
+
+import tag_search
+import synthetic
+
+'''
+Measure latency of tag autocomplete.
+
+Queries are prefixes of tag names and names with one random typo.
+Tag names are taken from `data_stackexchange_tags.csv` (more are
+generated if needed), post counts are random.
+
+Example usage:
+    python3 bench_search.py --tags 50000 --queries 20000
+'''
+
+DEFAULT_TAGS_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '../../data/example/data_stackexchange_tags.csv')
+
+
+def read_tag_names(path):
+    with open(path, 'r') as tags_file:
+        reader = csv.reader(tags_file)
+        next(reader)
+        return [row[1] for row in reader]
+
+
+def make_typo(name, rnd):
+    pos = rnd.randrange(len(name))
+    kind = rnd.randrange(3)
+    if kind == 0:
+        return name[:pos] + name[pos + 1:]
+    if kind == 1:
+        return name[:pos] + rnd.choice('abcdefghijklmnopqrstuvwxyz') + name[pos + 1:]
+    return name[:pos] + rnd.choice('abcdefghijklmnopqrstuvwxyz') + name[pos:]
+
+
+def make_queries(names, cnt_queries, rnd):
+    queries = []
+    for _ in range(cnt_queries):
+        name = rnd.choice(names)
+        if rnd.random() < 0.5:
+            queries.append(name[:rnd.randint(1, len(name))])
+        else:
+            queries.append(make_typo(name, rnd))
+    return queries
+
+
+def get_percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def report(title, latencies):
+    latencies = sorted(latencies)
+    print('{:<12} p50 {:>8.1f} us   p99 {:>8.1f} us   max {:>8.1f} us'.format(title,
+          get_percentile(latencies, 0.5) * 1e6,
+          get_percentile(latencies, 0.99) * 1e6,
+          latencies[-1] * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark tag autocomplete.')
+    parser.add_argument('--tags', type=int, default=50000)
+    parser.add_argument('--tags-csv', default=DEFAULT_TAGS_CSV)
+    parser.add_argument('--queries', type=int, default=20000)
+    parser.add_argument('--limit', type=int, default=tag_search.DEFAULT_LIMIT)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    names = read_tag_names(args.tags_csv) if os.path.isfile(args.tags_csv) else []
+    names = list(dict.fromkeys(names))[:args.tags]
+    if len(names) < args.tags:
+        names.extend(synthetic.make_tag_names(args.tags - len(names)))
+    post_counts = [int(rnd.paretovariate(1.0)) for _ in names]
+
+    start = time.perf_counter()
+    index = tag_search.TagSearchIndex(names, post_counts)
+    print('Built index over {} tags in {:.3f} s.'.format(len(names), time.perf_counter() - start))
+
+    queries = make_queries(names, args.queries, rnd)
+    latencies = []
+    cnt_found = 0
+    for query in queries:
+        start = time.perf_counter()
+        result = index.complete(query, args.limit)
+        latencies.append(time.perf_counter() - start)
+        cnt_found += bool(result)
+
+    print('{} of {} queries have suggestions.'.format(cnt_found, len(queries)))
+    report('complete', latencies)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import tempfile
+import subprocess
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../data'))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../visualization'))
+
+import numpy as np
+
+import get_tiling
+import prepare_stacklite_data
+import synthetic
+from bench_tile_server import SUFFIX, configure_tile_server
+
+'''
+Time the main stages of our pipeline on synthetic data, and save results
+as JSON, so that runs on different commits can be compared:
+    prepare_stacklite_data - posts and tags from StackLite-shaped data;
+    merge_mappings, extract_tsv - as scripts, the way the Makefile runs them;
+    get_tiling - loading a map, rendering and encoding each zoom level,
+        label index and manifest;
+    tile_server - requests to each endpoint under Flask's test client.
+
+Pipeline stages are run `--repeat` times and the fastest run counts.
+For endpoints, `seconds` is the total time of all requests to the endpoint.
+With `--baseline`, results are compared with an earlier results file, and
+the exit code is 1 if some result got slower by more than `--threshold`.
+
+Example usage:
+    python3 bench_suite.py --output results.json
+    python3 bench_suite.py --preset large --baseline results.json
+'''
+
+PRESETS = {
+    'small': {'posts': 100000, 'tags': 2000, 'max_zoom': 4, 'requests': 200},
+    'large': {'posts': 1000000, 'tags': 20000, 'max_zoom': 6, 'requests': 1000},
+}
+BHTSNE_DIR = os.path.join(BENCHMARKS_DIR, '../models/use_bhtsne')
+# Slowdown (as a fraction of the baseline time) reported as a regression.
+DEFAULT_THRESHOLD = 0.2
+# Results faster than this, in seconds, are too noisy to be compared.
+MIN_COMPARED_SECONDS = 0.05
+
+
+def get_environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARKS_DIR,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+            'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def time_runs(func, repeat):
+    """
+    Run `func` `repeat` times. Returns a list of durations in seconds.
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def make_result(name, durations, **params):
+    result = {'name': name, 'seconds': min(durations), 'runs': durations}
+    result.update(params)
+    return result
+
+
+def run_script(script_path, args, out_path):
+    with open(out_path, 'wb') as out_file:
+        subprocess.check_call([sys.executable, script_path] + args, stdout=out_file)
+
+
+def bench_prepare_stacklite(tmp_dir, cnt_posts, repeat):
+    raw_dir = os.path.join(tmp_dir, 'raw')
+    interim_dir = os.path.join(tmp_dir, 'interim')
+    os.mkdir(raw_dir)
+    os.mkdir(interim_dir)
+    synthetic.write_stacklite_input(raw_dir, cnt_posts)
+
+    durations = time_runs(lambda: prepare_stacklite_data.prepare(raw_dir, interim_dir), repeat)
+    return [make_result('prepare_stacklite_data', durations, posts=cnt_posts)]
+
+
+def bench_scripts(tmp_dir, cnt_tags, repeat):
+    adj_to_nn_path, tags_path, post_count_path = synthetic.write_mappings(tmp_dir, cnt_tags)
+    raw_output_path = synthetic.write_raw_tsne_output(os.path.join(tmp_dir, 'raw_tsne_output.txt'), cnt_tags)
+    out_path = os.path.join(tmp_dir, 'script_output')
+
+    merge_mappings = os.path.join(BHTSNE_DIR, 'merge_mappings.py')
+    extract_tsv = os.path.join(BHTSNE_DIR, 'extract_tsv.py')
+    return [make_result('merge_mappings', time_runs(lambda: run_script(merge_mappings,
+                        [adj_to_nn_path, tags_path, post_count_path], out_path), repeat), tags=cnt_tags),
+            make_result('extract_tsv', time_runs(lambda: run_script(extract_tsv, [raw_output_path], out_path),
+                        repeat), tags=cnt_tags)]
+
+
+def render_tiling(tsv_path, info_path, max_zoom):
+    """
+    Render all tiles up to `max_zoom`, as `get_tiling.py` does in one thread.
+    Returns durations: of loading, of each zoom level, and of labels with the manifest.
+    """
+    start = time.perf_counter()
+    tiler = get_tiling.Tiler(get_tiling.load_tag_columns(tsv_path, info_path))
+    load_seconds = time.perf_counter() - start
+
+    tile_store = get_tiling.DirectoryTileStore(get_tiling.get_tile_dir(SUFFIX))
+    manifest = {'max_zoom': max_zoom}
+    zoom_seconds = [0] * (max_zoom + 1)
+    # Signatures of a metatile are computed before it is yielded, so time
+    # between consecutive metatiles belongs to the zoom level of the latter.
+    start = time.perf_counter()
+    for meta_x, meta_y, zoom in get_tiling.get_metatile_tasks(tiler, max_zoom, tile_store, manifest):
+        img, _ = tiler.get_metatile(meta_x, meta_y, zoom)
+        get_tiling.render_tiles(img, meta_x, meta_y, zoom, tile_store)
+        now = time.perf_counter()
+        zoom_seconds[zoom] += now - start
+        start = now
+
+    manifest['labels'] = tiler.build_label_index().to_dict()
+    tile_store.commit(manifest)
+    return load_seconds, zoom_seconds, time.perf_counter() - start
+
+
+def bench_get_tiling(tmp_dir, cnt_tags, max_zoom, repeat):
+    tsv_path, info_path = synthetic.write_tiling_input(tmp_dir, SUFFIX, cnt_tags)
+    get_tiling.TILES_DIR_BASE = os.path.join(tmp_dir, 'tiles')
+    get_tiling.SNAPSHOT_DIR_BASE = os.path.join(tmp_dir, 'snapshot')
+
+    runs = [render_tiling(tsv_path, info_path, max_zoom) for _ in range(repeat)]
+    results = [make_result('get_tiling.load', [run[0] for run in runs], tags=cnt_tags)]
+    for zoom in range(max_zoom + 1):
+        results.append(make_result('get_tiling.zoom_{}'.format(zoom), [run[1][zoom] for run in runs],
+                                   tags=cnt_tags, metatiles=len(range(0, 1 << zoom, get_tiling.METATILE_SIZE)) ** 2))
+    results.append(make_result('get_tiling.labels', [run[2] for run in runs], tags=cnt_tags))
+    return results
+
+
+def time_requests(test_client, name, urls):
+    latencies = []
+    for url in urls:
+        start = time.perf_counter()
+        response = test_client.get(url)
+        latencies.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise RuntimeError('{} returned {}'.format(url, response.status_code))
+
+    latencies.sort()
+    return {'name': 'tile_server.{}'.format(name), 'seconds': sum(latencies), 'requests': len(urls),
+            'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'p99_ms': latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1000}
+
+
+def bench_tile_server(tmp_dir, max_zoom, cnt_requests):
+    """
+    Request each endpoint of `tile_server` on tiles rendered by `bench_get_tiling`.
+    Tiles deeper than `max_zoom` are rendered on demand.
+    """
+    tile_server = configure_tile_server(tmp_dir)
+    test_client = tile_server.app.test_client()
+    # The first request finds tilings.
+    test_client.get('/get_tile_variants')
+
+    start = time.perf_counter()
+    tiling = tile_server.tilings.get(SUFFIX)
+    results = [{'name': 'tile_server.load_tiling', 'seconds': time.perf_counter() - start}]
+
+    rnd = random.Random(0)
+    names = tiling.tiler.columns.names
+
+    def get_tile_urls(prefix, ext, min_zoom, zoom_range):
+        urls = []
+        for _ in range(cnt_requests):
+            zoom = rnd.randint(min_zoom, min_zoom + zoom_range)
+            urls.append('/{}_{}/{}_{}_{}{}'.format(prefix, SUFFIX, rnd.randrange(1 << zoom),
+                                                   rnd.randrange(1 << zoom), zoom, ext))
+        return urls
+
+    rendered_urls = get_tile_urls('tiles', '.png', max_zoom + 1, 2)
+    requests = [
+        ('page', ['/'] * cnt_requests),
+        ('tile_variants', ['/get_tile_variants'] * cnt_requests),
+        ('tile_version', ['/tile_version/{}'.format(SUFFIX)] * cnt_requests),
+        ('tile_file', get_tile_urls('tiles', '.png', 0, max_zoom)),
+        # Tiles which share a metatile are rendered once.
+        ('tile_on_demand', rendered_urls),
+        ('tile_on_demand_cached', rendered_urls),
+        ('point_tile', get_tile_urls('points', '', 0, max_zoom + 2)),
+        ('search', ['/search/{}/{}'.format(SUFFIX, rnd.choice(names)) for _ in range(cnt_requests)]),
+        ('autocomplete', ['/autocomplete/{}?q={}'.format(SUFFIX, rnd.choice(names)[:rnd.randint(1, 5)])
+                          for _ in range(cnt_requests)]),
+    ]
+    for name, urls in requests:
+        results.append(time_requests(test_client, name, urls))
+    return results
+
+
+def compare_with_baseline(results, params, baseline, threshold):
+    """
+    Print results which differ from the baseline. Returns names of regressions.
+    """
+    baseline_seconds = {result['name']: result['seconds'] for result in baseline['results']}
+    regressions = []
+    print('\nCompared with {}:'.format(baseline['environment'].get('commit')))
+    if baseline['params'] != params:
+        print('Warning: the baseline was run with different parameters: {}'.format(baseline['params']))
+    for result in results:
+        old_seconds = baseline_seconds.get(result['name'])
+        if old_seconds is None or max(old_seconds, result['seconds']) < MIN_COMPARED_SECONDS:
+            continue
+        ratio = result['seconds'] / old_seconds
+        if ratio > 1 + threshold:
+            regressions.append(result['name'])
+            print('{:<36} {:>6.2f}x slower'.format(result['name'], ratio))
+        elif ratio < 1 / (1 + threshold):
+            print('{:<36} {:>6.2f}x faster'.format(result['name'], 1 / ratio))
+    if not regressions:
+        print('No regressions.')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark stages of the pipeline on synthetic data.')
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='small')
+    parser.add_argument('--posts', type=int, help='number of posts for prepare_stacklite_data')
+    parser.add_argument('--tags', type=int, help='number of tags for other stages')
+    parser.add_argument('--max-zoom', type=int, help='deepest pre-rendered zoom level')
+    parser.add_argument('--requests', type=int, help='number of requests to each endpoint')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each pipeline stage')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+            help='slowdown reported as a regression (default: %(default)s, that is 20%%)')
+    args = parser.parse_args()
+
+    params = dict(PRESETS[args.preset])
+    for key in params:
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+    params['repeat'] = args.repeat
+
+    # The tile server changes the current directory.
+    output_path = os.path.abspath(args.output)
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for stage_name in ('prepare_stacklite', 'scripts', 'tiling'):
+            stage_dir = os.path.join(tmp_dir, stage_name)
+            os.mkdir(stage_dir)
+            if stage_name == 'prepare_stacklite':
+                stage_results = bench_prepare_stacklite(stage_dir, params['posts'], args.repeat)
+            elif stage_name == 'scripts':
+                stage_results = bench_scripts(stage_dir, params['tags'], args.repeat)
+            else:
+                stage_results = bench_get_tiling(stage_dir, params['tags'], params['max_zoom'], args.repeat)
+                stage_results += bench_tile_server(stage_dir, params['max_zoom'], params['requests'])
+
+            for result in stage_results:
+                details = ''
+                if 'p50_ms' in result:
+                    details = 'p50 {:.2f} ms, p99 {:.2f} ms'.format(result['p50_ms'], result['p99_ms'])
+                print('{:<36} {:>9.3f} s   {}'.format(result['name'], result['seconds'], details))
+            results.extend(stage_results)
+        os.chdir(BENCHMARKS_DIR)
+
+    with open(output_path, 'w') as output_file:
+        json.dump({'environment': get_environment(), 'params': params, 'results': results},
+                  output_file, indent=2)
+    print('Saved results to {}'.format(output_path))
+
+    if baseline is not None and compare_with_baseline(results, params, baseline, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import sys
+import csv
+import time
+import argparse
+import tempfile
+import multiprocessing
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../visualization'))
+
+import get_tiling
+import synthetic
+
+'''
+Compare memory taken by loaded tags: one object with a `__dict__` per tag
+(the way `get_tags_data` used to work) against `TagColumns`.
+
+Either pass real input files, or a number of synthetic tags.
+Tag names are shared between tilings loaded into `TagColumns`,
+see `--tilings`.
+
+Example usage:
+    python3 bench_tag_memory.py --tags 50000
+    python3 bench_tag_memory.py --tsv tsne_output_2008-01-01.tsv \
+        --additional id_to_additional_info_2008-01-01.csv
+'''
+
+
+class DictTag:
+
+    def __init__(self, x, y, *additional_info):
+        self.x = x
+        self.y = y
+        for field_name, field_val in additional_info:
+            self.__dict__[field_name] = field_val
+
+
+def get_dict_tags(tsv_data_path, additional_data_path):
+    with open(additional_data_path, 'r', newline='') as additional_info_file:
+        additional_reader = csv.DictReader(additional_info_file)
+        with open(tsv_data_path, 'r', newline='') as tsvfile:
+            reader = csv.DictReader(tsvfile, delimiter='\t')
+            tags = []
+            for row, add_info in zip(reader, additional_reader):
+                flat_addinfo = [(name, add_info[name]) for name in additional_reader.fieldnames]
+                tags.append(DictTag(float(row['x']), float(row['y']), *flat_addinfo))
+            return tags
+
+
+def load_dict_tags(tsv_path, info_path):
+    return get_dict_tags(tsv_path, info_path)
+
+
+def load_tag_columns(tsv_path, info_path):
+    return get_tiling.get_tags_data(tsv_path, info_path)
+
+
+def load_tiler_from_dict_tags(tsv_path, info_path):
+    return get_tiling.Tiler(get_dict_tags(tsv_path, info_path))
+
+
+def load_tiler_from_tag_columns(tsv_path, info_path):
+    return get_tiling.Tiler(get_tiling.get_tags_data(tsv_path, info_path))
+
+
+LOADERS = [
+    ('dict per tag', load_dict_tags),
+    ('TagColumns', load_tag_columns),
+    ('dict + Tiler', load_tiler_from_dict_tags),
+    ('cols + Tiler', load_tiler_from_tag_columns),
+]
+
+
+def measure(load, tsv_path, info_path, cnt_tilings):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = [load(tsv_path, info_path) for _ in range(cnt_tilings)]
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return elapsed, current, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure memory taken by loaded tags.')
+    parser.add_argument('--tags', type=int, default=50000)
+    parser.add_argument('--tsv')
+    parser.add_argument('--additional')
+    parser.add_argument('--tilings', type=int, default=1,
+            help='number of tilings with the same tags loaded at once (as in the tile server)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.tsv is not None and args.additional is not None:
+            tsv_path, info_path = args.tsv, args.additional
+        else:
+            tsv_path, info_path = synthetic.write_tiling_input(tmp_dir, 'bench', args.tags)
+
+        print('{:<14} {:>8} {:>12} {:>12}'.format('', 'time,s', 'kept,MiB', 'peak,MiB'))
+        for title, load in LOADERS:
+            # Each loader runs in a fresh process, so that
+            # it is not affected by memory left by others.
+            with multiprocessing.Pool(1) as pool:
+                elapsed, current, peak = pool.apply(measure, (load, tsv_path, info_path, args.tilings))
+            print('{:<14} {:>8.3f} {:>12.1f} {:>12.1f}'.format(title, elapsed,
+                  current / (1 << 20), peak / (1 << 20)))
+
+
+if __name__ == '__main__':
+    main()
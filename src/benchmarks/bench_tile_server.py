@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../visualization'))
+
+import get_tiling
+import synthetic
+from bench_http_cache import SUFFIX, prerender_tiles
+
+'''
+Load test of the tile server: the Flask app (`tile_server.py`, as `run_server.py`
+runs it) against `async_tile_server.py`.
+
+A synthetic map is rendered into a directory of tiles, then each server is
+started in its own process on it. Clients keep connections alive (when the
+server allows it) and request random pre-rendered tiles as fast as they can,
+with several levels of concurrency. Latency of every request is measured
+from sending it to receiving the whole response, including reconnects.
+
+The Flask app is run by gevent's WSGIServer, as in `run_server.py`. Without
+gevent, Werkzeug's threaded server is used, which is reported.
+
+Clients run in this process, on the same machine as the server, so compare
+servers with each other rather than with absolute numbers.
+
+Example usage:
+    python3 bench_tile_server.py --concurrency 1 16 64 --requests 3000
+    python3 bench_tile_server.py --json results.json
+'''
+
+SERVERS = ('flask', 'async')
+HOST = '127.0.0.1'
+# How long to wait for a server to start, in seconds.
+START_TIMEOUT = 60
+
+
+def configure_tile_server(data_dir):
+    """
+    Make `tile_server` use tiles and input data from `data_dir`.
+    """
+    import tile_server
+    get_tiling.TILES_DIR_BASE = os.path.join(data_dir, 'tiles')
+    get_tiling.SNAPSHOT_DIR_BASE = os.path.join(data_dir, 'snapshot')
+    tile_server.BASE_DIR = tile_server.PROCESSED_DIR = data_dir
+    tile_server.POINTS_TSV_FMT = os.path.join(data_dir, 'tsne_output_{}.tsv')
+    tile_server.RAW_POINTS_FMT = os.path.join(data_dir, 'raw_tsne_output_{}.txt')
+    tile_server.ADDITIONAL_INFO_FMT = os.path.join(data_dir, 'id_to_additional_info_{}.csv')
+    # The server looks for tilings in the current directory.
+    os.chdir(data_dir)
+    return tile_server
+
+
+def run_flask_server(port):
+    tile_server = sys.modules['tile_server']
+    try:
+        from gevent.pywsgi import WSGIServer
+    except ImportError:
+        from werkzeug.serving import run_simple
+        print('gevent is not installed, using Werkzeug threaded server')
+        sys.stdout.flush()
+        run_simple(HOST, port, tile_server.app, threaded=True)
+        return
+    print('Using gevent WSGIServer')
+    sys.stdout.flush()
+    WSGIServer((HOST, port), tile_server.app, log=None).serve_forever()
+
+
+def run_async_server(port):
+    import async_tile_server
+    asyncio.run(async_tile_server.serve(HOST, port))
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def start_server(kind, data_dir):
+    port = get_free_port()
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', kind,
+                                '--data-dir', data_dir, '--port', str(port)],
+                               stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + START_TIMEOUT
+    while True:
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return process, port
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError('{} server did not start'.format(kind))
+            time.sleep(0.1)
+
+
+async def read_response(reader):
+    """
+    Read a response. Returns a pair <status, whether the connection stays open>.
+    """
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    version, status = lines[0].split(' ')[:2]
+    headers = dict()
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    elif status != '304':
+        await reader.read()
+        return int(status), False
+
+    connection = headers.get('connection', '').lower()
+    keep_alive = 'keep-alive' in connection if version == 'HTTP/1.0' else 'close' not in connection
+    return int(status), keep_alive
+
+
+async def run_client(port, urls, latencies, errors):
+    reader = writer = None
+    for url in urls:
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(HOST, port)
+            writer.write('GET {} HTTP/1.1\r\nHost: {}\r\nConnection: keep-alive\r\n\r\n'.format(
+                         url, HOST).encode('latin-1'))
+            status, keep_alive = await read_response(reader)
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            errors.append(url)
+            writer = None
+            continue
+        latencies.append(time.perf_counter() - start)
+        if status != 200:
+            errors.append(url)
+        if not keep_alive:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def run_load(port, urls, concurrency, cnt_requests, seed):
+    rnd = random.Random(seed)
+    per_client = [[rnd.choice(urls) for _ in range(cnt_requests // concurrency)] for _ in range(concurrency)]
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*[run_client(port, client_urls, latencies, errors) for client_urls in per_client])
+    return latencies, errors, time.perf_counter() - start
+
+
+def get_percentile(sorted_values, q):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))]
+
+
+def prepare_data(data_dir, cnt_tags, max_zoom):
+    """
+    Render a synthetic map into `data_dir`. Returns URLs of all its tiles.
+    """
+    tsv_path, info_path = synthetic.write_tiling_input(data_dir, SUFFIX, cnt_tags)
+    get_tiling.TILES_DIR_BASE = os.path.join(data_dir, 'tiles')
+    get_tiling.SNAPSHOT_DIR_BASE = os.path.join(data_dir, 'snapshot')
+
+    prerender_tiles(tsv_path, info_path, max_zoom)
+
+    return ['/tiles_{}/{}'.format(SUFFIX, get_tiling.get_tile_name(x, y, zoom))
+            for zoom in range(max_zoom + 1) for x in range(1 << zoom) for y in range(1 << zoom)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of tile servers.')
+    parser.add_argument('--servers', nargs='+', choices=SERVERS, default=list(SERVERS))
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16, 64])
+    parser.add_argument('--requests', type=int, default=3000, help='number of requests per run')
+    parser.add_argument('--tags', type=int, default=2000)
+    parser.add_argument('--max-zoom', type=int, default=5, help='deepest zoom level of pre-rendered tiles')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also save results to this file')
+    parser.add_argument('--serve', choices=SERVERS, help=argparse.SUPPRESS)
+    parser.add_argument('--data-dir', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        configure_tile_server(args.data_dir)
+        if args.serve == 'flask':
+            run_flask_server(args.port)
+        else:
+            run_async_server(args.port)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        urls = prepare_data(data_dir, args.tags, args.max_zoom)
+        print('{} tiles, {} requests per run'.format(len(urls), args.requests))
+        print('{:<8} {:>12} {:>10} {:>10} {:>10} {:>8}'.format('server', 'concurrency', 'rps',
+              'p50, ms', 'p99, ms', 'errors'))
+
+        for kind in args.servers:
+            process, port = start_server(kind, data_dir)
+            try:
+                # Warm up: the first requests load the tiling and hash its tiles.
+                asyncio.run(run_load(port, urls, 1, min(len(urls), 100), args.seed))
+                for concurrency in args.concurrency:
+                    latencies, errors, elapsed = asyncio.run(run_load(port, urls, concurrency,
+                                                                      args.requests, args.seed))
+                    latencies.sort()
+                    result = {'server': kind, 'concurrency': concurrency, 'requests': len(latencies),
+                              'errors': len(errors), 'rps': len(latencies) / elapsed,
+                              'p50_ms': get_percentile(latencies, 0.5) * 1000,
+                              'p99_ms': get_percentile(latencies, 0.99) * 1000}
+                    results.append(result)
+                    print('{:<8} {:>12} {:>10.0f} {:>10.2f} {:>10.2f} {:>8}'.format(kind, concurrency,
+                          result['rps'], result['p50_ms'], result['p99_ms'], result['errors']))
+            finally:
+                process.kill()
+                process.wait()
+
+    if args.json is not None:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../visualization'))
+
+import get_tiling
+import synthetic
+
+'''
+Measure how tile generation time scales with the number of tags.
+
+For each number of tags, a synthetic map is generated, and every metatile
+of each zoom level is drawn (optionally, also cut into tiles and encoded).
+
+Example usage:
+    python3 bench_tiler.py --tags 376 5000 50000 --max-zoom 5
+'''
+
+
+def bench_tiler(cnt_tags, max_zoom, encode):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tsv_path, info_path = synthetic.write_tiling_input(tmp_dir, 'bench', cnt_tags)
+
+        start = time.perf_counter()
+        tiler = get_tiling.Tiler(get_tiling.get_tags_data(tsv_path, info_path))
+        load_time = time.perf_counter() - start
+
+    zoom_times = []
+    for zoom in range(max_zoom + 1):
+        start = time.perf_counter()
+        for meta_x in range(0, 1 << zoom, get_tiling.METATILE_SIZE):
+            for meta_y in range(0, 1 << zoom, get_tiling.METATILE_SIZE):
+                img, _ = tiler.get_metatile(meta_x, meta_y, zoom)
+                if encode:
+                    for _, _, image_part in get_tiling.cut_metatile(img, meta_x, meta_y, zoom):
+                        get_tiling.encode_tile(image_part)
+        zoom_times.append(time.perf_counter() - start)
+
+    return load_time, zoom_times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark tile generation.')
+    parser.add_argument('--tags', type=int, nargs='+', default=[376, 2000, 10000, 50000])
+    parser.add_argument('--max-zoom', type=int, default=5)
+    parser.add_argument('--encode', action='store_true', help='also cut metatiles and encode PNGs')
+    args = parser.parse_args()
+
+    print('{:>8} {:>8} '.format('tags', 'load,s') +
+          ' '.join('{:>8}'.format('z={},s'.format(zoom)) for zoom in range(args.max_zoom + 1)))
+    for cnt_tags in args.tags:
+        load_time, zoom_times = bench_tiler(cnt_tags, args.max_zoom, args.encode)
+        print('{:>8} {:>8.3f} '.format(cnt_tags, load_time) +
+              ' '.join('{:>8.3f}'.format(t) for t in zoom_times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import random
+
+'''
+Generators of synthetic data, shaped like the real data of our pipeline.
+They are used by benchmarks, so that they can run without downloading
+anything or running t-SNE for hours.
+
+All generators are deterministic for a given seed.
+'''
+
+
+def make_tag_names(cnt_tags):
+    return ['tag{}'.format(i) for i in range(cnt_tags)]
+
+
+def make_points(cnt_tags, seed=0):
+    """
+    Return lists <names, x, y, post counts> for `cnt_tags` tags.
+
+    Points are grouped into clusters, like t-SNE output, and post
+    counts follow a heavy-tailed distribution, like real tags.
+    """
+    rnd = random.Random(seed)
+    cnt_clusters = max(1, cnt_tags // 200)
+    centers = [(rnd.gauss(0, 40), rnd.gauss(0, 40)) for _ in range(cnt_clusters)]
+
+    names = make_tag_names(cnt_tags)
+    xs, ys, post_counts = [], [], []
+    for _ in range(cnt_tags):
+        center_x, center_y = rnd.choice(centers)
+        xs.append(rnd.gauss(center_x, 4))
+        ys.append(rnd.gauss(center_y, 4))
+        post_counts.append(int(rnd.paretovariate(1.1) * 10))
+
+    return names, xs, ys, post_counts
+
+
+def write_tiling_input(out_dir, suffix, cnt_tags, seed=0):
+    """
+    Write `tsne_output_<suffix>.tsv` and `id_to_additional_info_<suffix>.csv`
+    into `out_dir`, in the same format as our pipeline does.
+
+    Returns paths to both files.
+    """
+    names, xs, ys, post_counts = make_points(cnt_tags, seed)
+
+    tsv_path = os.path.join(out_dir, 'tsne_output_{}.tsv'.format(suffix))
+    with open(tsv_path, 'w') as tsv_file:
+        tsv_file.write('x\ty\n')
+        for x, y in zip(xs, ys):
+            tsv_file.write('{}\t{}\n'.format(x, y))
+
+    info_path = os.path.join(out_dir, 'id_to_additional_info_{}.csv'.format(suffix))
+    with open(info_path, 'w') as info_file:
+        info_file.write('Id,name,PostCount\n')
+        for i, (name, post_count) in enumerate(zip(names, post_counts)):
+            info_file.write('{},{},{}\n'.format(i, name, post_count))
+
+    return tsv_path, info_path
+
+
+def write_raw_tsne_output(path, cnt_tags, seed=0):
+    """
+    Write output of `bh_tsne` for `cnt_tags` points to `path`: the table of
+    points between `######START TSV` and `######END TSV`, surrounded by log lines.
+    """
+    _, xs, ys, _ = make_points(cnt_tags, seed)
+    with open(path, 'w') as out_file:
+        out_file.write('Read the {} x {} data matrix successfully!\n'.format(cnt_tags, cnt_tags))
+        for iteration in range(50, 1001, 50):
+            out_file.write('Iteration {}: error is 1.234567 (50 iterations in 1.00 seconds)\n'.format(iteration))
+        out_file.write('######START TSV\nx\ty')
+        for x, y in zip(xs, ys):
+            out_file.write('\n{}\t{}'.format(x, y))
+        out_file.write('\n######END TSV\n')
+        out_file.write('\nWrote the {} x 2 data matrix successfully!\n'.format(cnt_tags))
+    return path
+
+
+def write_mappings(out_dir, cnt_tags, seed=0):
+    """
+    Write inputs of `merge_mappings.py` into `out_dir`: a mapping from ids in the
+    adjacency matrix to ids in the neighbour matrix (only some tags have posts
+    in the time period, so adjacency ids are sparse), `tags.csv` with names
+    of all tags and `post_count.csv`.
+
+    Returns paths to these three files.
+    """
+    rnd = random.Random(seed)
+    cnt_all_tags = cnt_tags + cnt_tags // 4
+    adj_ids = sorted(rnd.sample(range(1, cnt_all_tags + 1), cnt_tags))
+
+    adj_to_nn_path = os.path.join(out_dir, 'adj_id_to_nn_id.txt')
+    with open(adj_to_nn_path, 'w') as out_file:
+        for nn_id, adj_id in enumerate(adj_ids):
+            out_file.write('{} {}\n'.format(adj_id, nn_id))
+
+    tags_path = os.path.join(out_dir, 'tags.csv')
+    with open(tags_path, 'w') as out_file:
+        out_file.write('Id,Tag\n')
+        for adj_id, name in enumerate(make_tag_names(cnt_all_tags), 1):
+            out_file.write('{},{}\n'.format(adj_id, name))
+
+    post_count_path = os.path.join(out_dir, 'post_count.csv')
+    with open(post_count_path, 'w') as out_file:
+        out_file.write('Id,PostCount\n')
+        for adj_id in adj_ids:
+            out_file.write('{},{}\n'.format(adj_id, int(rnd.paretovariate(1.1) * 10)))
+
+    return adj_to_nn_path, tags_path, post_count_path
+
+
+def write_stacklite_input(out_dir, cnt_posts, cnt_tags=5000, duplicate_rate=0.01, seed=0):
+    """
+    Write `questions.csv` and `question_tags.csv` into `out_dir`, in the
+    format of StackLite data. Tags of a post come sequentially, and
+    some of them are repeated, as in the real data.
+
+    Returns paths to both files.
+    """
+    rnd = random.Random(seed)
+    names = make_tag_names(cnt_tags)
+    # Popularity of tags is heavy-tailed.
+    weights = [1 / (rank + 1) for rank in range(cnt_tags)]
+    rnd.shuffle(names)
+
+    questions_path = os.path.join(out_dir, 'questions.csv')
+    question_tags_path = os.path.join(out_dir, 'question_tags.csv')
+    with open(questions_path, 'w') as questions_file, \
+            open(question_tags_path, 'w') as question_tags_file:
+        questions_file.write('Id,CreationDate,ClosedDate,DeletionDate,Score,OwnerUserId,AnswerCount\n')
+        question_tags_file.write('Id,Tag\n')
+
+        post_id = 0
+        for _ in range(cnt_posts):
+            post_id += rnd.randint(1, 3)
+            day = rnd.randrange(3000)
+            questions_file.write('{},{:04d}-{:02d}-{:02d}T12:00:00Z,NA,NA,{},{},{}\n'.format(
+                post_id, 2008 + day // 365, day % 12 + 1, day % 28 + 1,
+                rnd.randint(-5, 100), rnd.randint(1, 10 ** 6), rnd.randint(0, 10)))
+
+            tags = rnd.choices(names, weights, k=rnd.randint(1, 5))
+            if rnd.random() < duplicate_rate:
+                tags.append(rnd.choice(tags))
+            for tag in tags:
+                question_tags_file.write('{},{}\n'.format(post_id, tag))
+
+    return questions_path, question_tags_path
+
+
+def write_query_result(path, cnt_edges, cnt_tags=50000, sort=False, seed=0):
+    """
+    Write a data.stackexchange query result with `cnt_edges` rows
+    (see `convert_datastackexchange_query_result.py`) to `path`.
+
+    Every edge comes in both directions, along with some diagonal rows, as
+    the query returns them. Rows are shuffled, unless `sort` is set.
+    """
+    rnd = random.Random(seed)
+    cnt_diagonal = min(cnt_tags, cnt_edges // 10)
+    cnt_pairs = (cnt_edges - cnt_diagonal) // 2
+    rows = [(tag, tag, int(rnd.paretovariate(1.1) * 1000)) for tag in range(cnt_diagonal)]
+
+    # Unordered pairs of different tags, without repetitions.
+    pairs = [divmod(pair, cnt_tags) for pair in rnd.sample(range(cnt_tags * cnt_tags), int(2.1 * cnt_pairs) + 100)]
+    pairs = [(tag1, tag2) for tag1, tag2 in pairs if tag1 < tag2][:cnt_pairs]
+    for tag1, tag2 in pairs:
+        cnt = int(rnd.paretovariate(1.1) * 10)
+        rows.append((tag1, tag2, cnt))
+        rows.append((tag2, tag1, cnt))
+
+    if sort:
+        rows.sort()
+    else:
+        rnd.shuffle(rows)
+
+    with open(path, 'w') as out_file:
+        out_file.write('cnt,Tag1,Tag2\n')
+        for tag1, tag2, cnt in rows:
+            out_file.write('"{}","{}","{}"\n'.format(cnt, tag1, tag2))
+    return path
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import gzip
+import json
+import random
+import tempfile
+import threading
+import http.server
+
+import make_raw_data
+
+'''
+Check of resuming and revalidation in `make_raw_data.py` against a local HTTP server.
+
+The server supports ETag, If-None-Match, Range and If-Range, and can be told
+to answer a Range request with a wrong part of the file, as a broken proxy would.
+Each case prints OK or FAILED; the exit code is the number of failed cases.
+
+Example usage:
+    python3 check_make_raw_data.py
+'''
+
+FILENAME = 'questions.csv.gz'
+# Number of CSV lines in the served file; makes it span several chunks.
+CNT_LINES = 200000
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # Set by `serve`.
+    body = b''
+    etag = '"0"'
+    wrong_range = False
+    requests = []
+
+
+    def do_GET(self):
+        cls = type(self)
+        cls.requests.append(dict(self.headers))
+        if self.path != '/' + FILENAME:
+            self.send_error(404)
+            return
+        if self.headers.get('If-None-Match') == cls.etag:
+            self.send_response(304)
+            self.send_header('ETag', cls.etag)
+            self.end_headers()
+            return
+
+        start = 0
+        range_header = self.headers.get('Range')
+        # If-Range does not match when the file changed: the whole file is sent.
+        if range_header is not None and self.headers.get('If-Range', cls.etag) == cls.etag:
+            start = int(range_header[len('bytes='):].rstrip('-'))
+            if start >= len(cls.body):
+                self.send_error(416)
+                return
+            if cls.wrong_range:
+                start //= 2
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(cls.body) - 1, len(cls.body)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', cls.etag)
+        self.send_header('Content-Length', str(len(cls.body) - start))
+        self.end_headers()
+        self.wfile.write(cls.body[start:])
+
+
+    def log_message(self, *args):
+        pass
+
+
+def make_content(seed):
+    rnd = random.Random(seed)
+    lines = ['Id,CreationDate,Score\n']
+    lines.extend('{},2016-01-01T00:00:00Z,{}\n'.format(i, rnd.randint(-5, 100)) for i in range(CNT_LINES))
+    return ''.join(lines).encode('ascii')
+
+
+def serve(content, etag):
+    Handler.body = gzip.compress(content)
+    Handler.etag = etag
+    Handler.wrong_range = False
+    Handler.requests = []
+
+
+def write_partial(base_url, raw_data_dir, size):
+    """
+    Leave a download of the served file interrupted after `size` bytes.
+    """
+    with open(os.path.join(raw_data_dir, FILENAME + '.part'), 'wb') as part_file:
+        part_file.write(Handler.body[:size])
+    out_path = os.path.join(raw_data_dir, FILENAME[:-len('.gz')])
+    if os.path.isfile(out_path):
+        os.remove(out_path)
+    make_raw_data.save_meta(out_path + '.meta.json', {'url': base_url + '/' + FILENAME,
+                                                      'etag': Handler.etag, 'last_modified': None,
+                                                      'complete': False})
+
+
+def check(name, base_url, raw_data_dir, content, expected_result, expected_range=None):
+    result = make_raw_data.download(FILENAME, base_url, raw_data_dir)
+    out_path = os.path.join(raw_data_dir, FILENAME[:-len('.gz')])
+    with open(out_path + '.meta.json') as meta_file:
+        meta = json.load(meta_file)
+    with open(out_path, 'rb') as out_file:
+        ok = (result == expected_result and out_file.read() == content and meta['complete'] and
+              not os.path.exists(os.path.join(raw_data_dir, FILENAME + '.part')) and
+              Handler.requests[0].get('Range') == expected_range)
+    print('{}: {}'.format(name, 'OK' if ok else 'FAILED'))
+    Handler.requests = []
+    return ok
+
+
+def main():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    content = make_content(0)
+    new_content = make_content(1)
+    cnt_failed = 0
+    with tempfile.TemporaryDirectory() as raw_data_dir:
+        serve(content, '"old"')
+        cnt_failed += not check('full download', base_url, raw_data_dir, content, True)
+        cnt_failed += not check('up to date', base_url, raw_data_dir, content, False)
+
+        offset = len(Handler.body) // 3
+        write_partial(base_url, raw_data_dir, offset)
+        cnt_failed += not check('resume', base_url, raw_data_dir, content, True, 'bytes={}-'.format(offset))
+
+        write_partial(base_url, raw_data_dir, offset)
+        serve(new_content, '"new"')
+        cnt_failed += not check('file changed while resuming', base_url, raw_data_dir, new_content, True,
+                                'bytes={}-'.format(offset))
+
+        write_partial(base_url, raw_data_dir, offset)
+        Handler.wrong_range = True
+        cnt_failed += not check('wrong part of the file', base_url, raw_data_dir, new_content, True,
+                                'bytes={}-'.format(offset))
+
+        write_partial(base_url, raw_data_dir, len(Handler.body))
+        Handler.wrong_range = False
+        cnt_failed += not check('range not satisfiable', base_url, raw_data_dir, new_content, True,
+                                'bytes={}-'.format(len(Handler.body)))
+
+    server.shutdown()
+    return cnt_failed
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -1,5 +1,10 @@
 #include <cassert>
+#include <cstdint>
+#include <cstdlib>
 #include <cstring>
+#include <ctime>
+
+#include <sys/stat.h>
 
 #include <iostream>
 #include <sstream>
@@ -16,6 +21,9 @@ using namespace std;
  * Precompute the adjacency matrix, 
  * using `post_tag.csv` produced by `prepare_stacklite_data.py`.
  *
+ * If binary `posts.npy` and `post_tag.npy` (see `interim.py`) are present
+ * and not older than text files, they are read instead, which is much faster.
+ *
  * The python version `compute_matrix.py` using PostgreSQL works
  * very slow, so we decided to rewrite it in C++ without any DBMS usage.
  *
@@ -37,6 +45,8 @@ namespace
 {
     const string post_tag_csv = "../../data/interim/post_tag.csv";
     const string posts_data_csv = "../../data/interim/posts.csv";
+    const string post_tag_npy = "../../data/interim/post_tag.npy";
+    const string posts_data_npy = "../../data/interim/posts.npy";
     const string matrix_out_file_prefix = "../../data/interim/adj_matrix_";
     const string matrix_out_file_suffix = ".txt";
 
@@ -48,7 +58,8 @@ namespace
 
     unordered_map<int, vector<int>> post_to_tags;
     vector< pair<int, int> > tags_with_posts;
-    unordered_map<int, uint64_t> post_id_to_creation_hash;
+    unordered_map<int, int> post_id_to_creation_day;
+    int max_tag_id = 0;
 
     void print_row(ostream& matrix_out, ostream& postcount_out, int row_no)
     {
@@ -70,18 +81,102 @@ namespace
         matrix_out << endl;
     }
 
-    uint64_t get_date_hash(istringstream& ss)
+    int get_day_number(istringstream& ss)
     {
         /*
          * Given a string reader `ss`, which is about
          * to read a date in the form YYYY-MM-DD (e.g. 2008-08-01),
-         * return a number representation for this date (so we can
+         * return the number of days since 1970-01-01 (so we can
          * compare numbers instead of strings).
+         *
+         * http://howardhinnant.github.io/date_algorithms.html#days_from_civil
          */
         int year, month, day;
         char delim;
         ss >> year >> delim >> month >> delim >> day;
-        return static_cast<uint64_t>(year) * 4000 + month * 40 + day;
+
+        year -= month <= 2;
+        const int era = (year >= 0 ? year : year - 399) / 400;
+        const int year_of_era = year - era * 400;
+        const int day_of_year = (153 * (month + (month > 2 ? -3 : 9)) + 2) / 5 + day - 1;
+        const int day_of_era = year_of_era * 365 + year_of_era / 4 - year_of_era / 100 + day_of_year;
+        return era * 146097 + day_of_era - 719468;
+    }
+
+    vector<int32_t> read_npy_pairs(const string& path)
+    {
+        /*
+         * Read an `.npy` file with int32 array of shape (n, 2),
+         * as written by `interim.py`. Returns a flat vector of 2 * n numbers.
+         */
+        ifstream inp(path, ios::binary);
+        char magic[6];
+        unsigned char version[2];
+        inp.read(magic, 6);
+        inp.read(reinterpret_cast<char*>(version), 2);
+        if (!inp || memcmp(magic, "\x93NUMPY", 6) != 0)
+        {
+            cerr << path << " is not an .npy file" << endl;
+            exit(1);
+        }
+
+        // Header length is 2 bytes in version 1.0, and 4 bytes later (little-endian).
+        unsigned char len_bytes[4] = {0, 0, 0, 0};
+        inp.read(reinterpret_cast<char*>(len_bytes), version[0] == 1 ? 2 : 4);
+        uint32_t header_len = len_bytes[0] | (len_bytes[1] << 8) | (len_bytes[2] << 16) | (len_bytes[3] << 24);
+        string header(header_len, ' ');
+        inp.read(&header[0], header_len);
+
+        size_t shape_pos = header.find("'shape': (");
+        if (header.find("'descr': '<i4'") == string::npos || 
+            header.find("'fortran_order': False") == string::npos ||
+            shape_pos == string::npos)
+        {
+            cerr << path << " must hold a C-ordered int32 array, got header " << header << endl;
+            exit(1);
+        }
+        istringstream shape_reader(header.substr(shape_pos + strlen("'shape': (")));
+        size_t rows, columns;
+        char delim;
+        shape_reader >> rows >> delim >> columns;
+        if (!shape_reader || columns != 2)
+        {
+            cerr << path << " must have shape (n, 2), got header " << header << endl;
+            exit(1);
+        }
+
+        vector<int32_t> data(rows * 2);
+        inp.read(reinterpret_cast<char*>(data.data()), data.size() * sizeof(int32_t));
+        if (!inp)
+        {
+            cerr << path << " is truncated" << endl;
+            exit(1);
+        }
+        return data;
+    }
+
+    time_t get_mtime(const string& path)
+    {
+        /*
+         * Return modification time of a file, or -1 if it does not exist.
+         */
+        struct stat file_stat;
+        if (stat(path.c_str(), &file_stat) != 0)
+        {
+            return -1;
+        }
+        return file_stat.st_mtime;
+    }
+
+    bool use_npy_input()
+    {
+        /*
+         * Binary files are used if both exist and text files were not
+         * written after them (e.g. by `prepare_stacklite_data.py --format csv`).
+         */
+        time_t npy_mtime = min(get_mtime(posts_data_npy), get_mtime(post_tag_npy));
+        time_t csv_mtime = max(get_mtime(posts_data_csv), get_mtime(post_tag_csv));
+        return npy_mtime >= 0 && npy_mtime >= csv_mtime;
     }
 
     void read_posts_data()
@@ -110,56 +205,92 @@ namespace
 
             ss >> post_id;
             ss.ignore(1);
-            uint64_t date_hash = get_date_hash(ss);
+            post_id_to_creation_day[post_id] = get_day_number(ss);
+        }
+
+    }
+
+    void read_posts_data_npy()
+    {
+        vector<int32_t> posts = read_npy_pairs(posts_data_npy);
+        post_id_to_creation_day.reserve(posts.size() / 2);
+        for (size_t i = 0; i < posts.size(); i += 2)
+        {
+            post_id_to_creation_day[posts[i]] = posts[i + 1];
+        }
+    }
+
+    void add_post_tag(int post_id, int tag_id, int day_lower_bound)
+    {
+        assert (post_id_to_creation_day.count(post_id));
+        if (post_id_to_creation_day[post_id] <= day_lower_bound)
+        {
+            // Disregard posts earlier than certain date.
+            return;
+        }
+
+        post_to_tags[post_id].push_back(tag_id);
+        max_tag_id = max(max_tag_id, tag_id);
+        tags_with_posts.push_back(make_pair(tag_id, post_id));
+    }
+
+    void read_post_tags(int day_lower_bound)
+    {
+        ifstream inp(post_tag_csv);
+        string current_line;
+        int post_id, tag_id;
+
+        // Skip header.
+        getline(inp, current_line);
+
+        while (getline(inp, current_line))
+        {
+            istringstream ss(current_line);
+
+            ss >> post_id;
+            ss.ignore(1);
+            ss >> tag_id;
 
-            post_id_to_creation_hash[post_id] = date_hash;
+            add_post_tag(post_id, tag_id, day_lower_bound);
         }
+    }
 
+    void read_post_tags_npy(int day_lower_bound)
+    {
+        vector<int32_t> post_tags = read_npy_pairs(post_tag_npy);
+        for (size_t i = 0; i < post_tags.size(); i += 2)
+        {
+            add_post_tag(post_tags[i], post_tags[i + 1], day_lower_bound);
+        }
     }
 } // anon namespace
 
 
 int main(int argc, char **argv)
 {
-    uint64_t date_lower_bound_hash = 0;
     istringstream date_reader(argv[1]);
     cout << "Generating an adjacency matrix using posts later than " << argv[1] << endl;
-    date_lower_bound_hash = get_date_hash(date_reader);
+    int day_lower_bound = get_day_number(date_reader);
 
     ofstream postcount_out(postcount_prefix + string(argv[1]) + postcount_suffix);
     postcount_out << "Id,PostCount" << endl;
 
-    read_posts_data();
-    ifstream inp(post_tag_csv);
-    ofstream out(matrix_out_file_prefix + string(argv[1]) + matrix_out_file_suffix);
-    string current_line;
-    int post_id, tag_id;
-
-    // Skip header.
-    getline(inp, current_line);
-
-    int max_tag_id = 0;
-
-    while (getline(inp, current_line))
+    if (use_npy_input())
     {
-        istringstream ss(current_line);
-
-        ss >> post_id;
-        ss.ignore(1);
-        ss >> tag_id;
+        cout << "Reading " << posts_data_npy << " and " << post_tag_npy << endl;
+        read_posts_data_npy();
+        read_post_tags_npy(day_lower_bound);
+    }
+    else
+    {
+        cout << "Reading " << posts_data_csv << " and " << post_tag_csv << endl;
+        read_posts_data();
+        read_post_tags(day_lower_bound);
+    }
 
-        assert (post_id_to_creation_hash.count(post_id));
-        if (post_id_to_creation_hash[post_id] <= date_lower_bound_hash)
-        {
-            // Disregard posts earlier than certain date.
-            continue;
-        }
+    ofstream out(matrix_out_file_prefix + string(argv[1]) + matrix_out_file_suffix);
+    int post_id, tag_id;
 
-        post_to_tags[post_id].push_back(tag_id);
-        max_tag_id = max(max_tag_id, tag_id);
-        tags_with_posts.push_back(make_pair(tag_id, post_id));
-    }
-    
     ++max_tag_id;
 
     sort(tags_with_posts.begin(), tags_with_posts.end());
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import argparse
+
+import numpy as np
+
+import interim
+
+'''
+Compute adjacency matrices and post counts for many dates at once.
+
+`compute_matrix.cpp` reads all posts for every `POST_DATE`, although maps
+for different dates differ only by the set of posts taken into account.
+Instead, we go over posts once and save, for each month, how much its posts
+add to co-occurrence counts of tags and to post counts. A matrix for any date
+is then a sum of deltas of the following months.
+
+Posts are bucketed by the month of the day before their creation day, because
+for a date D we take posts created later than D: for D = YYYY-MM-01 these are
+exactly the buckets starting from YYYY-MM. For other dates, posts of the first
+(partial) month are read from interim data again.
+
+Output is the same as that of `compute_matrix.cpp` (see its description):
+    - adjacency matrix `adj_matrix_<date>.txt`
+    - .csv file with pairs <tag id, number of posts> `post_count_<date>.csv`
+
+Input:
+    `posts.npy` and `post_tag.npy` from `prepare_stacklite_data.py` (see `interim.py`).
+    Deltas are saved to `cooccurrence_deltas.npz` next to them, and rebuilt
+    when the input is newer.
+
+Usage:
+    $0 date [date ...]
+    $0 2008-01-01 2010-01-01 2012-01-01
+'''
+
+DELTAS_NPZ = 'cooccurrence_deltas.npz'
+# Number of post-tag pairs processed at once.
+CHUNK_PAIRS = 1 << 22
+
+
+def get_bucket(days):
+    """
+    Return buckets (months since 1970-01) of posts created on given days.
+    """
+    prev_days = np.asarray(days, dtype=np.int64) - 1
+    return prev_days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+
+
+def get_first_day(bucket):
+    return int(np.datetime64(int(bucket), 'M').astype('datetime64[D]').astype(np.int64)) + 1
+
+
+def date_to_day(date):
+    return int(np.datetime64(date, 'D').astype(np.int64))
+
+
+def reduce_by_key(keys, values):
+    """
+    Return sorted unique keys and sums of values for each of them.
+    """
+    if len(keys) == 0:
+        return keys, values
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    values = values[order]
+    starts = np.concatenate(([0], np.flatnonzero(keys[1:] != keys[:-1]) + 1))
+    return keys[starts], np.add.reduceat(values, starts)
+
+
+class PostTags:
+    """
+    Pairs of post and tag, grouped by post, with creation days of posts.
+    """
+
+    def __init__(self, interim_data_dir):
+        posts = interim.load_posts(interim_data_dir)
+        post_tags = interim.load_post_tags(interim_data_dir)
+
+        # Arrays keep the compact type of interim data, chunks are converted to int64.
+        order = np.argsort(posts[:, 0], kind='stable')
+        self.post_ids = np.asarray(posts[:, 0])[order]
+        self.post_days = np.asarray(posts[:, 1])[order]
+
+        pair_post_ids = np.asarray(post_tags[:, 0])
+        if np.any(pair_post_ids[1:] < pair_post_ids[:-1]):
+            order = np.argsort(pair_post_ids, kind='stable')
+            self.pair_post_ids = pair_post_ids[order]
+            self.pair_tags = np.asarray(post_tags[:, 1])[order]
+        else:
+            self.pair_post_ids = pair_post_ids
+            self.pair_tags = np.asarray(post_tags[:, 1])
+
+        self.max_tag_id = int(self.pair_tags.max()) if len(self.pair_tags) else 0
+
+
+    def get_days(self, pair_post_ids):
+        pos = np.searchsorted(self.post_ids, pair_post_ids)
+        pos = np.minimum(pos, len(self.post_ids) - 1)
+        missing = self.post_ids[pos] != pair_post_ids
+        if np.any(missing):
+            raise ValueError('Post {} is not in posts'.format(pair_post_ids[missing][0]))
+        return self.post_days[pos].astype(np.int64)
+
+
+    def get_chunks(self, mask=None):
+        """
+        Generate <post ids, tags> of consecutive posts, about `CHUNK_PAIRS` pairs at once.
+        If `mask` is given, only pairs for which it is True are taken.
+        """
+        pair_post_ids = self.pair_post_ids
+        pair_tags = self.pair_tags
+        if mask is not None:
+            pair_post_ids = pair_post_ids[mask]
+            pair_tags = pair_tags[mask]
+
+        start = 0
+        while start < len(pair_post_ids):
+            end = min(start + CHUNK_PAIRS, len(pair_post_ids))
+            # Do not split tags of one post.
+            end = int(np.searchsorted(pair_post_ids, pair_post_ids[end - 1], side='right'))
+            yield pair_post_ids[start:end].astype(np.int64), pair_tags[start:end].astype(np.int64)
+            start = end
+
+
+def get_chunk_deltas(post_ids, tags, buckets, tag_bound):
+    """
+    Compute co-occurrence and post count deltas of a chunk of posts.
+
+    Returns keys (bucket, tag, tag) with co-occurrence counts, and keys
+    (bucket, tag) with post count deltas, as `compute_matrix.cpp` counts them:
+    each tag of a post adds the number of tags of the post.
+    """
+    starts = np.concatenate(([0], np.flatnonzero(post_ids[1:] != post_ids[:-1]) + 1))
+    sizes = np.diff(np.concatenate((starts, [len(post_ids)])))
+    group_size = np.repeat(sizes, sizes)
+    group_end = np.repeat(starts + sizes, sizes)
+
+    count_keys, count_values = reduce_by_key(buckets * tag_bound + tags, group_size)
+
+    pair_keys = []
+    for shift in range(1, int(sizes.max()) if len(sizes) else 0):
+        first = np.flatnonzero(np.arange(len(tags) - shift) + shift < group_end[:len(tags) - shift])
+        tag_a = tags[first]
+        tag_b = tags[first + shift]
+        different = tag_a != tag_b
+        low = np.minimum(tag_a, tag_b)[different]
+        high = np.maximum(tag_a, tag_b)[different]
+        pair_keys.append((buckets[first][different] * tag_bound + low) * tag_bound + high)
+
+    pair_keys = np.concatenate(pair_keys) if pair_keys else np.empty(0, dtype=np.int64)
+    pair_keys, pair_values = reduce_by_key(pair_keys, np.ones(len(pair_keys), dtype=np.int64))
+    return pair_keys, pair_values, count_keys, count_values
+
+
+def compute_deltas(post_tags, mask=None, bucket_of_days=get_bucket):
+    """
+    Sum deltas over all chunks of posts. Returns sorted keys with values, see `get_chunk_deltas`.
+    """
+    tag_bound = post_tags.max_tag_id + 1
+    pair_parts = []
+    count_parts = []
+    for post_ids, tags in post_tags.get_chunks(mask):
+        buckets = bucket_of_days(post_tags.get_days(post_ids))
+        pair_keys, pair_values, count_keys, count_values = get_chunk_deltas(post_ids, tags, buckets, tag_bound)
+        pair_parts.append((pair_keys, pair_values))
+        count_parts.append((count_keys, count_values))
+
+    def merge(parts):
+        if not parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return reduce_by_key(np.concatenate([keys for keys, _ in parts]),
+                             np.concatenate([values for _, values in parts]))
+
+    return merge(pair_parts), merge(count_parts)
+
+
+class CooccurrenceDeltas:
+    """
+    Co-occurrence and post count deltas of each month, in sparse form.
+
+    For each bucket, `pair_*[pair_offsets[i]:pair_offsets[i + 1]]` are
+    co-occurrence counts of tags a < b, and `count_*[count_offsets[i]:count_offsets[i + 1]]`
+    are post count deltas of tags.
+    """
+
+    FIELDS = ('tag_bound', 'buckets', 'pair_offsets', 'pair_a', 'pair_b', 'pair_count',
+              'count_offsets', 'count_tag', 'count_value')
+
+    def __init__(self, **arrays):
+        for name in self.FIELDS:
+            setattr(self, name, arrays[name])
+
+
+    @classmethod
+    def build(cls, post_tags):
+        tag_bound = post_tags.max_tag_id + 1
+        (pair_keys, pair_values), (count_keys, count_values) = compute_deltas(post_tags)
+
+        pair_buckets = pair_keys // (tag_bound * tag_bound)
+        count_buckets = count_keys // tag_bound
+        buckets = np.union1d(pair_buckets, count_buckets)
+        return cls(tag_bound=np.int64(tag_bound),
+                   buckets=buckets,
+                   pair_offsets=np.searchsorted(pair_buckets, np.append(buckets, buckets[-1] + 1 if len(buckets) else 0)),
+                   pair_a=((pair_keys // tag_bound) % tag_bound).astype(np.int32),
+                   pair_b=(pair_keys % tag_bound).astype(np.int32),
+                   pair_count=pair_values.astype(np.int32),
+                   count_offsets=np.searchsorted(count_buckets, np.append(buckets, buckets[-1] + 1 if len(buckets) else 0)),
+                   count_tag=(count_keys % tag_bound).astype(np.int32),
+                   count_value=count_values)
+
+
+    def save(self, path):
+        tmp_path = '{}.tmp-{}.npz'.format(path, os.getpid())
+        np.savez(tmp_path, **{name: getattr(self, name) for name in self.FIELDS})
+        os.replace(tmp_path, path)
+
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(**{name: data[name] for name in cls.FIELDS})
+
+
+    def get_suffix(self, first_bucket):
+        """
+        Return co-occurrence and post count deltas of all buckets starting from `first_bucket`,
+        as keys (a * tag_bound + b, and tag) with values.
+        """
+        tag_bound = int(self.tag_bound)
+        i = int(np.searchsorted(self.buckets, first_bucket))
+        pair_slice = slice(int(self.pair_offsets[i]), int(self.pair_offsets[-1]))
+        count_slice = slice(int(self.count_offsets[i]), int(self.count_offsets[-1]))
+
+        pair_keys = self.pair_a[pair_slice].astype(np.int64) * tag_bound + self.pair_b[pair_slice]
+        return (reduce_by_key(pair_keys, self.pair_count[pair_slice].astype(np.int64)),
+                reduce_by_key(self.count_tag[count_slice].astype(np.int64), self.count_value[count_slice]))
+
+
+def add_sparse(first, second):
+    keys_a, values_a = first
+    keys_b, values_b = second
+    return reduce_by_key(np.concatenate((keys_a, keys_b)), np.concatenate((values_a, values_b)))
+
+
+def get_matrix(deltas, post_tags, date):
+    """
+    Return co-occurrence counts and post count deltas of posts created later than `date`.
+    """
+    day = date_to_day(date)
+    bucket = int(get_bucket(day + 1))
+    if get_first_day(bucket) == day + 1:
+        return deltas.get_suffix(bucket)
+
+    # The first month is taken partially: compute it from posts again.
+    pairs, counts = deltas.get_suffix(bucket + 1)
+    tag_bound = int(deltas.tag_bound)
+    last_day = get_first_day(bucket + 1) - 1
+    pair_days = post_tags.get_days(post_tags.pair_post_ids)
+    mask = (pair_days > day) & (pair_days <= last_day)
+    (partial_pairs, partial_pair_values), (partial_counts, partial_count_values) = compute_deltas(
+            post_tags, mask, bucket_of_days=lambda days: np.zeros(len(days), dtype=np.int64))
+
+    pairs = add_sparse(pairs, (partial_pairs % (tag_bound * tag_bound), partial_pair_values))
+    counts = add_sparse(counts, (partial_counts % tag_bound, partial_count_values))
+    return pairs, counts
+
+
+def write_matrix(pairs, counts, tag_bound, matrix_path, postcount_path):
+    """
+    Write the adjacency matrix and post counts in the format of `compute_matrix.cpp`.
+    """
+    pair_keys, pair_values = pairs
+    count_tags, count_values = counts
+    pair_a = pair_keys // tag_bound
+    pair_b = pair_keys % tag_bound
+
+    post_counts = np.zeros(tag_bound, dtype=np.int64)
+    post_counts[count_tags] += count_values
+    np.add.at(post_counts, pair_a, pair_values)
+
+    row_starts = np.searchsorted(pair_a, count_tags, side='left')
+    row_ends = np.searchsorted(pair_a, count_tags, side='right')
+    pair_b = pair_b.tolist()
+    pair_values = pair_values.tolist()
+
+    with open(matrix_path, 'w') as matrix_out, open(postcount_path, 'w') as postcount_out:
+        postcount_out.write('Id,PostCount\n')
+        for tag, start, end in zip(count_tags.tolist(), row_starts.tolist(), row_ends.tolist()):
+            matrix_out.write('{}: {}\n'.format(tag, ''.join('{},{} '.format(b, value)
+                             for b, value in zip(pair_b[start:end], pair_values[start:end]))))
+            postcount_out.write('{},{}\n'.format(tag, post_counts[tag]))
+
+
+def is_outdated(path, source_paths):
+    if not os.path.isfile(path):
+        return True
+    return any(os.path.getmtime(source_path) > os.path.getmtime(path) for source_path in source_paths)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compute adjacency matrices for several dates.')
+    parser.add_argument('dates', nargs='+', help='dates in the form YYYY-MM-DD')
+    parser.add_argument('--interim-data-dir', default=interim.INTERIM_DATA_DIR)
+    parser.add_argument('--rebuild', action='store_true', help='rebuild deltas even if they are up to date')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    deltas_path = os.path.join(args.interim_data_dir, DELTAS_NPZ)
+    source_paths = [os.path.join(args.interim_data_dir, interim.POSTS_NPY),
+                    os.path.join(args.interim_data_dir, interim.POST_TAG_NPY)]
+
+    post_tags = PostTags(args.interim_data_dir)
+    if args.rebuild or is_outdated(deltas_path, source_paths):
+        print('Computing monthly deltas')
+        deltas = CooccurrenceDeltas.build(post_tags)
+        deltas.save(deltas_path)
+    else:
+        deltas = CooccurrenceDeltas.load(deltas_path)
+
+    for date in args.dates:
+        print('Generating an adjacency matrix using posts later than', date)
+        pairs, counts = get_matrix(deltas, post_tags, date)
+        write_matrix(pairs, counts, int(deltas.tag_bound),
+                     os.path.join(args.interim_data_dir, 'adj_matrix_{}.txt'.format(date)),
+                     os.path.join(args.interim_data_dir, 'post_count_{}.csv'.format(date)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import os
+import os.path
+import shutil
+
+import numpy as np
+
+'''
+Binary columnar format of interim data, written by `prepare_stacklite_data.py`.
+
+    posts.npy
+        int32 array of shape (number of posts, 2): post Id, creation day.
+    post_tag.npy
+        int32 array of shape (number of pairs, 2): post Id, tag Id.
+
+Creation days are numbers of days since 1970-01-01. Files are standard
+`.npy` files: Python readers memory-map them with `load_posts` and
+`load_post_tags`, and `compute_matrix.cpp` reads them directly. This
+saves parsing gigabytes of text at every stage of the pipeline.
+'''
+
+REPO_DIR = os.path.abspath(os.path.dirname(__file__))
+INTERIM_DATA_DIR = os.path.join(REPO_DIR, '../../data/interim')
+
+POSTS_NPY = 'posts.npy'
+POST_TAG_NPY = 'post_tag.npy'
+DTYPE = np.dtype('<i4')
+
+
+def dates_to_days(dates):
+    """
+    Convert dates like `2008-07-31T21:42:52Z` (only the date part is used) to day numbers.
+    """
+    return np.array([date[:10] for date in dates], dtype='datetime64[D]').astype(DTYPE)
+
+
+def day_to_date(day):
+    return str(np.datetime64(int(day), 'D'))
+
+
+def to_interim_dtype(values, dtype=DTYPE):
+    values = np.asarray(values)
+    if len(values) and (values.min() < np.iinfo(dtype).min or values.max() > np.iinfo(dtype).max):
+        raise ValueError('Values do not fit into {}'.format(dtype))
+    return values.astype(dtype)
+
+
+class ArrayWriter:
+    """
+    Write an `.npy` file with a fixed number of columns, adding rows in chunks.
+    If `cnt_columns` is None, the array is one-dimensional.
+
+    The number of rows is not known in advance, so rows are written
+    to a temporary file, which is prefixed with a header on `close`.
+    """
+
+    def __init__(self, path, cnt_columns, dtype=DTYPE):
+        self.path = path
+        self.cnt_columns = cnt_columns
+        self.dtype = np.dtype(dtype)
+        self.cnt_rows = 0
+        self.tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+        self.tmp_file = open(self.tmp_path, 'wb')
+
+
+    def append(self, rows):
+        rows = to_interim_dtype(rows, self.dtype)
+        if self.cnt_columns is not None:
+            rows = rows.reshape(-1, self.cnt_columns)
+        rows.tofile(self.tmp_file)
+        self.cnt_rows += len(rows)
+
+
+    def close(self):
+        self.tmp_file.close()
+        shape = (self.cnt_rows,) if self.cnt_columns is None else (self.cnt_rows, self.cnt_columns)
+        header = {'descr': np.lib.format.dtype_to_descr(self.dtype),
+                  'fortran_order': False,
+                  'shape': shape}
+
+        out_path = '{}.out-{}'.format(self.path, os.getpid())
+        with open(out_path, 'wb') as out_file, open(self.tmp_path, 'rb') as tmp_file:
+            np.lib.format.write_array_header_1_0(out_file, header)
+            shutil.copyfileobj(tmp_file, out_file, 1 << 20)
+        os.remove(self.tmp_path)
+        os.replace(out_path, self.path)
+
+
+def create_array(path, cnt_rows, cnt_columns):
+    """
+    Create an `.npy` file for a known number of rows, and memory-map it for writing.
+    """
+    if cnt_rows == 0:
+        # Empty files can not be memory-mapped.
+        array = np.empty((0, cnt_columns), dtype=DTYPE)
+        np.save(path, array)
+        return array
+    return np.lib.format.open_memmap(path, mode='w+', dtype=DTYPE, shape=(cnt_rows, cnt_columns))
+
+
+def load_posts(interim_data_dir=INTERIM_DATA_DIR):
+    return np.load(os.path.join(interim_data_dir, POSTS_NPY), mmap_mode='r')
+
+
+def load_post_tags(interim_data_dir=INTERIM_DATA_DIR):
+    return np.load(os.path.join(interim_data_dir, POST_TAG_NPY), mmap_mode='r')
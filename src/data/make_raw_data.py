@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 
-import gzip
-import urllib.request
+import os
 import os.path
-import shutil
+import json
+import zlib
+import argparse
+import urllib.error
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
 
 '''
 Download raw data from `StackLite` repository.
@@ -14,41 +19,218 @@ Warning: uncompressed data weights about 1Gb,
 so make sure not to run this script too often.
 
 We could write this using Bash script, but Python
-seem more cross-platform. 
+seem more cross-platform.
 Also, Python support
 for gzip is increasing from version to version,
 which looks promising.
 
+Both files are downloaded concurrently and decompressed on the fly.
+Received compressed data is also appended to `<name>.gz.part`, so that an
+interrupted download is resumed (with an HTTP Range request) next time.
+The `.part` file is removed when the download completes.
+
+ETag and Last-Modified of downloaded files are saved to `<name>.meta.json`.
+When the remote file did not change, it is not downloaded again.
+
+Options:
+    --base-url URL - where to download files from (default: `STACKLITE_BASE_URL`
+        environment variable, or the StackLite repository).
+    --keep-compressed - keep `.gz` files as well.
+    --no-resume - do not write `.part` files (an interrupted download starts over).
+
 Example usage:
     python3 make_raw_data.py
+    STACKLITE_BASE_URL=http://localhost:8000 python3 make_raw_data.py
 '''
 
 SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
 RAW_DATA_DIR = os.path.abspath(os.path.join(SCRIPT_DIR, '../../data/raw'))
-STACKLITE_BASE_URL = 'https://github.com/dgrtwo/StackLite/raw/master'
+STACKLITE_BASE_URL = os.environ.get('STACKLITE_BASE_URL', 'https://github.com/dgrtwo/StackLite/raw/master')
+FILENAMES = ('question_tags.csv.gz', 'questions.csv.gz')
+
+CHUNK_SIZE = 1 << 20
+# Makes zlib expect a gzip header.
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class GzipStreamWriter:
+    """
+    Decompress gzip data, given in chunks, into a file.
+    """
+
+    def __init__(self, out_file):
+        self.out_file = out_file
+        self.decompressor = zlib.decompressobj(GZIP_WBITS)
+
+
+    def write(self, data):
+        while data:
+            self.out_file.write(self.decompressor.decompress(data))
+            data = self.decompressor.unused_data
+            if data:
+                # A gzip file may consist of several members.
+                self.decompressor = zlib.decompressobj(GZIP_WBITS)
+
+
+    def close(self):
+        self.out_file.write(self.decompressor.flush())
+        if not self.decompressor.eof:
+            raise ValueError('Compressed data is truncated')
+
+
+def load_meta(meta_path):
+    try:
+        with open(meta_path, 'r') as meta_file:
+            return json.load(meta_file)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_meta(meta_path, meta):
+    tmp_path = '{}.tmp-{}'.format(meta_path, os.getpid())
+    with open(tmp_path, 'w') as meta_file:
+        json.dump(meta, meta_file, sort_keys=True)
+    os.replace(tmp_path, meta_path)
+
+
+def get_validators(response):
+    return {'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified')}
+
+
+def copy_file_to(path, writer):
+    with open(path, 'rb') as in_file:
+        while True:
+            data = in_file.read(CHUNK_SIZE)
+            if not data:
+                break
+            writer.write(data)
+
+
+def download(filename, base_url=STACKLITE_BASE_URL, raw_data_dir=RAW_DATA_DIR,
+             keep_compressed=False, resume=True):
+    """
+    Download `filename` from `base_url` and decompress it into `raw_data_dir`.
+
+    Returns False if the local copy is up to date, True otherwise.
+    """
+    url = '{}/{}'.format(base_url, filename)
+    gz_path = os.path.join(raw_data_dir, filename)
+    part_path = gz_path + '.part'
+    out_path = gz_path[:-len('.gz')]
+    meta_path = out_path + '.meta.json'
+
+    meta = load_meta(meta_path)
+    if meta.get('url') != url:
+        meta = {'url': url}
+
+    request = urllib.request.Request(url)
+    offset = 0
+    if meta.get('complete') and os.path.isfile(out_path):
+        # Ask the server to send the file only if it changed.
+        if meta.get('etag'):
+            request.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            request.add_header('If-Modified-Since', meta['last_modified'])
+    elif resume and not meta.get('complete') and os.path.isfile(part_path) and \
+            (meta.get('etag') or meta.get('last_modified')):
+        # Ask for the rest of the file, but only if it is the same file.
+        offset = os.path.getsize(part_path)
+        request.add_header('Range', 'bytes={}-'.format(offset))
+        request.add_header('If-Range', meta.get('etag') or meta['last_modified'])
+
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            print('{} is up to date'.format(filename))
+            return False
+        if e.code == 416 and offset > 0:
+            # The partial file is broken. Start over.
+            os.remove(part_path)
+            return download(filename, base_url, raw_data_dir, keep_compressed, resume)
+        raise
+
+    # Only a 200 is the whole file, and only a 206 starting at `offset` continues the partial one.
+    if response.status == 206:
+        content_range = response.headers.get('Content-Range', '')
+        if offset == 0:
+            response.close()
+            raise ValueError('Got a part of {} without asking for it: {}'.format(url, content_range))
+        if not content_range.startswith('bytes {}-'.format(offset)):
+            response.close()
+            # The server sent some other part of the file. Start over without Range.
+            os.remove(part_path)
+            return download(filename, base_url, raw_data_dir, keep_compressed, resume)
+    elif response.status != 200:
+        response.close()
+        raise ValueError('Unexpected response {} {} for {}'.format(response.status, response.reason, url))
+
+    tmp_path = '{}.tmp-{}'.format(out_path, os.getpid())
+    with response, open(tmp_path, 'wb') as out_file:
+        writer = GzipStreamWriter(out_file)
+
+        if response.status == 206:
+            print('Resuming {} from {:.1f} MiB'.format(filename, offset / (1 << 20)))
+            copy_file_to(part_path, writer)
+            part_mode = 'ab'
+        else:
+            print('Downloading {}'.format(filename))
+            meta.update(get_validators(response))
+            meta['complete'] = False
+            save_meta(meta_path, meta)
+            part_mode = 'wb'
+
+        part_file = open(part_path, part_mode) if resume or keep_compressed else None
+        try:
+            while True:
+                data = response.read(CHUNK_SIZE)
+                if not data:
+                    break
+                if part_file is not None:
+                    part_file.write(data)
+                writer.write(data)
+            writer.close()
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        finally:
+            if part_file is not None:
+                part_file.close()
+
+    os.replace(tmp_path, out_path)
+    if keep_compressed:
+        os.replace(part_path, gz_path)
+    elif os.path.isfile(part_path):
+        os.remove(part_path)
+
+    meta['complete'] = True
+    save_meta(meta_path, meta)
+    print('Obtained {}'.format(os.path.basename(out_path)))
+    return True
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Download raw data from StackLite repository.')
+    parser.add_argument('--base-url', default=STACKLITE_BASE_URL)
+    parser.add_argument('--raw-data-dir', default=RAW_DATA_DIR)
+    parser.add_argument('--keep-compressed', action='store_true', help='keep downloaded .gz files')
+    parser.add_argument('--no-resume', dest='resume', action='store_false',
+            help='do not keep partially downloaded data for resuming')
+    return parser.parse_args()
+
 
 def main():
+    args = parse_args()
     print('Getting raw tag data from StackLite repo...')
+    os.makedirs(args.raw_data_dir, exist_ok=True)
 
-    # About copying remote files via urllib.request:
-    # http://stackoverflow.com/a/7244263/5338270
-    
-    for filename in ('question_tags.csv.gz', 'questions.csv.gz'):
-        download_url = '{}/{}'.format(STACKLITE_BASE_URL, filename)
-        file_path = os.path.join(RAW_DATA_DIR, filename)
-
-        print('Downloading {}'.format(filename))
-        with urllib.request.urlopen(download_url) as response:
-            with open(file_path, 'wb') as out_file:
-                shutil.copyfileobj(response, out_file)
-
-        print('Decompressing {}'.format(filename))
-        with gzip.open(file_path, 'rb') as compressed_file:
-            out_filename = filename[:-len('.csv.gz')] + '.csv'
-            out_file_path = os.path.join(RAW_DATA_DIR, out_filename)
-
-            with open(out_file_path, 'wb') as out_file:
-                shutil.copyfileobj(compressed_file, out_file)
+    with ThreadPoolExecutor(len(FILENAMES)) as pool:
+        futures = [pool.submit(download, filename, args.base_url, args.raw_data_dir,
+                               args.keep_compressed, args.resume)
+                   for filename in FILENAMES]
+        for future in futures:
+            future.result()
 
     print('Successfully obtained raw data')
 
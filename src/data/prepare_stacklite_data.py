@@ -1,7 +1,16 @@
 #!/usr/bin/env python3
 
-import csv
+import os
 import os.path
+import csv
+import argparse
+import tempfile
+import itertools
+import multiprocessing
+
+import numpy as np
+
+import interim
 
 '''
 Take StackOverflow data from https://github.com/dgrtwo/StackLite:
@@ -24,11 +33,12 @@ From tags, we need to make Id-s:
     1,c#
     2,winforms
     ...
-Then, convert question_tags into having post_id and tag_id (instead of post_id and 
+Then, convert question_tags into having post_id and tag_id (instead of post_id and
 tag name).
 
 
-Output:
+Output (posts and post_tag are written as binary `.npy` files by default,
+see `interim.py`; use `--format csv` or `--format both` for text files):
     posts.csv
         Id,CreationDate
         4,2008-07-31T21:42:52Z
@@ -46,79 +56,250 @@ Output:
         2,8
         ...
 
+Tag Id-s are assigned in sorted order of tag names, so they do not depend
+on the order of rows or on the number of workers.
+
+`question_tags.csv` is read once, in chunks. Tags of a post come sequentially,
+and some of them repeat, unfortunately: repeated tags are dropped.
+Pairs of post and tag are kept in a temporary binary file until all tags
+are known, and then written out with final tag Id-s.
+
+Options:
+    --format {npy,csv,both} - format of posts and pairs of post and tag.
+    --workers N - split `question_tags.csv` into N parts (at post boundaries)
+        and read them in separate processes. `posts.csv` is written meanwhile.
 
-Time: ~7min
+
+Time: ~7min with two passes over question tags and removing repeated tags
+with a list of recent pairs; see `src/benchmarks/bench_prepare_stacklite.py`.
 '''
 
 REPO_DIR = os.path.abspath(os.path.dirname(__file__))
 RAW_DATA_DIR = os.path.join(REPO_DIR, '../../data/raw')
 INTERIM_DATA_DIR = os.path.join(REPO_DIR, '../../data/interim')
 
-tag_to_id_mapping = dict()
-
-
-with open(os.path.join(RAW_DATA_DIR, 'questions.csv'), 'r', newline='') as questions_file:
-    reader = csv.reader(questions_file)
-    with open(os.path.join(INTERIM_DATA_DIR, 'posts.csv'), 'w', newline='') as posts_csv_file:
-        # We could use DictWriter, but it is slower.
-        writer = csv.writer(posts_csv_file)
-        for i, row in enumerate(reader):
-            if i == 0:
-                writer.writerow(['Id', 'CreationDate'])
-                continue
-            post_id = row[0]
-            creation_date = row[1]
-            writer.writerow([post_id, creation_date])
-        posts_csv_file.flush()
-
-
-with open(os.path.join(RAW_DATA_DIR, 'question_tags.csv'), 'r', newline='') as question_tags_file:
-    reader = csv.reader(question_tags_file)
-    all_tags = set()
-
-    for row in reader:
-        all_tags.add(row[1])
-    all_tags.remove('Tag')
-
-    tags = list(sorted(all_tags))
-
-    with open(os.path.join(INTERIM_DATA_DIR, 'tags.csv'), 'w', newline='') as tags_csv_file:
-        writer = csv.writer(tags_csv_file)
-        writer.writerow(['Id', 'Tag'])
-        for i, tag in enumerate(tags, 1):
-            tag_to_id_mapping[tag] = i
-            writer.writerow([i, tag])
-        tags_csv_file.flush()
-
-
-
-with open(os.path.join(RAW_DATA_DIR, 'question_tags.csv'), 'r', newline='') as question_tags_file:
-    reader = csv.reader(question_tags_file)
-    with open(os.path.join(INTERIM_DATA_DIR, 'post_tag.csv'), 'w', newline='') as post_tag_csv_file:
-        writer = csv.writer(post_tag_csv_file)
-        
-        # Queue to erase duplicate entries.
-        # We know that all tags for a single question come sequentially
-        # in `question_tags.csv`. Some of them may repeat, unfortunately.
-        # In order to overcome this, store a queue of last MAX_QUEUE_SIZE entries.
-        # If the current <post, tag> pair is already inside queue, do not output it.
-        queue = []
-        MAX_QUEUE_SIZE = 40 # ~ max number of tags per question.
-        
-        for i, row in enumerate(reader):
-            if i == 0:
-                writer.writerow(['PostId', 'TagId'])
-                continue
-            post_id = row[0]
-            tag = row[1]
-
-            if (post_id, tag) not in queue:
-                writer.writerow([post_id, tag_to_id_mapping[tag]])
-            queue.append((post_id, tag))
-            if len(queue) > MAX_QUEUE_SIZE:
-                queue.pop(0)
-        post_tag_csv_file.flush()
+# Number of rows processed at once.
+CHUNK_ROWS = 1 << 16
+
+
+def prepare_posts(questions_path, posts_csv_path=None, posts_npy_path=None):
+    with open(questions_path, 'r', newline='') as questions_file:
+        reader = csv.reader(questions_file)
+        next(reader)
+
+        writer = None
+        if posts_csv_path is not None:
+            posts_csv_file = open(posts_csv_path, 'w', newline='')
+            # We could use DictWriter, but it is slower.
+            writer = csv.writer(posts_csv_file)
+            writer.writerow(['Id', 'CreationDate'])
+        array_writer = None
+        if posts_npy_path is not None:
+            array_writer = interim.ArrayWriter(posts_npy_path, 2)
+
+        while True:
+            chunk = [row[:2] for row in itertools.islice(reader, CHUNK_ROWS)]
+            if not chunk:
+                break
+            if writer is not None:
+                writer.writerows(chunk)
+            if array_writer is not None:
+                post_ids = np.array([int(post_id) for post_id, _ in chunk], dtype=np.int64)
+                days = interim.dates_to_days([creation_date for _, creation_date in chunk])
+                array_writer.append(np.column_stack((post_ids, days)))
+
+        if writer is not None:
+            posts_csv_file.close()
+        if array_writer is not None:
+            array_writer.close()
+
+
+def get_post_id(line):
+    return line.split(b',', 1)[0]
+
+
+def split_question_tags(question_tags_path, cnt_parts):
+    """
+    Split `question_tags.csv` (without header) into at most `cnt_parts` byte ranges
+    of similar size. Each range starts with the first tag of some post.
+    """
+    size = os.path.getsize(question_tags_path)
+    with open(question_tags_path, 'rb') as question_tags_file:
+        question_tags_file.readline()
+        bounds = [question_tags_file.tell()]
+
+        for i in range(1, cnt_parts):
+            pos = max(size * i // cnt_parts, bounds[-1])
+            question_tags_file.seek(pos)
+            # Skip to the beginning of a line, and then to the beginning of a post.
+            question_tags_file.readline()
+            post_id = get_post_id(question_tags_file.readline())
+            while True:
+                line_start = question_tags_file.tell()
+                line = question_tags_file.readline()
+                if not line or get_post_id(line) != post_id:
+                    break
+            if line_start > bounds[-1] and line_start < size:
+                bounds.append(line_start)
+
+    return list(zip(bounds, bounds[1:] + [size]))
+
+
+def read_post_tags(question_tags_path, start, end, pairs_path):
+    """
+    Read pairs of post and tag from a byte range of `question_tags.csv`,
+    dropping repeated tags of a post.
+
+    Tags get local Id-s, in the order of appearance. Pairs of post Id and
+    local tag Id are written to `pairs_path` as int64.
+
+    Returns the list of tag names (indexed by local Id) and the number of pairs.
+    """
+    local_tag_ids = dict()
+    cnt_pairs = 0
+    cur_post_id = None
+    cur_post_tags = set()
+
+    with open(question_tags_path, 'rb') as question_tags_file, open(pairs_path, 'wb') as pairs_file:
+        question_tags_file.seek(start)
+        pos = start
+        while pos < end:
+            lines = []
+            for line in question_tags_file:
+                lines.append(line.decode('utf-8'))
+                pos += len(line)
+                if pos >= end or len(lines) >= CHUNK_ROWS:
+                    break
+            if not lines:
+                break
+
+            post_ids = []
+            tag_ids = []
+            for post_id, tag in csv.reader(lines):
+                if post_id != cur_post_id:
+                    cur_post_id = post_id
+                    cur_post_tags = set()
+                if tag in cur_post_tags:
+                    continue
+                cur_post_tags.add(tag)
+
+                tag_id = local_tag_ids.get(tag)
+                if tag_id is None:
+                    tag_id = local_tag_ids[tag] = len(local_tag_ids)
+                post_ids.append(int(post_id))
+                tag_ids.append(tag_id)
+
+            np.column_stack((np.array(post_ids, dtype=np.int64),
+                             np.array(tag_ids, dtype=np.int64))).tofile(pairs_file)
+            cnt_pairs += len(post_ids)
+
+    return list(local_tag_ids), cnt_pairs
+
+
+def write_post_tags(pairs_path, cnt_pairs, local_to_global, post_tag_csv_file, post_tag_array, offset):
+    """
+    Write pairs of post and local tag Id with global tag Id-s into
+    `post_tag_csv_file` and `post_tag_array` (starting at `offset`), when they are given.
+    """
+    if cnt_pairs == 0:
+        return
+    pairs = np.memmap(pairs_path, dtype=np.int64, mode='r', shape=(cnt_pairs, 2))
+    for chunk_start in range(0, cnt_pairs, CHUNK_ROWS):
+        chunk = pairs[chunk_start:chunk_start + CHUNK_ROWS]
+        post_ids = chunk[:, 0]
+        tag_ids = local_to_global[chunk[:, 1]]
+
+        if post_tag_csv_file is not None:
+            post_tag_csv_file.write(''.join('{},{}\r\n'.format(post_id, tag_id)
+                                            for post_id, tag_id in zip(post_ids.tolist(), tag_ids.tolist())))
+        if post_tag_array is not None:
+            rows = slice(offset + chunk_start, offset + chunk_start + len(chunk))
+            post_tag_array[rows, 0] = interim.to_interim_dtype(post_ids)
+            post_tag_array[rows, 1] = interim.to_interim_dtype(tag_ids)
+    del pairs
+
+
+def prepare_post_tags(question_tags_path, tags_path, post_tag_csv_path=None, post_tag_npy_path=None,
+                      workers=1, pool=None):
+    parts = split_question_tags(question_tags_path, workers)
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(tags_path))) as tmp_dir:
+        tasks = [(question_tags_path, start, end, os.path.join(tmp_dir, 'pairs_{}.bin'.format(i)))
+                 for i, (start, end) in enumerate(parts)]
+        if pool is not None:
+            results = pool.starmap(read_post_tags, tasks)
+        else:
+            results = [read_post_tags(*task) for task in tasks]
+
+        tags = sorted(set().union(*(local_tags for local_tags, _ in results)))
+        tag_to_id_mapping = dict()
+        with open(tags_path, 'w', newline='') as tags_csv_file:
+            writer = csv.writer(tags_csv_file)
+            writer.writerow(['Id', 'Tag'])
+            for i, tag in enumerate(tags, 1):
+                tag_to_id_mapping[tag] = i
+                writer.writerow([i, tag])
+
+        post_tag_csv_file = None
+        if post_tag_csv_path is not None:
+            post_tag_csv_file = open(post_tag_csv_path, 'w', newline='')
+            csv.writer(post_tag_csv_file).writerow(['PostId', 'TagId'])
+        post_tag_array = None
+        if post_tag_npy_path is not None:
+            post_tag_array = interim.create_array(post_tag_npy_path,
+                    sum(cnt_pairs for _, cnt_pairs in results), 2)
+
+        offset = 0
+        for (local_tags, cnt_pairs), (_, _, _, pairs_path) in zip(results, tasks):
+            local_to_global = np.array([tag_to_id_mapping[tag] for tag in local_tags], dtype=np.int64)
+            write_post_tags(pairs_path, cnt_pairs, local_to_global, post_tag_csv_file, post_tag_array, offset)
+            offset += cnt_pairs
+
+        if post_tag_csv_file is not None:
+            post_tag_csv_file.close()
+        if isinstance(post_tag_array, np.memmap):
+            post_tag_array.flush()
+        del post_tag_array
+
+
+def prepare(raw_data_dir, interim_data_dir, workers=1, formats=('npy',)):
+    """
+    Extract posts and tags, writing posts and pairs of post and tag
+    in each of `formats`: 'csv' or 'npy' (see `interim.py`).
+    """
+    questions_path = os.path.join(raw_data_dir, 'questions.csv')
+    question_tags_path = os.path.join(raw_data_dir, 'question_tags.csv')
+    tags_path = os.path.join(interim_data_dir, 'tags.csv')
+
+    posts_paths = (os.path.join(interim_data_dir, 'posts.csv') if 'csv' in formats else None,
+                   os.path.join(interim_data_dir, interim.POSTS_NPY) if 'npy' in formats else None)
+    post_tag_paths = (os.path.join(interim_data_dir, 'post_tag.csv') if 'csv' in formats else None,
+                      os.path.join(interim_data_dir, interim.POST_TAG_NPY) if 'npy' in formats else None)
+
+    if workers <= 1:
+        prepare_posts(questions_path, *posts_paths)
+        prepare_post_tags(question_tags_path, tags_path, *post_tag_paths)
+        return
+
+    with multiprocessing.Pool(workers) as pool:
+        posts_result = pool.apply_async(prepare_posts, (questions_path,) + posts_paths)
+        prepare_post_tags(question_tags_path, tags_path, *post_tag_paths, workers=workers, pool=pool)
+        posts_result.get()
+
 
+def main():
+    parser = argparse.ArgumentParser(description='Extract posts and tags from StackLite data.')
+    parser.add_argument('--workers', type=int, default=1,
+            help='number of processes reading the input (default: read in the main process)')
+    parser.add_argument('--format', choices=('npy', 'csv', 'both'), default='npy',
+            help='format of posts and pairs of post and tag (default: binary, see interim.py)')
+    parser.add_argument('--raw-data-dir', default=RAW_DATA_DIR)
+    parser.add_argument('--interim-data-dir', default=INTERIM_DATA_DIR)
+    args = parser.parse_args()
 
+    formats = ('npy', 'csv') if args.format == 'both' else (args.format,)
+    prepare(args.raw_data_dir, args.interim_data_dir, args.workers, formats)
 
 
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 '''
 A simple Python wrapper for the bh_tsne binary that makes it easier to use it
@@ -19,6 +19,37 @@ The output will not be normalised, maybe the below one-liner is of interest?:
         d = numpy.loadtxt(stdin); d -= d.min(axis=0); d /= d.max(axis=0);
         numpy.savetxt(stdout, d, fmt="%.8f", delimiter="\t")'
 
+Nearest neighbour matrix mode:
+
+    The `bh_tsne` binary built in this directory does not take samples, but
+    a nearest neighbour matrix (`nn_matrix_*.txt`, see `compute_nearest_neighbours.cpp`)
+    after a text header on stdin, and prints the embedding between
+    `######START TSV` and `######END TSV` lines on stdout. `run.sh` does the same.
+    With `--nn-matrix`, the matrix is streamed to the binary as is, and the
+    output of the binary can be saved with `--raw-output`
+    (`get_tiling.py` reads it):
+
+    > ./bhtsne.py --nn-matrix nn_matrix_example.txt --raw-output raw_tsne_output_example.txt
+
+    Defaults of this mode are the parameters of `run.sh`.
+
+    Progress of the run (time of computing similarities, KL divergence
+    and timings every 50 iterations) is parsed as it is printed. Use `BhTsneRun`
+    to iterate over progress events, `progress` callback of `run_bh_tsne_nn`,
+    or `--progress-log` to write them as JSON lines.
+
+    A run can start from the map of an earlier date instead of a random
+    initialization, so that maps of both dates look alike and fewer
+    iterations are needed. Tags are matched by name (`id_to_additional_info_*.csv`
+    of both dates), see `get_initial_solution`:
+
+    > ./bhtsne.py --nn-matrix nn_matrix_2012-01-01.txt --raw-output raw_tsne_output_2012-01-01.txt \
+        --info id_to_additional_info_2012-01-01.csv \
+        --init-from raw_tsne_output_2011-01-01.txt --previous-info id_to_additional_info_2011-01-01.csv
+
+Samples mode talks to the original `bh_tsne` binary through `data.dat` and
+`result.dat` files. They are written and read with NumPy as a whole.
+
 Authors:     Pontus Stenetorp    <pontus stenetorp se>
              Philippe Remy       <github: philipperemy>
 Version:    2016-03-08
@@ -39,23 +70,24 @@ Version:    2016-03-08
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 from argparse import ArgumentParser, FileType
+from io import BytesIO
 from os.path import abspath, dirname, isfile, join as path_join
-from shutil import rmtree
-from struct import calcsize, pack, unpack
-from subprocess import Popen
+from shutil import copyfileobj
+from struct import pack
+from subprocess import Popen, PIPE, DEVNULL
 from sys import stderr, stdin, stdout
-from tempfile import mkdtemp
+from tempfile import TemporaryDirectory
+from threading import Thread
 from platform import system
-from os import devnull
+from time import monotonic
+import csv
+import json
+import re
 import numpy as np
-import os, sys
 
 ### Constants
 IS_WINDOWS = True if system() == 'Windows' else False
 BH_TSNE_BIN_PATH = path_join(dirname(__file__), 'windows', 'bh_tsne.exe') if IS_WINDOWS else path_join(dirname(__file__), 'bh_tsne')
-assert isfile(BH_TSNE_BIN_PATH), ('Unable to find the bh_tsne binary in the '
-    'same directory as this script, have you forgotten to compile it?: {}'
-    ).format(BH_TSNE_BIN_PATH)
 # Default hyper-parameter values from van der Maaten (2014)
 # https://lvdmaaten.github.io/publications/papers/JMLR_2014.pdf (Experimental Setup, page 13)
 DEFAULT_NO_DIMS = 2
@@ -65,6 +97,30 @@ DEFAULT_THETA = 0.5
 EMPTY_SEED = -1
 DEFAULT_USE_PCA = True
 DEFAULT_MAX_ITERATIONS = 1000
+# Default hyper-parameter values for a nearest neighbour matrix, as in `run.sh`.
+NN_DEFAULT_PERPLEXITY = 30
+NN_DEFAULT_THETA = 0.3
+NN_DEFAULT_MAX_ITERATIONS = 10000
+# A run which starts from an earlier map only has to adjust it.
+NN_DEFAULT_WARM_MAX_ITERATIONS = 1000
+# Number of nearest neighbours of a new tag, among which it is placed.
+INIT_NEIGHBOURS = 10
+# Spread of new tags around the mean of their neighbours, relative to the spread of the map.
+INIT_JITTER = 1e-3
+# Lines around the embedding in the output of `bh_tsne` for a nearest neighbour matrix.
+TSV_START = b'######START TSV'
+TSV_END = b'######END TSV'
+# Size of blocks in which the nearest neighbour matrix is read.
+CHUNK_SIZE = 1 << 20
+# Progress lines of `bh_tsne`, see `parse_progress_line`.
+PROGRESS_RES = (
+    ('start', re.compile(rb'^Read the (?P<cnt_points>\d+) x \d+ data matrix')),
+    ('similarities', re.compile(rb'^Input similarities computed in (?P<seconds>\S+) seconds'
+                                rb'(?: \(sparsity = (?P<sparsity>[^)]+)\))?')),
+    ('iteration', re.compile(rb'^Iteration (?P<iteration>\d+): error is (?P<error>\S+)'
+                             rb'(?: \(50 iterations in (?P<seconds>\S+) seconds\))?')),
+    ('fitted', re.compile(rb'^Fitting performed in (?P<seconds>\S+) seconds')),
+)
 
 ###
 
@@ -73,24 +129,38 @@ def _argparse():
     argparse.add_argument('-d', '--no_dims', type=int,
                           default=DEFAULT_NO_DIMS)
     argparse.add_argument('-p', '--perplexity', type=float,
-            default=DEFAULT_PERPLEXITY)
+            help='default: {} ({} with --nn-matrix)'.format(DEFAULT_PERPLEXITY, NN_DEFAULT_PERPLEXITY))
     # 0.0 for theta is equivalent to vanilla t-SNE
-    argparse.add_argument('-t', '--theta', type=float, default=DEFAULT_THETA)
+    argparse.add_argument('-t', '--theta', type=float,
+            help='default: {} ({} with --nn-matrix)'.format(DEFAULT_THETA, NN_DEFAULT_THETA))
     argparse.add_argument('-r', '--randseed', type=int, default=EMPTY_SEED)
     argparse.add_argument('-n', '--initial_dims', type=int, default=INITIAL_DIMENSIONS)
     argparse.add_argument('-v', '--verbose', action='store_true')
     argparse.add_argument('-i', '--input', type=FileType('r'), default=stdin)
     argparse.add_argument('-o', '--output', type=FileType('w'),
-            default=stdout)
+            help='default: stdout, unless --raw-output is given')
     argparse.add_argument('--use_pca', action='store_true')
     argparse.add_argument('--no_pca', dest='use_pca', action='store_false')
     argparse.set_defaults(use_pca=DEFAULT_USE_PCA)
-    argparse.add_argument('-m', '--max_iter', type=int, default=DEFAULT_MAX_ITERATIONS)
+    argparse.add_argument('-m', '--max_iter', type=int,
+            help='default: {} ({} with --nn-matrix)'.format(DEFAULT_MAX_ITERATIONS, NN_DEFAULT_MAX_ITERATIONS))
+    argparse.add_argument('--nn-matrix', help='run on a nearest neighbour matrix instead of samples')
+    argparse.add_argument('--raw-output', help='save output of bh_tsne for a nearest neighbour matrix here')
+    argparse.add_argument('--progress-log', help='write progress of bh_tsne for a nearest neighbour matrix '
+                          'here, as JSON lines')
+    argparse.add_argument('--init-from', help='start from this earlier output of bh_tsne for a nearest '
+                          'neighbour matrix (raw or tsv), default of --max_iter becomes {}'.format(
+                              NN_DEFAULT_WARM_MAX_ITERATIONS))
+    argparse.add_argument('--previous-info', help='tag names of --init-from (id_to_additional_info_*.csv)')
+    argparse.add_argument('--info', help='tag names of --nn-matrix (id_to_additional_info_*.csv)')
     return argparse
 
 
-def _read_unpack(fmt, fh):
-    return unpack(fmt, fh.read(calcsize(fmt)))
+def _check_bin():
+    assert isfile(BH_TSNE_BIN_PATH), ('Unable to find the bh_tsne binary in the '
+        'same directory as this script, have you forgotten to compile it?: {}'
+        ).format(BH_TSNE_BIN_PATH)
+
 
 def init_bh_tsne(samples, workdir, no_dims=DEFAULT_NO_DIMS, initial_dims=INITIAL_DIMENSIONS, perplexity=DEFAULT_PERPLEXITY,
             theta=DEFAULT_THETA, randseed=EMPTY_SEED, verbose=False, use_pca=DEFAULT_USE_PCA, max_iter=DEFAULT_MAX_ITERATIONS):
@@ -110,10 +180,8 @@ def init_bh_tsne(samples, workdir, no_dims=DEFAULT_NO_DIMS, initial_dims=INITIAL
         eig_vec = eig_vec[:, :initial_dims]
         samples = np.dot(samples, eig_vec)
 
-    # Assume that the dimensionality of the first sample is representative for
-    #   the whole batch
-    sample_dim = len(samples[0])
-    sample_count = len(samples)
+    samples = np.ascontiguousarray(samples, dtype='=f8')
+    sample_count, sample_dim = samples.shape
 
     # Note: The binary format used by bh_tsne is roughly the same as for
     #   vanilla tsne
@@ -121,63 +189,45 @@ def init_bh_tsne(samples, workdir, no_dims=DEFAULT_NO_DIMS, initial_dims=INITIAL
         # Write the bh_tsne header
         data_file.write(pack('iiddii', sample_count, sample_dim, theta, perplexity, no_dims, max_iter))
         # Then write the data
-        for sample in samples:
-            data_file.write(pack('{}d'.format(len(sample)), *sample))
+        samples.tofile(data_file)
         # Write random seed if specified
         if randseed != EMPTY_SEED:
             data_file.write(pack('i', randseed))
 
-def load_data(input_file):
-    # Read the data, with some sanity checking
-    samples = []
-    for sample_line_num, sample_line in enumerate((l.rstrip('\n')
-            for l in input_file), start=1):
-        sample_data = sample_line.split('\t')
-        try:
-            assert len(sample_data) == dims, ('Input line #{} of '
-                    'dimensionality {} although we have previously observed '
-                    'lines with dimensionality {}, possible data error or is '
-                    'the data sparsely encoded?'
-                    ).format(sample_line_num, len(sample_data), dims)
-        except NameError:
-            # First line, record the dimensionality
-            dims = len(sample_data)
-        samples.append([float(e) for e in sample_data])
 
-    return np.asarray(samples, dtype='float64')
+def load_data(input_file):
+    # Read the data, with some sanity checking: lines of different
+    #   dimensionality make `loadtxt` fail.
+    return np.loadtxt(input_file, delimiter='\t', dtype='float64', ndmin=2)
 
 
 def bh_tsne(workdir, verbose=False):
 
     # Call bh_tsne and let it do its thing
-    with open(devnull, 'w') as dev_null:
-        bh_tsne_p = Popen((abspath(BH_TSNE_BIN_PATH), ), cwd=workdir,
-                # bh_tsne is very noisy on stdout, tell it to use stderr
-                #   if it is to print any output
-                stdout=stderr if verbose else dev_null)
-        bh_tsne_p.wait()
-        assert not bh_tsne_p.returncode, ('ERROR: Call to bh_tsne exited '
-                'with a non-zero return code exit status, please ' +
-                ('enable verbose mode and ' if not verbose else '') +
-                'refer to the bh_tsne output for further details')
+    bh_tsne_p = Popen((abspath(BH_TSNE_BIN_PATH), ), cwd=workdir,
+            # bh_tsne is very noisy on stdout, tell it to use stderr
+            #   if it is to print any output
+            stdout=stderr if verbose else DEVNULL)
+    bh_tsne_p.wait()
+    assert not bh_tsne_p.returncode, ('ERROR: Call to bh_tsne exited '
+            'with a non-zero return code exit status, please ' +
+            ('enable verbose mode and ' if not verbose else '') +
+            'refer to the bh_tsne output for further details')
 
     # Read and pass on the results
     with open(path_join(workdir, 'result.dat'), 'rb') as output_file:
         # The first two integers are just the number of samples and the
         #   dimensionality
-        result_samples, result_dims = _read_unpack('ii', output_file)
+        result_samples, result_dims = np.fromfile(output_file, dtype='=i4', count=2)
         # Collect the results, but they may be out of order
-        results = [_read_unpack('{}d'.format(result_dims), output_file)
-            for _ in range(result_samples)]
+        results = np.fromfile(output_file, dtype='=f8', count=result_samples * result_dims)
+        results = results.reshape(result_samples, result_dims)
         # Now collect the landmark data so that we can return the data in
         #   the order it arrived
-        results = [(_read_unpack('i', output_file), e) for e in results]
-        # Put the results in order and yield it
-        results.sort()
-        for _, result in results:
-            yield result
+        landmarks = np.fromfile(output_file, dtype='=i4', count=result_samples)
         # The last piece of data is the cost for each sample, we ignore it
-        #read_unpack('{}d'.format(sample_count), output_file)
+    return results[np.argsort(landmarks, kind='mergesort')]
+
 
 def run_bh_tsne(data, no_dims=2, perplexity=50, theta=0.5, randseed=-1, verbose=False,initial_dims=50, use_pca=True, max_iter=1000):
     '''
@@ -196,40 +246,375 @@ def run_bh_tsne(data, no_dims=2, perplexity=50, theta=0.5, randseed=-1, verbose=
     use_pca: boolean
     max_iter: int
     '''
+    _check_bin()
+    if hasattr(data, 'read'):
+        data = load_data(data)
 
     # bh_tsne works with fixed input and output paths, give it a temporary
     #   directory to work in so we don't clutter the filesystem
-    tmp_dir_path = mkdtemp()
-
-    # Load data in forked process to free memory for actual bh_tsne calculation
-    child_pid = os.fork()
-    if child_pid == 0:
-        if isinstance(data, file):
-            data = load_data(data)
+    with TemporaryDirectory() as tmp_dir_path:
         init_bh_tsne(data, tmp_dir_path, no_dims=no_dims, perplexity=perplexity, theta=theta, randseed=randseed,verbose=verbose, initial_dims=initial_dims, use_pca=use_pca, max_iter=max_iter)
-        sys.exit(0)
-    else:
-        os.waitpid(child_pid, 0)
-        res = []
-        for result in bh_tsne(tmp_dir_path, verbose):
-            sample_res = []
-            for r in result:
-                sample_res.append(r)
-            res.append(sample_res)
-        rmtree(tmp_dir_path)
-        return np.asarray(res, dtype='float64')
+        # Samples are not needed while bh_tsne runs.
+        del data
+        return bh_tsne(tmp_dir_path, verbose)
+
+
+def count_lines(path):
+    cnt_lines = 0
+    with open(path, 'rb') as in_file:
+        while True:
+            data = in_file.read(CHUNK_SIZE)
+            if not data:
+                break
+            cnt_lines += data.count(b'\n')
+    return cnt_lines
+
+
+def parse_tsv(table):
+    '''
+    Parse the embedding printed by `bh_tsne`: a header and rows of tab-separated numbers.
+    '''
+    header, _, rows = table.strip().partition(b'\n')
+    no_dims = len(header.split())
+    rows = rows.strip()
+    cnt_rows = rows.count(b'\n') + 1 if rows else 0
+    values = np.fromstring(rows, dtype='float64', sep=' ') if rows else np.empty(0)
+    assert len(values) == cnt_rows * no_dims, 'bh_tsne printed a malformed embedding'
+    return values.reshape(cnt_rows, no_dims)
+
+
+def _feed_nn_matrix(bh_tsne_p, header, nn_matrix_path):
+    try:
+        with open(nn_matrix_path, 'rb') as nn_matrix_file:
+            bh_tsne_p.stdin.write(header)
+            copyfileobj(nn_matrix_file, bh_tsne_p.stdin, CHUNK_SIZE)
+        bh_tsne_p.stdin.close()
+    except BrokenPipeError:
+        # bh_tsne exited early, its return code tells why.
+        pass
+
+
+class BhTsneRun:
+    '''
+    A run of `bh_tsne` on a nearest neighbour matrix (see `run_bh_tsne_nn`),
+    which reports its progress while it goes.
+
+    Iterating over the run yields progress events (see `parse_progress_line`)
+    as `bh_tsne` prints them, each with `elapsed` wall time in seconds.
+    Iteration events also have `eta`: estimated seconds to the end.
+    The last event is `finished`. After it, `get_embedding()` returns the result.
+
+    Events are also written to `progress_log_path` as JSON lines, if it is given.
+    `stop()` kills `bh_tsne`, e.g. from another thread when the run is stalled:
+    see `get_seconds_since_progress()`.
+
+    `initial_solution` (numpy.array, one point per row of the matrix) replaces
+    the random initialization and the early exaggeration, see `get_initial_solution`.
+    '''
+
+    def __init__(self, nn_matrix_path, no_dims=DEFAULT_NO_DIMS, perplexity=NN_DEFAULT_PERPLEXITY,
+                 theta=NN_DEFAULT_THETA, max_iter=NN_DEFAULT_MAX_ITERATIONS, randseed=EMPTY_SEED,
+                 raw_output_path=None, verbose=False, workdir=None, progress_log_path=None,
+                 initial_solution=None):
+        _check_bin()
+        self.cnt_points = count_lines(nn_matrix_path)
+        self.max_iter = max_iter
+        self.verbose = verbose
+        # Input dimensionality is not used: distances are given.
+        header = '{:d} {:d} {:f} {:g} {:d} {:d}'.format(self.cnt_points, 0, theta, perplexity, no_dims, max_iter)
+        if randseed != EMPTY_SEED or initial_solution is not None:
+            header += ' {:d}'.format(randseed)
+        header = header.encode()
+        if initial_solution is not None:
+            assert initial_solution.shape == (self.cnt_points, no_dims), ('The initial solution has shape {}, '
+                    'but the matrix has {} rows').format(initial_solution.shape, self.cnt_points)
+            # The solution follows the header, one point per line.
+            solution = BytesIO()
+            np.savetxt(solution, initial_solution, fmt='%.17g', delimiter='\t')
+            header += b' 1\n' + solution.getvalue()
+        else:
+            header += b'\n'
+
+        self.raw_output_path = raw_output_path
+        self.progress_log_path = progress_log_path
+        self.embedding = None
+        self.returncode = None
+
+        self.start_time = monotonic()
+        self.learning_start_time = None
+        self.last_progress_time = self.start_time
+        self.process = Popen((abspath(BH_TSNE_BIN_PATH), ), cwd=workdir, stdin=PIPE, stdout=PIPE)
+        self.feeder = Thread(target=_feed_nn_matrix, args=(self.process, header, nn_matrix_path))
+        self.feeder.start()
+
+
+    def __iter__(self):
+        raw_output_file = open(self.raw_output_path, 'wb') if self.raw_output_path is not None else None
+        progress_log_file = open(self.progress_log_path, 'w') if self.progress_log_path is not None else None
+        table = []
+        in_table = False
+        try:
+            for line in self.process.stdout:
+                if raw_output_file is not None:
+                    raw_output_file.write(line)
+                if self.verbose:
+                    stderr.buffer.write(line)
+
+                if line.startswith(TSV_END):
+                    in_table = False
+                if in_table:
+                    table.append(line)
+                if line.startswith(TSV_START):
+                    in_table = True
+
+                event = parse_progress_line(line)
+                if event is not None:
+                    yield self._report(event, progress_log_file)
+
+            self.feeder.join()
+            self.returncode = self.process.wait()
+            if not self.returncode:
+                self.embedding = parse_tsv(b''.join(table))
+            yield self._report({'event': 'finished', 'returncode': self.returncode}, progress_log_file)
+        finally:
+            if self.returncode is None:
+                # The caller stopped iterating before the end.
+                self.stop()
+                self.returncode = self.process.wait()
+            self.process.stdout.close()
+            if raw_output_file is not None:
+                raw_output_file.close()
+            if progress_log_file is not None:
+                progress_log_file.close()
+
+
+    def _report(self, event, progress_log_file):
+        now = monotonic()
+        self.last_progress_time = now
+        event['elapsed'] = now - self.start_time
+        if event['event'] == 'similarities':
+            self.learning_start_time = now
+        elif event['event'] == 'iteration' and self.learning_start_time is not None and event['iteration'] > 0:
+            speed = event['iteration'] / (now - self.learning_start_time)
+            event['eta'] = max(0, self.max_iter - event['iteration']) / speed if speed > 0 else None
+
+        if progress_log_file is not None:
+            progress_log_file.write(json.dumps(event, sort_keys=True) + '\n')
+            progress_log_file.flush()
+        return event
+
+
+    def get_seconds_since_progress(self):
+        return monotonic() - self.last_progress_time
+
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.kill()
+
+
+    def get_embedding(self):
+        '''
+        Wait for the end of the run and return the embedding as numpy.array,
+        one point per row of the matrix.
+        '''
+        if self.returncode is None:
+            for _ in self:
+                pass
+        assert not self.returncode, ('ERROR: Call to bh_tsne exited '
+                'with a non-zero return code exit status, please ' +
+                ('enable verbose mode and ' if not self.verbose else '') +
+                'refer to the bh_tsne output for further details')
+        assert len(self.embedding) == self.cnt_points, ('bh_tsne returned {} points for {} rows of the matrix'
+                ).format(len(self.embedding), self.cnt_points)
+        return self.embedding
+
+
+def run_bh_tsne_nn(nn_matrix_path, no_dims=DEFAULT_NO_DIMS, perplexity=NN_DEFAULT_PERPLEXITY, theta=NN_DEFAULT_THETA,
+                   max_iter=NN_DEFAULT_MAX_ITERATIONS, randseed=EMPTY_SEED, raw_output_path=None, verbose=False,
+                   workdir=None, progress=None, progress_log_path=None, initial_solution=None):
+    '''
+    Run TSNE on a nearest neighbour matrix, one row per point, as `run.sh` does.
+
+    The matrix is streamed to `bh_tsne` without parsing. Output of `bh_tsne`
+    is saved to `raw_output_path`, if it is given, and printed to stderr
+    in verbose mode. `bh_tsne` is run in `workdir`, if it is given.
+
+    `progress` is called with every progress event, see `BhTsneRun`.
+    The run starts from `initial_solution`, if it is given.
+
+    Returns the embedding as numpy.array, one point per row of the matrix.
+    '''
+    run = BhTsneRun(nn_matrix_path, no_dims, perplexity, theta, max_iter, randseed,
+                    raw_output_path, verbose, workdir, progress_log_path, initial_solution)
+    for event in run:
+        if progress is not None:
+            progress(event)
+    return run.get_embedding()
+
+
+def parse_progress_line(line):
+    '''
+    Parse a line printed by `bh_tsne` into a progress event, or return None.
+
+    Events are dicts with `event` field:
+        start - the matrix is being read: `cnt_points`;
+        similarities - input similarities are computed: `seconds`, `sparsity`;
+        iteration - KL divergence `error` after `iteration`, and `seconds`
+            (CPU time) taken by the last 50 iterations;
+        fitted - all iterations are done in `seconds` (CPU time).
+    '''
+    for event_name, regex in PROGRESS_RES:
+        match = regex.match(line)
+        if match is None:
+            continue
+        event = {'event': event_name}
+        for field, value in match.groupdict().items():
+            if value is not None:
+                event[field] = int(value) if field in ('iteration', 'cnt_points') else float(value)
+        return event
+    return None
+
+
+def get_final_error(raw_output_path):
+    '''
+    Return KL divergence reported by `bh_tsne` at its last iteration, or None.
+    '''
+    error = None
+    with open(raw_output_path, 'rb') as raw_output_file:
+        for line in raw_output_file:
+            event = parse_progress_line(line)
+            if event is not None and event['event'] == 'iteration':
+                error = event['error']
+    return error
+
+
+def read_embedding(path):
+    '''
+    Read an embedding saved by `--raw-output` (the whole output of `bh_tsne`),
+    or the table alone (`tsne_output_*.tsv`).
+    '''
+    with open(path, 'rb') as in_file:
+        data = in_file.read()
+    start = data.find(TSV_START)
+    if start != -1:
+        start = data.index(b'\n', start) + 1
+        end = data.find(TSV_END, start)
+        data = data[start:end if end != -1 else len(data)]
+    return parse_tsv(data)
+
+
+def read_names(info_path):
+    '''
+    Read tag names from `id_to_additional_info_*.csv`, one per row of the matrix.
+    '''
+    with open(info_path, 'r', newline='') as info_file:
+        reader = csv.reader(info_file)
+        name_pos = next(reader).index('name')
+        return [row[name_pos] for row in reader]
+
+
+def read_neighbours(nn_matrix_path, rows, cnt_neighbours=INIT_NEIGHBOURS):
+    '''
+    Read the nearest neighbours of `rows` of the matrix, closest first.
+
+    Returns a dict from a row to numpy.array of at most `cnt_neighbours` rows.
+    '''
+    rows = set(rows)
+    neighbours = dict()
+    with open(nn_matrix_path, 'rb') as nn_matrix_file:
+        for line in nn_matrix_file:
+            index, _, row = line.partition(b':')
+            index = int(index)
+            if index not in rows:
+                continue
+            values = np.fromstring(row.replace(b',', b' '), dtype='float64', sep=' ')
+            neighbours[index] = values[0::2][:cnt_neighbours].astype(np.int64)
+    return neighbours
+
+
+def get_initial_solution(nn_matrix_path, names, previous_embedding, previous_names, randseed=EMPTY_SEED):
+    '''
+    Make an initial solution for a nearest neighbour matrix from an earlier map.
+
+    `names` are tag names of rows of the matrix, `previous_names` are
+    tag names of points of `previous_embedding`. Tags found in the earlier map
+    keep their coordinates. Other tags are placed at the mean of their
+    nearest neighbours which are already placed (with a little jitter, so that
+    they do not coincide), repeatedly, until no more tags can be placed.
+    The rest are scattered randomly over the map.
+
+    Returns the solution (numpy.array, one point per row) and the number of matched tags.
+    '''
+    assert len(previous_names) == len(previous_embedding), ('{} tag names for an embedding of {} points'
+            ).format(len(previous_names), len(previous_embedding))
+    random_state = np.random.RandomState(randseed if randseed != EMPTY_SEED else None)
+    previous_index = {name: i for i, name in enumerate(previous_names)}
+    spread = previous_embedding.std(axis=0) if len(previous_embedding) else np.ones(previous_embedding.shape[1])
+
+    solution = np.zeros((len(names), previous_embedding.shape[1]))
+    placed = np.zeros(len(names), dtype=bool)
+    for i, name in enumerate(names):
+        j = previous_index.get(name)
+        if j is not None:
+            solution[i] = previous_embedding[j]
+            placed[i] = True
+    cnt_matched = int(placed.sum())
+
+    unplaced = np.flatnonzero(~placed)
+    neighbours = read_neighbours(nn_matrix_path, unplaced)
+    while len(unplaced):
+        # Tags are placed by neighbours placed in earlier passes only, so the order of rows does not matter.
+        positions = dict()
+        for i in unplaced:
+            known = neighbours.get(i, np.empty(0, dtype=np.int64))
+            known = known[placed[known]]
+            if len(known):
+                positions[i] = solution[known].mean(axis=0)
+        if not positions:
+            break
+        for i, position in positions.items():
+            solution[i] = position + random_state.randn(len(position)) * spread * INIT_JITTER
+            placed[i] = True
+        unplaced = np.flatnonzero(~placed)
+
+    solution[unplaced] = random_state.randn(len(unplaced), solution.shape[1]) * spread
+    return solution - solution.mean(axis=0), cnt_matched
 
 
 def main(args):
     argp = _argparse().parse_args(args[1:])
-    
-    for result in run_bh_tsne(argp.input, no_dims=argp.no_dims, perplexity=argp.perplexity, theta=argp.theta, randseed=argp.randseed,
-            verbose=argp.verbose, initial_dims=argp.initial_dims, use_pca=argp.use_pca, max_iter=argp.max_iter):
-        fmt = ''
-        for i in range(1, len(result)):
-            fmt = fmt + '{}\t'
-        fmt = fmt + '{}\n'
-        argp.output.write(fmt.format(*result))
+
+    if argp.nn_matrix is not None:
+        initial_solution = None
+        max_iter = NN_DEFAULT_MAX_ITERATIONS
+        if argp.init_from is not None:
+            if argp.info is None or argp.previous_info is None:
+                _argparse().error('--init-from needs --info and --previous-info')
+            initial_solution, cnt_matched = get_initial_solution(argp.nn_matrix, read_names(argp.info),
+                    read_embedding(argp.init_from), read_names(argp.previous_info), argp.randseed)
+            print('{} of {} tags are found in {}'.format(cnt_matched, len(initial_solution), argp.init_from),
+                  file=stderr)
+            max_iter = NN_DEFAULT_WARM_MAX_ITERATIONS
+        results = run_bh_tsne_nn(argp.nn_matrix, no_dims=argp.no_dims,
+                perplexity=argp.perplexity if argp.perplexity is not None else NN_DEFAULT_PERPLEXITY,
+                theta=argp.theta if argp.theta is not None else NN_DEFAULT_THETA,
+                max_iter=argp.max_iter if argp.max_iter is not None else max_iter,
+                randseed=argp.randseed, raw_output_path=argp.raw_output, verbose=argp.verbose,
+                progress_log_path=argp.progress_log, initial_solution=initial_solution)
+    else:
+        results = run_bh_tsne(argp.input, no_dims=argp.no_dims,
+                perplexity=argp.perplexity if argp.perplexity is not None else DEFAULT_PERPLEXITY,
+                theta=argp.theta if argp.theta is not None else DEFAULT_THETA,
+                randseed=argp.randseed, verbose=argp.verbose, initial_dims=argp.initial_dims,
+                use_pca=argp.use_pca,
+                max_iter=argp.max_iter if argp.max_iter is not None else DEFAULT_MAX_ITERATIONS)
+
+    output = argp.output
+    if output is None and argp.raw_output is None:
+        output = stdout
+    if output is not None:
+        output.write(''.join('\t'.join(map(str, result)) + '\n' for result in results.tolist()))
 
 if __name__ == '__main__':
     from sys import argv
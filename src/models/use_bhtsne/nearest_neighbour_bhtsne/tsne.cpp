@@ -97,9 +97,12 @@ void TSNE::run(double* X, int N, int D, double* Y, int no_dims, double perplexit
     for(int i = 0; i < row_P[N]; i++) val_P[i] /= sum_P;
     end = clock();
 
-    // Lie about the P-values
-    if(exact) { for(int i = 0; i < N * N; i++)        P[i] *= 12.0; }
-    else {      for(int i = 0; i < row_P[N]; i++) val_P[i] *= 12.0; }
+    // Lie about the P-values (early exaggeration is skipped if stop_lying_iter is 0)
+    bool lying = stop_lying_iter > 0;
+    if(lying) {
+        if(exact) { for(int i = 0; i < N * N; i++)        P[i] *= 12.0; }
+        else {      for(int i = 0; i < row_P[N]; i++) val_P[i] *= 12.0; }
+    }
 
 	// Initialize solution (randomly)
   if (skip_random_init != true) {
@@ -130,7 +133,7 @@ void TSNE::run(double* X, int N, int D, double* Y, int no_dims, double perplexit
 		zeroMean(Y, N, no_dims);
 
         // Stop lying about the P-values after a while, and switch momentum
-        if(iter == stop_lying_iter) {
+        if(lying && iter == stop_lying_iter) {
             if(exact) { for(int i = 0; i < N * N; i++)        P[i] /= 12.0; }
             else      { for(int i = 0; i < row_P[N]; i++) val_P[i] /= 12.0; }
         }
@@ -598,15 +601,38 @@ double TSNE::randn() {
 
 // Function that loads data from a t-SNE file
 // Note: this function does a malloc that should be freed elsewhere
-bool TSNE::load_data(double** data, int* n, int* d, int* no_dims, double* theta, double* perplexity, int* rand_seed, int* max_iter) {
+bool TSNE::load_data(double** data, int* n, int* d, int* no_dims, double* theta, double* perplexity, int* rand_seed, int* max_iter,
+                     bool* has_initial_solution) {
 
 	// Open file, read first 2 integers, allocate memory, and read the data
-        cin >> *n >> *d >> *theta >> *perplexity >> *no_dims >> *max_iter;
-        cin.ignore(1); // erase the \n after header.
+        // The header is a single line. A random seed may follow the maximum number of iterations,
+        // and a flag (0 or 1) telling that an initial solution follows the header may follow the seed.
+        string header;
+        getline(cin, header);
+        istringstream header_inp(header);
+        header_inp >> *n >> *d >> *theta >> *perplexity >> *no_dims >> *max_iter;
+        if (!(header_inp >> *rand_seed)) *rand_seed = -1;
+        int initial_solution_flag = 0;
+        if (!(header_inp >> initial_solution_flag)) initial_solution_flag = 0;
+        *has_initial_solution = initial_solution_flag != 0;
 	printf("Read the %i x %i data matrix successfully!\n", *n, *d);
 	return true;
 }
 
+// Function that reads an initial solution: n lines of no_dims numbers, which follow the header
+bool TSNE::load_initial_solution(double* Y, int n, int no_dims) {
+        string row;
+        for (int i = 0; i < n; i++) {
+            if (!getline(cin, row)) return false;
+            istringstream inp(row);
+            for (int d = 0; d < no_dims; d++) {
+                if (!(inp >> Y[i * no_dims + d])) return false;
+            }
+        }
+	printf("Read the initial solution for %i points successfully!\n", n);
+        return true;
+}
+
 void TSNE::save_data(double* data, int* landmarks, double* costs, int n, int d) {
 
         cout << "######START TSV" << endl;
@@ -636,10 +662,11 @@ int main() {
 	double perc_landmarks;
 	double perplexity, theta, *data;
     int rand_seed = -1;
+    bool has_initial_solution = false;
     TSNE* tsne = new TSNE();
 
     // Read the parameters and the dataset
-	if(tsne->load_data(&data, &origN, &D, &no_dims, &theta, &perplexity, &rand_seed, &max_iter)) {
+	if(tsne->load_data(&data, &origN, &D, &no_dims, &theta, &perplexity, &rand_seed, &max_iter, &has_initial_solution)) {
 
             cout << "Loaded data" << endl;
             cout << origN << " " << D << " " << theta << " " << perplexity << " " << no_dims << " " << max_iter << endl;
@@ -650,7 +677,12 @@ int main() {
 		double* Y = (double*) malloc(N * no_dims * sizeof(double));
 		double* costs = (double*) calloc(N, sizeof(double));
         if(Y == NULL || costs == NULL) { printf("Memory allocation failed!\n"); exit(1); }
-		tsne->run(data, N, D, Y, no_dims, perplexity, theta, rand_seed, false, max_iter);
+        if(has_initial_solution) {
+            if(!tsne->load_initial_solution(Y, N, no_dims)) { printf("Malformed initial solution!\n"); exit(1); }
+            // The solution is already laid out: no early exaggeration, and final momentum at once.
+            tsne->run(data, N, D, Y, no_dims, perplexity, theta, rand_seed, true, max_iter, 0, 0);
+        }
+        else tsne->run(data, N, D, Y, no_dims, perplexity, theta, rand_seed, false, max_iter);
 
 		// Save the results
 		tsne->save_data(Y, landmarks, costs, N, no_dims);
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import itertools
+import tempfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nearest_neighbour_bhtsne'))
+
+import numpy as np
+
+import bhtsne
+
+'''
+Run `bh_tsne` on a nearest neighbour matrix for a grid of hyperparameters,
+to choose between quality of the map and the time it takes.
+
+Every combination of perplexity, theta and random seed is run as a separate
+`bh_tsne` process (`bh_tsne` uses one core), at most `--jobs` at once.
+Each run works in its own directory inside `--cache-dir`. When it finishes,
+the directory is renamed to a key: a hash of the matrix, of the `bh_tsne`
+binary and of the parameters. It contains:
+    raw_tsne_output.txt - output of `bh_tsne`, which `get_tiling.py` reads;
+    progress.jsonl - progress events of the run, see `bhtsne.BhTsneRun`;
+    embedding.npy - coordinates of points;
+    result.json - parameters, wall time and final KL divergence.
+Runs which are already in the cache are not repeated. While a run goes,
+its `progress.jsonl` is in a directory named `.<key>.*`.
+
+Wall time is measured while other runs of the sweep work as well, so
+compare runs made with the same `--jobs`.
+
+Options:
+    --perplexity, --theta, --seed - values of the grid.
+    --max-iter, --no-dims - same for all runs.
+    --jobs N - number of concurrent runs (default: number of CPUs).
+    --stall-timeout SECONDS - stop a run which did not report progress for so long.
+    --summary PATH - also save results of all runs as a JSON list.
+
+Example usage:
+    python3 sweep_bhtsne.py ../../../data/interim/nn_matrix_example.txt \
+        --perplexity 20 30 50 --theta 0.3 0.5 --seed 1 2 3 --max-iter 2000 --jobs 8
+'''
+
+CACHE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../../data/interim/tsne_sweep'))
+RESULT_NAME = 'result.json'
+RAW_OUTPUT_NAME = 'raw_tsne_output.txt'
+EMBEDDING_NAME = 'embedding.npy'
+PROGRESS_LOG_NAME = 'progress.jsonl'
+# How often runs are checked for being stalled, in seconds.
+WATCH_INTERVAL = 1
+
+
+def get_file_hash(path):
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as in_file:
+        while True:
+            data = in_file.read(bhtsne.CHUNK_SIZE)
+            if not data:
+                break
+            file_hash.update(data)
+    return file_hash.hexdigest()
+
+
+def get_run_key(matrix_hash, binary_hash, params):
+    description = json.dumps({'matrix': matrix_hash, 'bh_tsne': binary_hash, 'params': params}, sort_keys=True)
+    return hashlib.sha256(description.encode()).hexdigest()[:20]
+
+
+def get_grid(perplexities, thetas, seeds, max_iter, no_dims):
+    return [{'perplexity': perplexity, 'theta': theta, 'randseed': seed,
+             'max_iter': max_iter, 'no_dims': no_dims}
+            for perplexity, theta, seed in itertools.product(perplexities, thetas, seeds)]
+
+
+def load_result(run_dir):
+    try:
+        with open(os.path.join(run_dir, RESULT_NAME), 'r') as result_file:
+            return json.load(result_file)
+    except (OSError, ValueError):
+        return None
+
+
+def watch_run(run, stall_timeout, finished):
+    while not finished.wait(WATCH_INTERVAL):
+        if run.get_seconds_since_progress() > stall_timeout:
+            print('Stopping a run without progress for {} s'.format(stall_timeout))
+            run.stop()
+            return
+
+
+def run_configuration(nn_matrix_path, key, params, cache_dir, stall_timeout=None):
+    """
+    Run `bh_tsne` with `params`, unless the result is already in `cache_dir`.
+
+    Returns the description of the run (see `result.json`), with `cached` field.
+    """
+    run_dir = os.path.join(cache_dir, key)
+    result = load_result(run_dir)
+    if result is not None:
+        result['cached'] = True
+        return result
+
+    work_dir = tempfile.mkdtemp(prefix='.{}.'.format(key), dir=cache_dir)
+    try:
+        start = time.perf_counter()
+        run = bhtsne.BhTsneRun(nn_matrix_path, raw_output_path=os.path.join(work_dir, RAW_OUTPUT_NAME),
+                               workdir=work_dir, progress_log_path=os.path.join(work_dir, PROGRESS_LOG_NAME),
+                               **params)
+        finished = threading.Event()
+        if stall_timeout is not None:
+            threading.Thread(target=watch_run, args=(run, stall_timeout, finished), daemon=True).start()
+
+        kl_error = None
+        try:
+            for event in run:
+                if event['event'] == 'iteration':
+                    kl_error = event['error']
+        finally:
+            finished.set()
+        embedding = run.get_embedding()
+        wall_time = time.perf_counter() - start
+
+        np.save(os.path.join(work_dir, EMBEDDING_NAME), embedding)
+        result = {'key': key,
+                  'params': params,
+                  'wall_time': wall_time,
+                  'kl_error': kl_error,
+                  'cnt_points': len(embedding)}
+        with open(os.path.join(work_dir, RESULT_NAME), 'w') as result_file:
+            json.dump(result, result_file, indent=2, sort_keys=True)
+
+        if os.path.isdir(run_dir):
+            # The same run was finished by another sweep meanwhile.
+            shutil.rmtree(work_dir)
+        else:
+            os.rename(work_dir, run_dir)
+    except BaseException:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+
+    result['cached'] = False
+    return result
+
+
+def run_sweep(nn_matrix_path, grid, cache_dir=CACHE_DIR, jobs=None, stall_timeout=None):
+    """
+    Run all configurations of `grid`, at most `jobs` at once.
+    Runs without progress for `stall_timeout` seconds are stopped.
+
+    Returns descriptions of runs in the order of `grid`. A failed run
+    is described by its parameters and `error`.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    matrix_hash = get_file_hash(nn_matrix_path)
+    binary_hash = get_file_hash(bhtsne.BH_TSNE_BIN_PATH)
+
+    def run(params):
+        key = get_run_key(matrix_hash, binary_hash, params)
+        try:
+            result = run_configuration(nn_matrix_path, key, params, cache_dir, stall_timeout)
+        except Exception as e:
+            return {'key': key, 'params': params, 'error': str(e) or type(e).__name__}
+        print('{} {} ({}): KL {}, {:.1f} s'.format(key, format_params(params),
+              'cached' if result['cached'] else 'done', result['kl_error'], result['wall_time']))
+        return result
+
+    with ThreadPoolExecutor(jobs or os.cpu_count() or 1) as pool:
+        return list(pool.map(run, grid))
+
+
+def format_params(params):
+    return 'perplexity={} theta={} seed={}'.format(params['perplexity'], params['theta'], params['randseed'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run bh_tsne for a grid of hyperparameters.')
+    parser.add_argument('nn_matrix_path')
+    parser.add_argument('--perplexity', type=float, nargs='+', default=[bhtsne.NN_DEFAULT_PERPLEXITY])
+    parser.add_argument('--theta', type=float, nargs='+', default=[bhtsne.NN_DEFAULT_THETA])
+    parser.add_argument('--seed', type=int, nargs='+', default=[1])
+    parser.add_argument('--max-iter', type=int, default=bhtsne.NN_DEFAULT_MAX_ITERATIONS)
+    parser.add_argument('--no-dims', type=int, default=bhtsne.DEFAULT_NO_DIMS)
+    parser.add_argument('--jobs', type=int, default=None, help='number of concurrent runs (default: number of CPUs)')
+    parser.add_argument('--stall-timeout', type=float, default=None,
+            help='stop runs which did not report progress for so many seconds')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--summary', help='save results of all runs to this JSON file')
+    args = parser.parse_args()
+
+    grid = get_grid(args.perplexity, args.theta, args.seed, args.max_iter, args.no_dims)
+    results = run_sweep(args.nn_matrix_path, grid, args.cache_dir, args.jobs, args.stall_timeout)
+
+    print()
+    print('{:<22} {:<40} {:>10} {:>10}'.format('key', 'parameters', 'KL', 'time, s'))
+    for result in sorted(results, key=lambda result: (result.get('kl_error') is None, result.get('kl_error') or 0)):
+        if 'error' in result:
+            print('{:<22} {:<40} failed: {}'.format(result['key'], format_params(result['params']), result['error']))
+            continue
+        print('{:<22} {:<40} {:>10} {:>10.1f}'.format(result['key'], format_params(result['params']),
+              result['kl_error'], result['wall_time']))
+
+    if args.summary is not None:
+        with open(args.summary, 'w') as summary_file:
+            json.dump(results, summary_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
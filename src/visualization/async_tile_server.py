@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+import re
+import sys
+import json
+import asyncio
+import argparse
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from urllib.parse import urlsplit, unquote, parse_qsl
+
+import http_cache
+import tile_server
+
+'''
+An asyncio HTTP/1.1 server for the same routes as `tile_server.py`,
+without Flask, Werkzeug or gevent.
+
+Connections are kept alive between requests (by default in HTTP/1.1, and
+with `Connection: keep-alive` in HTTP/1.0). Pre-rendered tile files are sent
+with `loop.sendfile`, which uses `os.sendfile` on plain sockets: tile data
+goes from the page cache to the socket without passing through Python.
+
+Everything that may block (loading a tiling, reading ETags of a set of tiles, rendering
+a tile on demand, searching) runs in a thread pool, so that a slow request
+does not stall other connections.
+
+Only GET and HEAD requests are supported; request bodies are skipped.
+Needs Python 3.7 or newer.
+
+Example usage (from the directory with `tiles_*`, as `run_server.py`):
+    python3 async_tile_server.py --port 8000
+'''
+
+DEFAULT_PORT = 8000
+# Longest accepted request line with headers, in bytes.
+MAX_HEADER_BYTES = 16 * 1024
+# Idle keep-alive connections are closed after so many seconds.
+KEEP_ALIVE_TIMEOUT = 75
+# Number of threads running request handlers.
+DEFAULT_THREADS = 8
+
+REASONS = {
+    200: 'OK',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    500: 'Internal Server Error',
+}
+
+TILE_RE = re.compile(r'^/tiles_(?P<suffix>[^/]+)/(?P<x>\d+)_(?P<y>\d+)_(?P<z>\d+)\.png$')
+POINT_TILE_RE = re.compile(r'^/points_(?P<suffix>[^/]+)/(?P<x>\d+)_(?P<y>\d+)_(?P<z>\d+)$')
+SEARCH_RE = re.compile(r'^/search/(?P<suffix>[^/]+)/(?P<name>[^/]+)$')
+AUTOCOMPLETE_RE = re.compile(r'^/autocomplete/(?P<suffix>[^/]+)$')
+TILE_VERSION_RE = re.compile(r'^/tile_version/(?P<suffix>[^/]+)$')
+
+TEXT_TYPE = 'text/html; charset=utf-8'
+
+
+class Response:
+    '''
+    Status, headers and either a body or a path to the file to send.
+    '''
+
+    def __init__(self, status, body=b'', content_type=TEXT_TYPE, headers=None, file_path=None):
+        self.status = status
+        self.body = body
+        self.file_path = file_path
+        self.headers = [('Content-Type', content_type)] if content_type is not None else []
+        if headers is not None:
+            self.headers.extend(headers)
+
+
+def make_text_response(text):
+    return Response(200, text.encode('utf-8'))
+
+
+def make_cached_response(request_headers, etag, cache_control, content_type, body=b'', file_path=None,
+                         extra_headers=()):
+    '''
+    Make a response with validators, or `304 Not Modified` if the client has the same data.
+    '''
+    headers = [('ETag', http_cache.quote_etag(etag)), ('Cache-Control', cache_control)]
+    headers.extend(extra_headers)
+    if http_cache.is_not_modified(request_headers.get('if-none-match'), etag):
+        return Response(304, content_type=None, headers=headers)
+    return Response(200, body, content_type, headers, file_path)
+
+
+def serve_tile(suffix, x, y, z, args, request_headers):
+    if suffix not in tile_server.tiling_suffixes:
+        return make_text_response('')
+
+    tile_path, data, etag, source = tile_server.find_tile(suffix, x, y, z)
+    if tile_path is None and data is None:
+        return Response(404)
+    cache_control = tile_server.get_tile_cache_control(suffix, args.get('v'), source)
+    return make_cached_response(request_headers, etag, cache_control, 'image/png',
+                                body=data if data is not None else b'', file_path=tile_path)
+
+
+def serve_point_tile(suffix, x, y, z, args, request_headers):
+    if suffix not in tile_server.tiling_suffixes:
+        return make_text_response('')
+
+    data, etag, source = tile_server.find_point_tile(suffix, x, y, z)
+    if data is None:
+        return Response(404)
+    cache_control = tile_server.get_tile_cache_control(suffix, args.get('v'), source)
+    return make_cached_response(request_headers, etag, cache_control, 'application/json', body=data)
+
+
+def show_visualization(request_headers):
+    page = tile_server.visualizer_page
+    data, etag, content_encoding = page.get_representation(request_headers.get('accept-encoding'))
+    extra_headers = [('Vary', 'Accept-Encoding')]
+    if content_encoding is not None:
+        extra_headers.append(('Content-Encoding', content_encoding))
+    return make_cached_response(request_headers, etag, http_cache.REVALIDATE_CACHE_CONTROL,
+                                page.mimetype, body=data, extra_headers=extra_headers)
+
+
+def handle_request(path, args, request_headers):
+    '''
+    Route a request, as `tile_server.app` does. Runs in the thread pool.
+    '''
+    match = TILE_RE.match(path)
+    if match is not None:
+        return serve_tile(match.group('suffix'), int(match.group('x')), int(match.group('y')),
+                          int(match.group('z')), args, request_headers)
+
+    match = POINT_TILE_RE.match(path)
+    if match is not None:
+        return serve_point_tile(match.group('suffix'), int(match.group('x')), int(match.group('y')),
+                                int(match.group('z')), args, request_headers)
+
+    if path == '/':
+        return show_visualization(request_headers)
+    if path == '/get_tile_variants':
+        return make_text_response('<br>'.join(tile_server.tiling_names))
+
+    match = SEARCH_RE.match(path)
+    if match is not None:
+        return make_text_response(tile_server.get_search_result(match.group('suffix'), match.group('name')))
+
+    match = AUTOCOMPLETE_RE.match(path)
+    if match is not None:
+        suggestions = tile_server.get_suggestions(match.group('suffix'), args.get('q', ''), args.get('limit'))
+        return Response(200, json.dumps(suggestions).encode('utf-8'), 'application/json')
+
+    match = TILE_VERSION_RE.match(path)
+    if match is not None:
+        suffix = match.group('suffix')
+        if suffix not in tile_server.tiling_suffixes:
+            return make_text_response('')
+        return make_text_response(tile_server.get_tile_version(suffix))
+
+    return Response(404)
+
+
+def parse_request_head(head):
+    '''
+    Parse the request line and headers. Returns a tuple <method, target, HTTP version,
+    headers with lowercase names>, or None if the request is malformed.
+    '''
+    try:
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, version = lines[0].split(' ')
+    except ValueError:
+        return None
+    if not version.startswith('HTTP/1.'):
+        return None
+
+    headers = dict()
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            return None
+        headers[name.strip().lower()] = value.strip()
+    return method, target, version, headers
+
+
+def is_keep_alive(version, headers):
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.0':
+        return 'keep-alive' in connection
+    return 'close' not in connection
+
+
+class TileServerProtocol:
+    '''
+    Serve requests of one connection, one after another.
+    '''
+
+    def __init__(self, executor):
+        self.executor = executor
+
+
+    async def handle_connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEP_ALIVE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self.send(writer, Response(400), False, False)
+                    break
+
+                request = parse_request_head(head)
+                if request is None:
+                    await self.send(writer, Response(400), False, False)
+                    break
+                method, target, version, headers = request
+                keep_alive = is_keep_alive(version, headers)
+
+                content_length = headers.get('content-length', '0')
+                if not content_length.isdigit():
+                    await self.send(writer, Response(400), False, False)
+                    break
+                if int(content_length):
+                    await reader.readexactly(int(content_length))
+
+                if method not in ('GET', 'HEAD'):
+                    response = Response(405, headers=[('Allow', 'GET, HEAD')])
+                else:
+                    url = urlsplit(target)
+                    args = dict(parse_qsl(url.query))
+                    try:
+                        response = await loop.run_in_executor(self.executor, handle_request,
+                                                              unquote(url.path), args, headers)
+                    except Exception:
+                        traceback.print_exc()
+                        response = Response(500)
+
+                await self.send(writer, response, keep_alive, method == 'HEAD', version)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+    async def send(self, writer, response, keep_alive, head_only, version='HTTP/1.1'):
+        tile_file = None
+        if response.file_path is not None:
+            try:
+                tile_file = open(response.file_path, 'rb')
+            except FileNotFoundError:
+                # The file was removed along with an outdated version of tiles.
+                response = Response(404)
+
+        try:
+            if tile_file is not None:
+                content_length = tile_file.seek(0, 2)
+                tile_file.seek(0)
+            else:
+                content_length = len(response.body)
+
+            lines = ['HTTP/1.1 {} {}'.format(response.status, REASONS[response.status]),
+                     'Date: {}'.format(formatdate(usegmt=True))]
+            if response.status != 304:
+                lines.append('Content-Length: {}'.format(content_length))
+            lines.extend('{}: {}'.format(name, value) for name, value in response.headers)
+            if not keep_alive:
+                lines.append('Connection: close')
+            elif version == 'HTTP/1.0':
+                lines.append('Connection: keep-alive')
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+            if head_only or response.status == 304:
+                await writer.drain()
+            elif tile_file is not None:
+                await writer.drain()
+                await asyncio.get_running_loop().sendfile(writer.transport, tile_file)
+            else:
+                writer.write(response.body)
+                await writer.drain()
+        finally:
+            if tile_file is not None:
+                tile_file.close()
+
+
+async def serve(host, port, threads=DEFAULT_THREADS):
+    executor = ThreadPoolExecutor(threads)
+    # Find available tilings before accepting connections.
+    await asyncio.get_running_loop().run_in_executor(executor, tile_server.initialize)
+
+    protocol = TileServerProtocol(executor)
+    server = await asyncio.start_server(protocol.handle_connection, host, port, limit=MAX_HEADER_BYTES)
+    print('Serving on {}'.format(', '.join(str(sock.getsockname()) for sock in server.sockets)))
+    sys.stdout.flush()
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve tiles with asyncio.')
+    parser.add_argument('--host', default='')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS,
+            help='number of threads running request handlers')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host or None, args.port, args.threads))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
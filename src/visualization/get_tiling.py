@@ -1,23 +1,37 @@
 #!/usr/bin/env python3
 
+import io
 import os
 import os.path
 import shutil
 
 import sys
 import csv
+import array
+import argparse
+import multiprocessing
+import resource
+import threading
 
-import heapq
-from collections import namedtuple
+import hashlib
+import json
+import time
+import tempfile
+from collections import namedtuple, deque
 
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from PIL import Image, ImageDraw, ImageOps, ImageFont
 
-from pyqtree import Index
+import numpy as np
+
+import http_cache
+import mbtiles
+import stage_profiler
+from stage_profiler import profiler
 
 """
-Read a file with <tag_name, x, y> triples and compute an image representation 
+Read t-SNE output with coordinates of tags and compute an image representation 
 for described points.
 
 This script creates so-called "tiles": many small images with grid-like arrangement.
@@ -30,23 +44,62 @@ multiple maps (referring to multiple dates) and compare them.
 
 
 Input parameters:
-    1 - path to a tsv-file which describes points
-    2 - path to a csv-file with additional information about points
+    1 - path to t-SNE output which describes points: raw output of `bh_tsne`
+        (`raw_tsne_output_*.txt`) or a tsv-file extracted from it
+    2 - path to a csv-file with additional information about points,
+        one row per point, in the same order
     3 - maximum zoom level for created tiles
     4 - lower bound on a date of any post that is used to compute tag similarity.
 
+Options:
+    --workers N - render metatiles in N processes. The output is the same
+        as when rendering in a single process.
+    --max-in-flight N - when rendering in a single process, keep at most N rendered
+        metatiles waiting for PNG encoding (default: twice the number of CPUs).
+        With --workers, at most N encoded metatiles wait for being written.
+    --memory-budget MB - same as above, but the limit is derived from
+        memory (in MiB) that waiting metatiles may take.
+
+    --incremental - compare with the manifest of the previous run and render only
+        metatiles whose points, post counts or visible labels changed.
+    --output mbtiles - write all tiles into a single SQLite file in MBTiles format,
+        `TILES_DIR_BASE` with appended posts date and `.mbtiles` extension.
+
+    --profile REPORT - record cumulative time and number of calls of each phase of
+        rendering (see `stage_profiler.py`) per zoom level, print a summary and
+        write it to REPORT as JSON. Building the label index, which is done once
+        for all zoom levels, is reported as `labels`.
+    --profile-zoom Z - also capture a profile of rendering zoom level Z, with
+        cProfile (saved next to REPORT as `*_zoomZ.prof`) or, with
+        `--profile-with tracemalloc`, the largest allocations.
+
+Peak memory usage is reported for each zoom level.
+
+Input data is also saved in a binary form to a directory `SNAPSHOT_DIR_BASE`
+with appended posts date (see `save_snapshot`). Worker processes and the tile
+server load it instead of parsing the input files, as long as they did not change.
+
 Output:
     Writes output tiles to a directory `TILES_DIR_BASE` with appended posts date.
-    Deletes everything in it beforehand.
+    The directory is a symbolic link to the current version of tiles. New tiles
+    are written to a separate directory, and the link is switched only when
+    all of them are ready, so the tile server never serves a half-written set.
+    `manifest.json` describes what was drawn on each metatile, holds the
+    index of labels shown on low zoom levels and ETags of all tiles (hashes
+    of their contents, see `http_cache.py`), so that the tile server does not
+    have to read every tile to serve it with an ETag.
     Tiles are named `x_y_z.png`, where `z` is the zoom level, `x` and `y` are
     tile coordinates (from 0 to 2**z - 1).
 
 
 Example usage:
-    python3 get_tiling.py tsne_output_example.tsv id_to_additional_info_example.csv 5 example
+    python3 get_tiling.py raw_tsne_output_example.txt id_to_additional_info_example.csv 5 example
+    python3 get_tiling.py tsne_output_example.tsv id_to_additional_info_example.csv 5 example --workers 8
 """
 
 TILES_DIR_BASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tiles')
+# Binary copies of the input data are stored in `SNAPSHOT_DIR_BASE` with appended posts date.
+SNAPSHOT_DIR_BASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snapshot')
 
 # Each tile is rendered in (256x256)*ANTIALIASING_SCALE size,
 # and then downscaled with antialiasing.
@@ -58,108 +111,530 @@ TILE_DIM = 256 * ANTIALIASING_SCALE
 SHIFT = 10 * ANTIALIASING_SCALE
 # Tiles are united in groups of METATILE_SIZE x METATILE_SIZE units.
 METATILE_SIZE = 8
+# Name of the file describing generated tiles. It is stored along with them.
+MANIFEST_NAME = 'manifest.json'
+# Memory taken by one rendered RGB metatile.
+METATILE_BYTES = 3 * (TILE_DIM * METATILE_SIZE) ** 2
 # The level, starting at which all tag names are shown, and number of shown tag 
 # names per tile.
 ZOOM_TEXT_SHOW = 7
 TAGS_ANNOTATED_PER_TILE = 10
+# The deepest zoom level we are able to render.
+MAX_ZOOM = 19
+# Font size decreases with zoom, but never goes below this value.
+MIN_FONT_SIZE = 9
+# Increase this when changing the way metatiles are drawn, so that
+# incremental generation does not reuse tiles drawn the old way.
+RENDER_VERSION = 2
+# Point tiles (see `Tiler.get_point_tile`) have tile-local coordinates quantized
+# to a grid of POINT_TILE_EXTENT x POINT_TILE_EXTENT cells.
+POINT_TILE_EXTENT = 4096
+# Labels start at their point and go right and down, so point tiles include labelled
+# tags which are up to this many pixels to the left or above the tile.
+POINT_TILE_LABEL_MARGIN = 128
+# Increase this when changing the contents of point tiles.
+POINT_TILE_VERSION = 1
+
+# Raw output of `bh_tsne` has the table of points between these lines.
+TSV_START = b'######START TSV'
+TSV_END = b'######END TSV'
 
 Point = namedtuple('Point', ['x', 'y'])
 
 
-def get_tags_data(tsv_data_path, additional_data_path):
+def read_points(tsne_output_path):
+    """
+    Read coordinates of points from t-SNE output: either the raw output
+    of `bh_tsne`, where the table is between `TSV_START` and `TSV_END` lines,
+    or the table alone. The table has a header with `x` and `y` columns.
+
+    Returns arrays of x and y.
+    """
+    with open(tsne_output_path, 'rb') as tsne_output_file:
+        data = tsne_output_file.read()
+
+    start = data.find(TSV_START)
+    if start != -1:
+        start = data.index(b'\n', start) + 1
+        end = data.find(TSV_END, start)
+        data = data[start:end if end != -1 else len(data)]
+
+    header, _, table = data.lstrip().partition(b'\n')
+    header = header.decode('utf-8').split()
+    table = table.rstrip()
+    cnt_rows = table.count(b'\n') + 1 if table else 0
+
+    values = np.fromstring(table, dtype=np.float64, sep=' ') if table else np.empty(0)
+    if len(values) != cnt_rows * len(header):
+        raise ValueError('{}: expected {} numbers in every row'.format(tsne_output_path, len(header)))
+    values = values.reshape(cnt_rows, len(header))
+    return values[:, header.index('x')].copy(), values[:, header.index('y')].copy()
+
+
+def get_tags_data(tsv_data_path, additional_data_path, extra_columns=()):
+    """
+    Read tags into `TagColumns`: points from t-SNE output (see `read_points`),
+    joined by index with rows of the additional information.
+
+    Besides coordinates, names and post counts, only the additional
+    columns listed in `extra_columns` are kept (as strings).
+    """
+    x, y = read_points(tsv_data_path)
+    post_count = array.array('q')
+    names = []
+    extra = {column: [] for column in extra_columns}
+
     with open(additional_data_path, 'r', newline='') as additional_info_file:
-        additional_reader = csv.DictReader(additional_info_file)
-        with open(tsv_data_path, 'r', newline='') as tsvfile:
-            reader = csv.DictReader(tsvfile, delimiter='\t')
-            tags = []
-            for row, add_info in zip(reader, additional_reader):
-                flat_addinfo = [(name, add_info[name]) for name in additional_reader.fieldnames]
-                tags.append(Tag(float(row['x']), float(row['y']), *flat_addinfo))
+        additional_reader = csv.reader(additional_info_file)
+        fieldnames = next(additional_reader)
+        name_pos = fieldnames.index('name')
+        post_count_pos = fieldnames.index('PostCount') if 'PostCount' in fieldnames else None
+        extra_pos = [(column, fieldnames.index(column)) for column in extra_columns]
+
+        for add_info in additional_reader:
+            post_count.append(int(add_info[post_count_pos]) if post_count_pos is not None else -1)
+            # Names are interned, so that all Tilers of a process share them.
+            names.append(sys.intern(add_info[name_pos]))
+            for column, pos in extra_pos:
+                extra[column].append(add_info[pos])
+
+    if len(names) != len(x):
+        raise ValueError('{} has {} points, but {} describes {} tags'.format(
+            tsv_data_path, len(x), additional_data_path, len(names)))
+
+    return TagColumns(x, y, np.frombuffer(post_count, dtype=np.int64), names, extra)
 
-            return tags
 
 class Tag:
+    """
+    A view of one tag stored in `TagColumns`.
+
+    Provides the attributes of a tag: `x`, `y`, `name`, `PostCount`
+    and extra columns, without storing a dictionary per tag.
+    """
+
+    __slots__ = ('columns', 'index')
+
+    def __init__(self, columns, index):
+        self.columns = columns
+        self.index = index
+
+
+    @property
+    def x(self):
+        return float(self.columns.x[self.index])
+
+
+    @property
+    def y(self):
+        return float(self.columns.y[self.index])
+
+
+    @property
+    def name(self):
+        return self.columns.names[self.index]
+
+
+    @property
+    def PostCount(self):
+        return int(self.columns.post_count[self.index])
+
+
+    def __getattr__(self, column):
+        try:
+            return self.columns.extra[column][self.index]
+        except KeyError:
+            raise AttributeError(column)
+
+
+class TagColumns:
+    """
+    Columnar representation of tags: coordinates, post counts
+    and names are stored in parallel arrays.
+
+    `extra` maps names of other columns to lists of their values.
+    Indexing returns a `Tag`.
+    """
+
+    def __init__(self, x, y, post_count, names, extra=None):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.post_count = np.asarray(post_count, dtype=np.int64)
+        self.names = list(names)
+        self.extra = extra if extra is not None else dict()
+
+
+    @classmethod
+    def from_tags(cls, tags):
+        return cls([tag.x for tag in tags],
+                   [tag.y for tag in tags],
+                   [int(getattr(tag, 'PostCount', -1)) for tag in tags],
+                   [tag.name for tag in tags])
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError(index)
+        return Tag(self, index % len(self))
+
+
+def get_snapshot_dir(date_suffix):
+    return '{}_{}'.format(SNAPSHOT_DIR_BASE, date_suffix)
+
+
+def get_source_stamps(source_paths):
+    """
+    Return sizes and modification times of input files, or None for missing files.
+    """
+    stamps = []
+    for path in source_paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stamps.append(None)
+            continue
+        stamps.append([stat.st_size, stat.st_mtime_ns])
+    return stamps
+
+
+def save_snapshot(columns, snapshot_dir, source_paths):
+    """
+    Save tag columns into `snapshot_dir`: one `.npy` file per column and a list of names.
+
+    Stamps of the input files are saved as well, so that an outdated
+    snapshot is not used. The directory is replaced as a whole.
+    """
+    parent_dir, snapshot_name = os.path.split(os.path.abspath(snapshot_dir))
+    new_snapshot_dir = tempfile.mkdtemp(prefix='.{}.'.format(snapshot_name), dir=parent_dir)
+    try:
+        np.save(os.path.join(new_snapshot_dir, 'x.npy'), columns.x)
+        np.save(os.path.join(new_snapshot_dir, 'y.npy'), columns.y)
+        np.save(os.path.join(new_snapshot_dir, 'post_count.npy'), columns.post_count)
+        with open(os.path.join(new_snapshot_dir, 'names.json'), 'w') as names_file:
+            json.dump(columns.names, names_file)
+        with open(os.path.join(new_snapshot_dir, 'sources.json'), 'w') as sources_file:
+            json.dump(get_source_stamps(source_paths), sources_file)
+        os.chmod(new_snapshot_dir, 0o755)
+
+        old_snapshot_dir = None
+        if os.path.isdir(snapshot_dir):
+            old_snapshot_dir = '{}.old-{}'.format(new_snapshot_dir, os.getpid())
+            os.rename(snapshot_dir, old_snapshot_dir)
+        os.rename(new_snapshot_dir, snapshot_dir)
+    except BaseException:
+        shutil.rmtree(new_snapshot_dir, ignore_errors=True)
+        raise
+
+    if old_snapshot_dir is not None:
+        shutil.rmtree(old_snapshot_dir, ignore_errors=True)
+
+
+def load_snapshot(snapshot_dir, source_paths):
+    """
+    Load tag columns saved by `save_snapshot`, or return None if the snapshot
+    is missing or older than the input files.
+
+    Columns are memory-mapped, so processes loading the same snapshot share them.
+    Missing input files are not checked: the snapshot may be shipped without them.
+    """
+    try:
+        with open(os.path.join(snapshot_dir, 'sources.json'), 'r') as sources_file:
+            saved_stamps = json.load(sources_file)
+        with open(os.path.join(snapshot_dir, 'names.json'), 'r') as names_file:
+            names = [sys.intern(name) for name in json.load(names_file)]
+        x = np.load(os.path.join(snapshot_dir, 'x.npy'), mmap_mode='r')
+        y = np.load(os.path.join(snapshot_dir, 'y.npy'), mmap_mode='r')
+        post_count = np.load(os.path.join(snapshot_dir, 'post_count.npy'), mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+
+    for saved_stamp, stamp in zip(saved_stamps, get_source_stamps(source_paths)):
+        if stamp is not None and stamp != saved_stamp:
+            return None
+    if not len(x) == len(y) == len(post_count) == len(names):
+        return None
+
+    return TagColumns(x, y, post_count, names)
+
+
+def load_tag_columns(tsv_data_path, additional_data_path, snapshot_dir=None):
+    """
+    Load tags from the snapshot in `snapshot_dir`, if it is up to date.
+
+    Otherwise, parse the input files and save a new snapshot.
+    """
+    source_paths = [tsv_data_path, additional_data_path]
+    if snapshot_dir is not None:
+        columns = load_snapshot(snapshot_dir, source_paths)
+        if columns is not None:
+            return columns
 
-    def __init__(self, x, y, *additional_info):
-        self.x = x
-        self.y = y
-        for field_name, field_val in additional_info:
-            self.__dict__[field_name] = field_val
+    columns = get_tags_data(tsv_data_path, additional_data_path)
+    if snapshot_dir is not None:
+        try:
+            save_snapshot(columns, snapshot_dir, source_paths)
+        except OSError as e:
+            print('Could not save snapshot to {}: {}'.format(snapshot_dir, e))
+    return columns
+
+
+class ZoomBuckets:
+    """
+    Tags of one zoom level, sorted by the metatile they fall into.
+
+    Tags of a metatile form a contiguous slice, so a rectangular query
+    is a handful of binary searches instead of a walk over a tree.
+    """
+
+    def __init__(self, columns, origin, tile_size, zoom):
+        self.origin = origin
+        self.tile_size = tile_size
+        self.cells_per_axis = max(1, -(-(1 << zoom) // METATILE_SIZE))
+
+        cell_x = self.get_cell(columns.x, origin.x)
+        cell_y = self.get_cell(columns.y, origin.y)
+        keys = cell_x * self.cells_per_axis + cell_y
+
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+
+
+    def get_cell(self, coords, origin_coord):
+        cells = np.floor((coords - origin_coord) / self.tile_size).astype(np.int64)
+        return np.clip(cells, 0, self.cells_per_axis - 1)
+
+
+    def query(self, columns, min_x, min_y, max_x, max_y):
+        """
+        Return indices of tags inside the (closed) rectangle, in increasing order.
+
+        The order matters: overlapping labels are blended one after another.
+        """
+        cell_x_lo, cell_x_hi = self.get_cell(np.array([min_x, max_x]), self.origin.x)
+        cell_y_lo, cell_y_hi = self.get_cell(np.array([min_y, max_y]), self.origin.y)
+
+        column_keys = np.arange(cell_x_lo, cell_x_hi + 1) * self.cells_per_axis
+        starts = np.searchsorted(self.sorted_keys, column_keys + cell_y_lo, side='left')
+        ends = np.searchsorted(self.sorted_keys, column_keys + cell_y_hi, side='right')
+
+        candidates = np.concatenate([self.order[start:end] for start, end in zip(starts, ends)])
+        cand_x = columns.x[candidates]
+        cand_y = columns.y[candidates]
+        inside = (cand_x >= min_x) & (cand_x <= max_x) & (cand_y >= min_y) & (cand_y <= max_y)
+        return np.sort(candidates[inside])
+
+
+class LabelIndex:
+    """
+    Names of tags shown on each metatile, for zoom levels below `ZOOM_TEXT_SHOW`.
+
+    Each metatile needs labels of all its neighbours, so label sets are computed
+    once per zoom level instead of nine times for every metatile.
+    The index can be saved as JSON and loaded back with `from_dict`.
+    """
+
+    def __init__(self):
+        # zoom -> {(meta_x, meta_y) -> names shown on the metatile}
+        self.shown_names = dict()
+        # zoom -> {(meta_x, meta_y) -> names shown on the metatile and its neighbours}
+        self.shown_names_around = dict()
+
+
+    @staticmethod
+    def get_cells_per_axis(zoom):
+        return max(1, -(-(1 << zoom) // METATILE_SIZE))
+
+
+    def has_zoom(self, zoom):
+        return zoom in self.shown_names
+
+
+    def build_zoom(self, tiler, zoom):
+        # Cells just outside the map are included as well, because
+        # they are neighbours of metatiles on the border.
+        cells = range(-1, self.get_cells_per_axis(zoom) + 1)
+        shown_names = dict()
+        for meta_x in cells:
+            for meta_y in cells:
+                names = tiler.select_names_of_shown_tags(meta_x, meta_y, zoom)
+                if names:
+                    shown_names[(meta_x, meta_y)] = frozenset(names)
+        self.set_zoom(zoom, shown_names)
+
+
+    def set_zoom(self, zoom, shown_names):
+        shown_names_around = dict()
+        for (meta_x, meta_y), names in shown_names.items():
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    key = (meta_x + dx, meta_y + dy)
+                    shown_names_around[key] = shown_names_around.get(key, frozenset()) | names
+        # Readers check `has_zoom` without a lock, so `shown_names` is published last.
+        self.shown_names_around[zoom] = shown_names_around
+        self.shown_names[zoom] = shown_names
+
+
+    def get_names(self, meta_x, meta_y, zoom):
+        return self.shown_names[zoom].get((int(meta_x), int(meta_y)), frozenset())
+
+
+    def get_names_around(self, meta_x, meta_y, zoom):
+        return self.shown_names_around[zoom].get((int(meta_x), int(meta_y)), frozenset())
+
+
+    def to_dict(self):
+        return {str(zoom): {'{}_{}'.format(meta_x, meta_y): sorted(names)
+                            for (meta_x, meta_y), names in shown_names.items()}
+                for zoom, shown_names in self.shown_names.items()}
+
+
+    @classmethod
+    def from_dict(cls, data):
+        label_index = cls()
+        for zoom, shown_names in data.items():
+            label_index.set_zoom(int(zoom), {tuple(map(int, key.split('_'))): frozenset(names)
+                                             for key, names in shown_names.items()})
+        return label_index
+
+
+# Fonts for each zoom level, shared by all Tilers, see `get_fonts`.
+_fonts = None
+
+
+def get_fonts():
+    global _fonts
+    if _fonts is None:
+        path_to_font = os.path.join(os.path.dirname(os.path.abspath(__file__)), './Verdana.ttf')
+        _fonts = [ImageFont.truetype(path_to_font, ANTIALIASING_SCALE * max(MIN_FONT_SIZE, 25 - zoom * 2))
+                  for zoom in range(MAX_ZOOM + 1)]
+    return _fonts
 
 
 class Tiler:
 
-    def set_extent(self, tags):
-        self.max_x = max((tag.x for tag in tags)) + SHIFT
-        self.min_x = min((tag.x for tag in tags)) - SHIFT
+    def set_extent(self, columns):
+        self.max_x = float(columns.x.max()) + SHIFT
+        self.min_x = float(columns.x.min()) - SHIFT
 
-        self.max_y = max((tag.y for tag in tags)) + SHIFT
-        self.min_y = min((tag.y for tag in tags)) - SHIFT
+        self.max_y = float(columns.y.max()) + SHIFT
+        self.min_y = float(columns.y.min()) - SHIFT
 
         self.origin = Point(self.min_x, self.min_y)
         max_size = max(self.max_x - self.min_x, self.max_y - self.min_y)
         self.map_size = max_size
 
-        self.tile_size = [self.map_size / (1 << i) * METATILE_SIZE for i in range(20)]
+        self.tile_size = [self.map_size / (1 << i) * METATILE_SIZE for i in range(MAX_ZOOM + 1)]
 
-        self.tag_to_normpos = dict()
-        for tag in tags:
-            x, y = tag.x, tag.y
-            rel_x, rel_y = x - self.origin.x, y - self.origin.y
-            norm_x, norm_y = rel_x / self.map_size, rel_y / self.map_size
-            self.tag_to_normpos[tag.name] = (norm_x, norm_y)
+        self.tag_to_index = dict(zip(columns.names, range(len(columns))))
 
 
-    def set_bbox(self, tags):
-        self.tag_spatial_index = Index(bbox=(self.min_x, self.min_y, self.max_x, self.max_y))
-        for tag in tags:
-            bbox = (tag.x, tag.y, tag.x, tag.y)
-            self.tag_spatial_index.insert(tag, bbox)
+    def set_bbox(self, columns):
+        # Buckets and label sets are computed for each zoom level on first use.
+        self.zoom_buckets = dict()
+        self.label_index = LabelIndex()
+        # Tiles are rendered on demand from several threads of the tile server,
+        # and each zoom level of the label index is built only once.
+        self._label_lock = threading.Lock()
 
 
-    def set_postcount(self, tags):
-        for tag in tags:
-            tag.PostCount = int(getattr(tag, 'PostCount', -1))
-        self.max_post_count = max(int(tag.PostCount) for tag in tags)
+    def set_postcount(self, columns):
+        self.max_post_count = int(columns.post_count.max())
+        # Rank of each tag name in sorted order, used to break ties between post counts.
+        name_order = np.argsort(np.array(columns.names, dtype=object), kind='stable')
+        self.name_rank = np.empty(len(columns), dtype=np.int64)
+        self.name_rank[name_order] = np.arange(len(columns))
 
 
     def set_fonts(self):
-        path_to_font = os.path.join(os.path.dirname(os.path.abspath(__file__)), './Verdana.ttf')
-        self.fonts = [ImageFont.truetype(path_to_font, ANTIALIASING_SCALE * (25 - zoom * 2)) for zoom in range(8 + 1)]
+        self.fonts = get_fonts()
 
 
     def __init__(self, tags):
-        self.set_extent(tags)
-        self.set_bbox(tags)
-        self.set_postcount(tags)
+        if not isinstance(tags, TagColumns):
+            tags = TagColumns.from_tags(tags)
+        self.columns = tags
+
+        self.set_extent(self.columns)
+        self.set_bbox(self.columns)
+        self.set_postcount(self.columns)
         self.set_fonts()
 
 
+    def get_normpos(self, tag_index):
+        """
+        Return position of a tag on the map, scaled to [0, 1].
+        """
+        return ((float(self.columns.x[tag_index]) - self.origin.x) / self.map_size,
+                (float(self.columns.y[tag_index]) - self.origin.y) / self.map_size)
+
+
     def search(self, name):
-        return self.tag_to_normpos.get(name, '')
+        tag_index = self.tag_to_index.get(name)
+        if tag_index is None:
+            return ''
+        return self.get_normpos(tag_index)
+
 
+    def get_memory_size(self):
+        """
+        Estimate memory (in bytes) taken by this Tiler.
 
-    def get_postcount_measure(self, tag):
-        tag_count = tag.PostCount
+        Memory-mapped columns are counted as well: they take page cache,
+        and the estimate is used for deciding which Tilers to unload.
+        """
+        if not hasattr(self, '_names_size'):
+            # Names do not change, so their size is computed once.
+            # Besides the list, each name is referenced by `tag_to_index`.
+            self._names_size = sum(sys.getsizeof(name) for name in self.columns.names) + \
+                               len(self.columns) * (8 + 100)
+
+        size = self._names_size + self.columns.x.nbytes + self.columns.y.nbytes + \
+               self.columns.post_count.nbytes + self.name_rank.nbytes
+        for buckets in list(self.zoom_buckets.values()):
+            size += buckets.order.nbytes + buckets.sorted_keys.nbytes
+        return size
+
+
+    def get_postcount_measure(self, tag_indices):
+        tag_count = self.columns.post_count[tag_indices]
         max_post_count = self.max_post_count
         return tag_count / max_post_count
 
 
+    def get_buckets(self, zoom):
+        buckets = self.zoom_buckets.get(zoom)
+        if buckets is None:
+            with profiler.measure(zoom, 'buckets'):
+                buckets = ZoomBuckets(self.columns, self.origin, self.tile_size[zoom], zoom)
+            self.zoom_buckets[zoom] = buckets
+        return buckets
+
+
     def get_tags_in_tile(self, meta_x, meta_y, zoom, with_shift):
+        """
+        Return indices of tags inside a metatile.
+        """
         tile_size = self.tile_size[zoom]
         lower_left_corner = Point(self.origin.x + meta_x * tile_size,
                                   self.origin.y + meta_y * tile_size)
 
         shift = SHIFT if with_shift else 0
-        tags_inside_tile = self.tag_spatial_index.intersect((lower_left_corner.x - shift, 
-                                                             lower_left_corner.y - shift,
-                                                             lower_left_corner.x + tile_size + shift, 
-                                                             lower_left_corner.y + tile_size + shift))
+        buckets = self.get_buckets(zoom)
+        with profiler.measure(zoom, 'query'):
+            tags_inside_tile = buckets.query(self.columns,
+                                             lower_left_corner.x - shift, 
+                                             lower_left_corner.y - shift,
+                                             lower_left_corner.x + tile_size + shift, 
+                                             lower_left_corner.y + tile_size + shift)
 
         return tags_inside_tile
 
 
-    def get_names_of_shown_tags(self, meta_x, meta_y, zoom):
+    def select_names_of_shown_tags(self, meta_x, meta_y, zoom):
         """
         Return the names of tags that we will show on the map.
 
@@ -171,9 +646,125 @@ class Tiler:
 
         tags_inside_tile = self.get_tags_in_tile(meta_x, meta_y, zoom, False)
 
-        all_postcounts = sorted([(tag.PostCount, tag.name) for tag in tags_inside_tile])
-        largest_tags = heapq.nlargest(TAGS_ANNOTATED_PER_TILE, all_postcounts)
-        return {x[1] for x in largest_tags if x[0] > 0}
+        with profiler.measure(zoom, 'label_selection'):
+            # Take tags with largest post counts, breaking ties by name (larger names first).
+            post_counts = self.columns.post_count[tags_inside_tile]
+            order = np.lexsort((self.name_rank[tags_inside_tile], post_counts))
+            largest_tags = order[::-1][:TAGS_ANNOTATED_PER_TILE]
+            largest_tags = largest_tags[post_counts[largest_tags] > 0]
+            return {self.columns.names[i] for i in tags_inside_tile[largest_tags].tolist()}
+
+
+    def get_label_index(self, zoom):
+        label_index = self.label_index
+        if zoom < ZOOM_TEXT_SHOW and not label_index.has_zoom(zoom):
+            with self._label_lock:
+                if not label_index.has_zoom(zoom):
+                    label_index.build_zoom(self, zoom)
+        return label_index
+
+
+    def build_label_index(self):
+        for zoom in range(ZOOM_TEXT_SHOW):
+            self.get_label_index(zoom)
+        return self.label_index
+
+
+    def set_label_index(self, label_index):
+        self.label_index = label_index
+
+
+    def get_names_of_shown_tags(self, meta_x, meta_y, zoom):
+        if zoom >= ZOOM_TEXT_SHOW:
+            return frozenset()
+        return self.get_label_index(zoom).get_names(meta_x, meta_y, zoom)
+
+
+    def get_names_of_shown_tags_around(self, meta_x, meta_y, zoom):
+        """
+        Return the names of tags shown on a metatile and on all its neighbours.
+
+        Tag names are drawn partially on neighbouring metatiles, so we need them as well.
+        """
+        if zoom >= ZOOM_TEXT_SHOW:
+            return frozenset()
+        return self.get_label_index(zoom).get_names_around(meta_x, meta_y, zoom)
+
+
+    def get_point_tile(self, x, y, zoom):
+        """
+        Return tags drawn on tile (x, y) as data for rendering it on the client.
+
+        Returns a dict with lists `x`, `y` (tile-local pixel coordinates, multiplied
+        by POINT_TILE_EXTENT / TILE_DIM and rounded) and `post_count`, in the order
+        in which circles are drawn, and `label` with `names`: indices of tags whose
+        names are shown, and these names. Tags around the tile are included when
+        their circles or labels reach it, so tiles can be drawn independently.
+        """
+        tile_size = self.tile_size[zoom] / METATILE_SIZE
+        pixel_size = tile_size / TILE_DIM
+        min_x = self.origin.x + x * tile_size
+        min_y = self.origin.y + y * tile_size
+        # Largest circle radius is `zoom` pixels, see `get_metatile`.
+        max_circle_rad = max(1, zoom)
+        circle_margin = max_circle_rad * pixel_size
+        label_margin = POINT_TILE_LABEL_MARGIN * pixel_size
+
+        candidates = self.get_buckets(zoom).query(self.columns, min_x - label_margin, min_y - label_margin,
+                                                  min_x + tile_size + circle_margin,
+                                                  min_y + tile_size + circle_margin)
+        shown_names = self.get_names_of_shown_tags_around(x // METATILE_SIZE, y // METATILE_SIZE, zoom)
+        names = [self.columns.names[i] for i in candidates.tolist()]
+        is_labelled = np.array([zoom >= ZOOM_TEXT_SHOW or name in shown_names for name in names], dtype=bool)
+
+        points_x = (self.columns.x[candidates] - min_x) / pixel_size
+        points_y = (self.columns.y[candidates] - min_y) / pixel_size
+        # Tags far to the left or above are needed only for their labels.
+        keep = is_labelled | ((points_x >= -max_circle_rad) & (points_y >= -max_circle_rad))
+
+        scale = POINT_TILE_EXTENT / TILE_DIM
+        label = np.flatnonzero(is_labelled[keep])
+        kept_names = [name for name, is_kept in zip(names, keep.tolist()) if is_kept]
+        return {'extent': POINT_TILE_EXTENT,
+                'max_post_count': self.max_post_count,
+                'x': np.round(points_x[keep] * scale).astype(np.int64).tolist(),
+                'y': np.round(points_y[keep] * scale).astype(np.int64).tolist(),
+                'post_count': self.columns.post_count[candidates[keep]].astype(np.int64).tolist(),
+                'label': label.tolist(),
+                'names': [kept_names[i] for i in label.tolist()]}
+
+
+    def get_global_signature(self):
+        """
+        Return a digest of everything that affects all metatiles at once.
+        """
+        global_params = [RENDER_VERSION, self.origin.x, self.origin.y, self.map_size,
+                         self.max_post_count, TILE_DIM, SHIFT, METATILE_SIZE, ANTIALIASING_SCALE,
+                         ZOOM_TEXT_SHOW, TAGS_ANNOTATED_PER_TILE, MIN_FONT_SIZE]
+        return hashlib.sha1(json.dumps(global_params).encode('utf-8')).hexdigest()
+
+
+    def get_metatile_signature(self, meta_x, meta_y, zoom):
+        """
+        Return a digest of everything that is drawn on a metatile.
+
+        Metatiles with equal signatures (under equal global signatures)
+        are rendered to equal images.
+        """
+        meta_x /= METATILE_SIZE
+        meta_y /= METATILE_SIZE
+
+        names_of_shown_tags = self.get_names_of_shown_tags_around(meta_x, meta_y, zoom)
+        tags_inside_tile = self.get_tags_in_tile(meta_x, meta_y, zoom, True)
+
+        with profiler.measure(zoom, 'signature'):
+            names = [self.columns.names[i] for i in tags_inside_tile.tolist()]
+            drawn_tags = sorted(zip(names,
+                                    self.columns.x[tags_inside_tile].tolist(),
+                                    self.columns.y[tags_inside_tile].tolist(),
+                                    self.columns.post_count[tags_inside_tile].tolist(),
+                                    [zoom >= ZOOM_TEXT_SHOW or name in names_of_shown_tags for name in names]))
+            return hashlib.sha1(json.dumps(drawn_tags).encode('utf-8')).hexdigest()
 
 
     def get_metatile(self, meta_x, meta_y, zoom):
@@ -195,48 +786,40 @@ class Tiler:
         lower_left_corner = Point(self.origin.x + meta_x * tile_size,
                                   self.origin.y + meta_y * tile_size)
         max_circle_rad = zoom * 1
-        cnt_points = 0
 
-        names_of_shown_tags = set()
-        for dx in (-1, 0, 1):
-            for dy in (-1, 0, 1):
-                names_of_shown_tags.update(self.get_names_of_shown_tags(meta_x + dx, meta_y + dy, zoom))
+        names_of_shown_tags = self.get_names_of_shown_tags_around(meta_x, meta_y, zoom)
 
         # Match slightly more tags, so that circles from neighbouring tiles can be drawn partially.
         tags_inside_tile = self.get_tags_in_tile(meta_x, meta_y, zoom, True)
+        cnt_points = len(tags_inside_tile)
 
+        # Get coordinates from tile origin, and then scale them to TILE_DIM.
+        points_x = ((self.columns.x[tags_inside_tile] - lower_left_corner.x)
+                    / tile_size * TILE_DIM * METATILE_SIZE).tolist()
+        points_y = ((self.columns.y[tags_inside_tile] - lower_left_corner.y)
+                    / tile_size * TILE_DIM * METATILE_SIZE).tolist()
 
-        def get_point_from_tag(tag):
-            x, y = tag.x, tag.y
-
-            # Get coordinates from tile origin.
-            point_coords = Point(x - lower_left_corner.x, y - lower_left_corner.y)
-            # Now scale to TILE_DIM.
-            pnt = Point(point_coords.x / tile_size * TILE_DIM * METATILE_SIZE,
-                        point_coords.y / tile_size * TILE_DIM * METATILE_SIZE)
-            return pnt
+        # Heuristic formula for showing post counts by circle sizes.
+        post_count_measure = self.get_postcount_measure(tags_inside_tile)
+        circle_rads = np.maximum(0.5, max_circle_rad * post_count_measure).tolist()
 
-
-        for tag in tags_inside_tile:
-            pnt = get_point_from_tag(tag)
-
-            # Heuristic formula for showing post counts by circle sizes.
-            post_count_measure = self.get_postcount_measure(tag)
-            circle_rad = max(0.5, max_circle_rad * post_count_measure)
-
-            draw.ellipse([pnt.x - circle_rad, pnt.y - circle_rad,
-                   pnt.x + circle_rad, pnt.y + circle_rad],
-                   fill=(122, 176, 42))
-
-            cnt_points += 1
+        with profiler.measure(zoom, 'ellipse', cnt_points):
+            for pnt_x, pnt_y, circle_rad in zip(points_x, points_y, circle_rads):
+                draw.ellipse([pnt_x - circle_rad, pnt_y - circle_rad,
+                       pnt_x + circle_rad, pnt_y + circle_rad],
+                       fill=(122, 176, 42))
 
         # Draw text after all circles, so that it is not overwritten.
         # (because I did not find any kind of z-index feature in PIL)
-        for tag in tags_inside_tile:
-            pnt = get_point_from_tag(tag)
-            fill = (0, 0, 0)
-            if zoom >= ZOOM_TEXT_SHOW or tag.name in names_of_shown_tags:
-                draw.text(pnt, tag.name, fill=fill, font=self.fonts[zoom])
+        fill = (0, 0, 0)
+        labels = []
+        for tag_idx, pnt_x, pnt_y in zip(tags_inside_tile.tolist(), points_x, points_y):
+            name = self.columns.names[tag_idx]
+            if zoom >= ZOOM_TEXT_SHOW or name in names_of_shown_tags:
+                labels.append((pnt_x, pnt_y, name))
+        with profiler.measure(zoom, 'text', len(labels)):
+            for pnt_x, pnt_y, name in labels:
+                draw.text((pnt_x, pnt_y), name, fill=fill, font=self.fonts[zoom])
 
         del draw
 
@@ -248,60 +831,455 @@ def get_tile_dir(date_suffix):
 
 
 def prepare_tile_dir(tile_dir):
+    """
+    Create an empty directory for a new version of tiles.
+
+    Versions are stored in hidden directories next to `tile_dir`,
+    see `publish_tile_dir`.
+    """
+    parent_dir, tile_dir_name = os.path.split(os.path.abspath(tile_dir))
+    new_tile_dir = tempfile.mkdtemp(prefix='.{}.'.format(tile_dir_name), dir=parent_dir)
+    os.chmod(new_tile_dir, 0o755)
+    return new_tile_dir
+
+
+def publish_tile_dir(tile_dir, new_tile_dir):
+    """
+    Make `tile_dir` point to `new_tile_dir` and remove outdated versions of tiles.
+
+    `tile_dir` is a symbolic link, which is replaced atomically. This way,
+    the running tile server never sees a half-written set of tiles.
+    The previous version is kept, because the server may still be reading from it.
+    """
+    parent_dir, tile_dir_name = os.path.split(os.path.abspath(tile_dir))
+    previous_tile_dir = None
+
+    if os.path.islink(tile_dir):
+        previous_tile_dir = os.path.realpath(tile_dir)
+    elif os.path.isdir(tile_dir):
+        # Tiles generated by older versions of this script are stored in a plain directory.
+        previous_tile_dir = os.path.join(parent_dir, '.{}.legacy'.format(tile_dir_name))
+        shutil.rmtree(previous_tile_dir, ignore_errors=True)
+        os.rename(tile_dir, previous_tile_dir)
+
+    tmp_link = os.path.join(parent_dir, '.{}-link-{}'.format(tile_dir_name, os.getpid()))
+    os.symlink(os.path.basename(new_tile_dir), tmp_link)
+    os.replace(tmp_link, tile_dir)
+
+    keep = {os.path.realpath(new_tile_dir), previous_tile_dir}
+    for dirname in os.listdir(parent_dir):
+        path = os.path.realpath(os.path.join(parent_dir, dirname))
+        if dirname.startswith('.{}.'.format(tile_dir_name)) and path not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def load_manifest(tile_dir):
+    """
+    Load the manifest of previously generated tiles, or return None if there is none.
+    """
     try:
-        shutil.rmtree(tile_dir)
-    except FileNotFoundError:
-        pass
-    os.mkdir(tile_dir)
+        with open(os.path.join(tile_dir, MANIFEST_NAME), 'r') as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+
+
+def save_manifest(tile_dir, manifest):
+    with open(os.path.join(tile_dir, MANIFEST_NAME), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, sort_keys=True)
+
+
+def get_metatile_key(meta_x, meta_y, tile_zoom):
+    return '{}/{}/{}'.format(tile_zoom, meta_x, meta_y)
+
+
+def get_metatile_tile_coords(meta_x, meta_y, tile_zoom):
+    """
+    Return coordinates of all tiles that belong to a metatile.
+    """
+    max_coord = 2 ** tile_zoom
+    return [(x, y) for x in range(meta_x, min(meta_x + METATILE_SIZE, max_coord))
+                   for y in range(meta_y, min(meta_y + METATILE_SIZE, max_coord))]
+
+
+class DirectoryTileStore:
+    """
+    Store tiles as separate `x_y_z.png` files in `tile_dir`.
+
+    New tiles are written to a new version of the directory, which
+    replaces the old one on `commit`.
+    """
+
+    def __init__(self, tile_dir):
+        self.tile_dir = tile_dir
+        self.new_tile_dir = prepare_tile_dir(tile_dir)
+        # Tile name -> ETag, for tiles of the new version.
+        self.etags = dict()
+        self._old_etags = dict()
+
 
+    def load_manifest(self):
+        manifest = load_manifest(self.tile_dir)
+        if manifest is not None:
+            self._old_etags = manifest.get('etags', dict())
+        return manifest
 
-def render_tiles(img, meta_x, meta_y, tile_zoom, tile_dir):
-    for dx in range(METATILE_SIZE):
-        x = meta_x + dx
-        if x >= 2 ** tile_zoom:
-            break
 
-        for dy in range(METATILE_SIZE):
-            y = meta_y + dy
-            if y >= 2 ** tile_zoom:
-                break
+    def add_tile(self, x, y, tile_zoom, data):
+        tile_name = get_tile_name(x, y, tile_zoom)
+        with open(os.path.join(self.new_tile_dir, tile_name), 'wb') as tile_file:
+            tile_file.write(data)
+        self.etags[tile_name] = http_cache.get_etag(data)
 
-            img_name = os.path.join(tile_dir, '{}_{}_{}.png'.format(x, y, tile_zoom))
 
+    def reuse_tiles(self, tile_coords, tile_zoom):
+        """
+        Link tiles from the previous version. Returns False if some of them are missing.
+        """
+        for x, y in tile_coords:
+            tile_name = get_tile_name(x, y, tile_zoom)
+            old_path = os.path.join(self.tile_dir, tile_name)
+            new_path = os.path.join(self.new_tile_dir, tile_name)
+            try:
+                os.link(old_path, new_path)
+            except FileNotFoundError:
+                return False
+            except OSError:
+                shutil.copyfile(old_path, new_path)
+
+            etag = self._old_etags.get(tile_name)
+            if etag is None:
+                # Tiles of older versions of this script have no saved ETags.
+                with open(new_path, 'rb') as tile_file:
+                    etag = http_cache.get_etag(tile_file.read())
+            self.etags[tile_name] = etag
+        return True
+
+
+    def commit(self, manifest):
+        manifest['etags'] = self.etags
+        save_manifest(self.new_tile_dir, manifest)
+        publish_tile_dir(self.tile_dir, self.new_tile_dir)
+
+
+def cut_metatile(img, meta_x, meta_y, tile_zoom):
+    '''
+    Cut a rendered metatile into separate tiles.
+
+    Yields triples <x, y, tile image>, where tile image is already
+    downscaled to the final size.
+    '''
+    for x, y in get_metatile_tile_coords(meta_x, meta_y, tile_zoom):
+        dx = x - meta_x
+        dy = y - meta_y
+
+        with profiler.measure(tile_zoom, 'crop'):
             image_part = img.crop((dx * TILE_DIM, dy * TILE_DIM, 
                                     (dx + 1) * TILE_DIM, (dy + 1) * TILE_DIM))
 
+        with profiler.measure(tile_zoom, 'resize'):
             image_part = image_part.resize((TILE_DIM // ANTIALIASING_SCALE,
                                             TILE_DIM // ANTIALIASING_SCALE),
                                             resample=Image.LANCZOS)
 
-            image_part.save(img_name, optimize=True)
+        yield x, y, image_part
+
+
+def encode_tile(image_part):
+    """
+    Return PNG representation of a tile, exactly as it would be saved on disk.
+    """
+    buf = io.BytesIO()
+    image_part.save(buf, format='PNG', optimize=True)
+    return buf.getvalue()
+
+
+def get_tile_name(x, y, tile_zoom):
+    return '{}_{}_{}.png'.format(x, y, tile_zoom)
+
+
+def render_tiles(img, meta_x, meta_y, tile_zoom, tile_store):
+    for x, y, image_part in cut_metatile(img, meta_x, meta_y, tile_zoom):
+        with profiler.measure(tile_zoom, 'encode'):
+            data = encode_tile(image_part)
+        with profiler.measure(tile_zoom, 'write'):
+            tile_store.add_tile(x, y, tile_zoom, data)
 
     del img
 
 
-def main():
-    tsv_data_path = sys.argv[1]
-    additional_data_path = sys.argv[2]
-    max_tile_zoom = int(sys.argv[3])
-    date_suffix = sys.argv[4]
+class EncodedTiles:
+    """
+    Collect encoded tiles, so that they can be passed from a worker process.
+    """
 
-    tile_dir = get_tile_dir(date_suffix)
-    prepare_tile_dir(tile_dir)
+    def __init__(self):
+        self.tiles = []
 
-    tiler = Tiler(get_tags_data(tsv_data_path, additional_data_path))
-    pool = ThreadPoolExecutor()
+
+    def add_tile(self, x, y, tile_zoom, data):
+        self.tiles.append((x, y, tile_zoom, data))
 
 
+# Tiler used by worker processes, see `init_worker`.
+_worker_tiler = None
+
+
+def get_current_rss():
+    """
+    Return resident set size of the current process in bytes.
+
+    Falls back to the peak RSS on systems without `/proc`.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # `ru_maxrss` is in kilobytes on Linux and in bytes on macOS.
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class MemoryTracker:
+    """
+    Track peak memory usage for each zoom level.
+    """
+
+    def __init__(self):
+        self.peak_rss = dict()
+
+
+    def sample(self, tile_zoom, rss=None):
+        if rss is None:
+            rss = get_current_rss()
+        self.peak_rss[tile_zoom] = max(self.peak_rss.get(tile_zoom, 0), rss)
+
+
+    def report(self):
+        for tile_zoom in sorted(self.peak_rss):
+            print('Zoom level = {}: peak RSS {:.1f} MiB'.format(tile_zoom,
+                self.peak_rss[tile_zoom] / (1 << 20)))
+
+
+def get_max_in_flight(max_in_flight, memory_budget_mb):
+    """
+    Compute how many rendered metatiles may wait for encoding at once.
+    """
+    if max_in_flight is not None:
+        return max(1, max_in_flight)
+    if memory_budget_mb is not None:
+        return max(1, memory_budget_mb * (1 << 20) // METATILE_BYTES)
+    return 2 * (os.cpu_count() or 1)
+
+
+def init_worker(tsv_data_path, additional_data_path, snapshot_dir, label_index_data, profile=False):
+    """
+    Prepare a worker process for rendering metatiles.
+
+    When workers are forked, they inherit the Tiler built by the main
+    process. Otherwise, each worker builds its own Tiler once from the
+    snapshot, reusing the label index computed by the main process.
+    """
+    global _worker_tiler
+    profiler.enabled = profile
+    # Forked workers inherit stats of the main process, which it already has.
+    profiler.take_stats()
+    if _worker_tiler is None:
+        _worker_tiler = Tiler(load_tag_columns(tsv_data_path, additional_data_path, snapshot_dir))
+        _worker_tiler.set_label_index(LabelIndex.from_dict(label_index_data))
+
+
+def render_metatile_in_worker(task):
+    meta_x, meta_y, tile_zoom = task
+    img, cnt_points = _worker_tiler.get_metatile(meta_x, meta_y, tile_zoom)
+    encoded_tiles = EncodedTiles()
+    render_tiles(img, meta_x, meta_y, tile_zoom, encoded_tiles)
+    return tile_zoom, get_current_rss(), encoded_tiles.tiles, profiler.take_stats()
+
+
+def get_metatile_tasks(tiler, max_tile_zoom, tile_store, manifest, old_manifest=None):
+    """
+    Generate metatiles that need rendering and fill `manifest` with their signatures.
+
+    If an old manifest is given, metatiles that did not change since the
+    previous run are not rendered: their tiles are reused by `tile_store`.
+    """
+    manifest['global'] = tiler.get_global_signature()
+    manifest['metatiles'] = dict()
+
+    old_signatures = dict()
+    if old_manifest is not None and old_manifest.get('global') == manifest['global']:
+        old_signatures = old_manifest.get('metatiles', dict())
+
+    cnt_reused = 0
+    cnt_total = 0
     for tile_zoom in range(0, max_tile_zoom + 1):
         print('Generating zoom level =', tile_zoom)
+        profiler.start_zoom(tile_zoom)
         for meta_x in range(0, 1 << tile_zoom, METATILE_SIZE):
             for meta_y in range(0, 1 << tile_zoom, METATILE_SIZE):
-                img, cnt_points = tiler.get_metatile(meta_x, meta_y, tile_zoom)
-                pool.submit(render_tiles, img, meta_x, meta_y, tile_zoom, tile_dir)
+                cnt_total += 1
+                key = get_metatile_key(meta_x, meta_y, tile_zoom)
+                signature = tiler.get_metatile_signature(meta_x, meta_y, tile_zoom)
+                manifest['metatiles'][key] = signature
+
+                if old_signatures.get(key) == signature and tile_store.reuse_tiles(
+                        get_metatile_tile_coords(meta_x, meta_y, tile_zoom), tile_zoom):
+                    cnt_reused += 1
+                    continue
+
+                yield meta_x, meta_y, tile_zoom
+
+    profiler.start_zoom(None)
+    if old_manifest is not None:
+        print('Reused {} of {} metatiles.'.format(cnt_reused, cnt_total))
+
+
+def render_with_processes(tiler, args, tasks, tile_store, memory_tracker):
+    """
+    Render and encode metatiles in worker processes and write tiles in the main one.
+
+    Tasks are taken from `tasks` in the main thread, so that its side effects
+    (signatures, reused tiles, profiled zoom levels) keep step with writing.
+    The number of submitted metatiles whose tiles are not written yet is
+    bounded, so that encoded tiles do not pile up in memory.
+    """
+    global _worker_tiler
+    _worker_tiler = tiler
+    max_in_flight = args.workers + get_max_in_flight(args.max_in_flight, args.memory_budget)
+
+    def write_result(result):
+        # Raises the exception of a failed worker.
+        tile_zoom, worker_rss, tiles, stats = result.get()
+        for x, y, tile_zoom, data in tiles:
+            with profiler.measure(tile_zoom, 'write'):
+                tile_store.add_tile(x, y, tile_zoom, data)
+        # Workers only collect encoded tiles, they are written here.
+        profiler.merge(stat for stat in stats if stat[1] != 'write')
+        memory_tracker.sample(tile_zoom, worker_rss)
+        memory_tracker.sample(tile_zoom)
+
+    # On an error, the pool is terminated when leaving the block.
+    with multiprocessing.Pool(args.workers, initializer=init_worker,
+            initargs=(args.tsv_data_path, args.additional_data_path,
+                      get_snapshot_dir(args.date_suffix), tiler.build_label_index().to_dict(),
+                      profiler.enabled)) as pool:
+        in_flight = deque()
+        for task in tasks:
+            if len(in_flight) >= max_in_flight:
+                write_result(in_flight.popleft())
+            in_flight.append(pool.apply_async(render_metatile_in_worker, (task,)))
+        while in_flight:
+            write_result(in_flight.popleft())
+        pool.close()
+        pool.join()
+
+
+def render_with_threads(tiler, args, tasks, tile_store, memory_tracker):
+    """
+    Render metatiles in the main thread and encode tiles in a thread pool.
+
+    The number of rendered metatiles waiting for encoding is bounded,
+    so that the renderer does not outrun encoders and fill up memory.
+    """
+    max_in_flight = get_max_in_flight(args.max_in_flight, args.memory_budget)
+    pool = ThreadPoolExecutor()
+    in_flight = set()
+
+    for meta_x, meta_y, tile_zoom in tasks:
+        if len(in_flight) >= max_in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+
+        img, cnt_points = tiler.get_metatile(meta_x, meta_y, tile_zoom)
+        if profiler.is_capturing():
+            # cProfile sees only the main thread, so encode there.
+            render_tiles(img, meta_x, meta_y, tile_zoom, tile_store)
+        else:
+            in_flight.add(pool.submit(render_tiles, img, meta_x, meta_y, tile_zoom, tile_store))
+        del img
+        memory_tracker.sample(tile_zoom)
+
+    for future in in_flight:
+        future.result()
+    pool.shutdown(wait=True)
 
 
-    pool.shutdown(wait=True)
+def parse_args():
+    parser = argparse.ArgumentParser(description='Generate tiles for described points.')
+    parser.add_argument('tsv_data_path')
+    parser.add_argument('additional_data_path')
+    parser.add_argument('max_tile_zoom', type=int)
+    parser.add_argument('date_suffix')
+    parser.add_argument('--workers', type=int, default=1,
+            help='number of processes rendering metatiles (default: render in the main process)')
+    parser.add_argument('--max-in-flight', type=int, default=None,
+            help='maximum number of rendered metatiles waiting for encoding')
+    parser.add_argument('--memory-budget', type=int, default=None,
+            help='memory in MiB for rendered metatiles waiting for encoding')
+    parser.add_argument('--incremental', action='store_true',
+            help='render only metatiles that changed since the previous run')
+    parser.add_argument('--output', choices=('directory', 'mbtiles'), default='directory',
+            help='store tiles as separate files or in a single MBTiles file')
+    parser.add_argument('--profile', metavar='REPORT',
+            help='record time of each phase of rendering and write a JSON report there')
+    parser.add_argument('--profile-zoom', type=int, default=None,
+            help='also capture a detailed profile of rendering this zoom level')
+    parser.add_argument('--profile-with', choices=stage_profiler.CAPTURE_MODES, default='cprofile',
+            help='how to capture the profile of --profile-zoom (default: cprofile)')
+    args = parser.parse_args()
+    if args.profile_zoom is not None and args.profile is None:
+        parser.error('--profile-zoom needs --profile')
+    if args.profile_zoom is not None and args.workers > 1:
+        parser.error('--profile-zoom needs rendering in the main process (--workers 1)')
+    return args
+
+
+def main():
+    args = parse_args()
+
+    tile_dir = get_tile_dir(args.date_suffix)
+    if args.output == 'mbtiles':
+        tile_store = mbtiles.MBTilesWriter(tile_dir + mbtiles.MBTILES_EXT, args.date_suffix)
+    else:
+        tile_store = DirectoryTileStore(tile_dir)
+
+    if args.profile is not None:
+        profiler.enabled = True
+        if args.profile_zoom is not None:
+            profiler.set_capture(args.profile_zoom, args.profile_with,
+                                 os.path.splitext(args.profile)[0] + '_zoom{}.prof'.format(args.profile_zoom))
+    start_time = time.perf_counter()
+
+    old_manifest = tile_store.load_manifest() if args.incremental else None
+    manifest = {'max_zoom': args.max_tile_zoom}
+
+    tiler = Tiler(load_tag_columns(args.tsv_data_path, args.additional_data_path,
+                                   get_snapshot_dir(args.date_suffix)))
+    # The manifest needs labels of all zoom levels, not only of rendered ones.
+    with profiler.section('labels'):
+        label_index = tiler.build_label_index()
+    tasks = get_metatile_tasks(tiler, args.max_tile_zoom, tile_store, manifest, old_manifest)
+    memory_tracker = MemoryTracker()
+
+    if args.workers > 1:
+        render_with_processes(tiler, args, tasks, tile_store, memory_tracker)
+    else:
+        render_with_threads(tiler, args, tasks, tile_store, memory_tracker)
+
+    manifest['labels'] = label_index.to_dict()
+    tile_store.commit(manifest)
+
+    memory_tracker.report()
+    if args.profile is not None:
+        profiler.report()
+        report = profiler.to_dict()
+        report['seconds'] = time.perf_counter() - start_time
+        report['workers'] = args.workers
+        with open(args.profile, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+        print('Saved the profile to {}'.format(args.profile))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,320 @@
+import os
+import os.path
+import gzip
+import json
+import time
+import hashlib
+import threading
+
+'''
+HTTP caching for `tile_server.py`.
+
+A set of tiles never changes once it is published: `get_tiling.py` writes
+a new version of tiles into a new directory (or a new MBTiles file) and
+switches to it at once. So each tile gets a strong ETag, a hash of its
+contents, which `get_tiling.py` computes when it writes the tile and saves
+in the manifest of the set. The server reads these ETags when the set is
+first used (and again when it is replaced). Tiles without a saved ETag
+(written by older versions of `get_tiling.py`, or rendered on demand into
+the directory) are hashed one by one, when they are first requested.
+
+The whole set is described by its version: a hash of ETags of its tiles.
+Tile URLs carrying the current version (`?v=<version>`) are immutable and
+may be cached by browsers forever, as long as the tile was taken from the
+set (or rendered from the data) which that version describes. Other tile
+requests are revalidated with the ETag, so a tile the browser already has
+costs a `304 Not Modified`.
+
+Static assets are kept in memory, along with their gzip-compressed version.
+'''
+
+ETAG_LENGTH = 20
+# `Cache-Control` of versioned tile URLs.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# `Cache-Control` of responses which may change: browsers revalidate them every time.
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+# How often (in seconds) we check whether a set of tiles or a static asset was replaced.
+CHECK_INTERVAL = 1.0
+# Smaller assets are not compressed.
+MIN_COMPRESS_SIZE = 256
+
+
+def get_etag(data):
+    return hashlib.sha1(data).hexdigest()[:ETAG_LENGTH]
+
+
+def quote_etag(etag):
+    return '"{}"'.format(etag)
+
+
+def is_not_modified(if_none_match, etag):
+    '''
+    Check whether the `If-None-Match` header matches `etag` (weak comparison, RFC 7232).
+    '''
+    if not if_none_match or etag is None:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[len('W/'):]
+        if candidate == quote_etag(etag):
+            return True
+    return False
+
+
+def accepts_gzip(accept_encoding):
+    '''
+    Check whether the `Accept-Encoding` header allows gzip.
+    '''
+    for coding in (accept_encoding or '').split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() not in ('gzip', 'x-gzip'):
+            continue
+        params = params.replace(' ', '')
+        return not params.startswith('q=') or params[len('q='):].rstrip('0.') != ''
+    return False
+
+
+class TileSetETags:
+    '''
+    ETags of all tiles of one set of tiles, by tile key.
+
+    Subclasses define `read_version()`, which changes when the set is replaced,
+    and `read_etags(version)`, which reads ETags of all tiles of the set saved
+    along with it, or returns None if there are none.
+    '''
+
+    def __init__(self):
+        self.version = None
+        self.digest = None
+        self._etags = dict()
+        self._next_check = 0
+        self._lock = threading.Lock()
+
+
+    def refresh(self):
+        '''
+        Recompute ETags if the set of tiles was replaced since the last check.
+        '''
+        with self._lock:
+            if time.monotonic() < self._next_check:
+                return
+            version = self.read_version()
+            if version != self.version or self.digest is None:
+                etags = self.read_etags(version) if version is not None else dict()
+                if etags is not None:
+                    self._etags = etags
+                    self.digest = get_etag(json.dumps(sorted(etags.values())).encode('utf-8'))
+                else:
+                    # Tiles are hashed when requested, so the set is described by its version.
+                    self._etags = dict()
+                    self.digest = get_etag(json.dumps(version).encode('utf-8'))
+                self.version = version
+            self._next_check = time.monotonic() + CHECK_INTERVAL
+
+
+    def get_state(self):
+        '''
+        Return the current version of the set and its digest.
+        '''
+        self.refresh()
+        with self._lock:
+            return self.version, self.digest
+
+
+    def get(self, key):
+        '''
+        Return the current version of the set and the ETag of a tile, or None if it is unknown.
+        '''
+        self.refresh()
+        with self._lock:
+            return self.version, self._etags.get(key)
+
+
+class DirectoryETags(TileSetETags):
+    '''
+    ETags of `x_y_z.png` files in a directory of tiles (see `get_tiling.publish_tile_dir`),
+    saved in its manifest (`manifest_name`, under `etags`).
+    The directory is a symbolic link to the current version of tiles.
+    '''
+
+    def __init__(self, tile_dir, manifest_name):
+        super().__init__()
+        self.tile_dir = tile_dir
+        self.manifest_name = manifest_name
+        # Path -> pair <(inode, modification time), ETag> of tiles without a saved ETag.
+        self._file_etags = dict()
+
+
+    def read_version(self):
+        if not os.path.isdir(self.tile_dir):
+            return None
+        return os.path.realpath(self.tile_dir)
+
+
+    def read_etags(self, version):
+        # Hashes of tiles of the previous version are not needed anymore.
+        self._file_etags = dict()
+        try:
+            with open(os.path.join(version, self.manifest_name), 'r') as manifest_file:
+                return json.load(manifest_file).get('etags')
+        except (OSError, ValueError):
+            return None
+
+
+    def get_tile(self, tile_name):
+        '''
+        Return a tuple <path to a tile in the current version of the directory, its ETag,
+        the version>, or a tuple of None if there is no such tile.
+
+        Tiles without a saved ETag are hashed on first use, and again only
+        if the file is replaced.
+        '''
+        version, etag = self.get(tile_name)
+        if version is None:
+            return None, None, None
+
+        path = os.path.join(version, tile_name)
+        if etag is None:
+            etag = self._get_file_etag(path)
+            if etag is None:
+                return None, None, None
+        return path, etag, version
+
+
+    def _get_file_etag(self, path):
+        try:
+            stat = os.stat(path)
+            stamp = stat.st_ino, stat.st_mtime_ns
+            with self._lock:
+                cached = self._file_etags.get(path)
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+            with open(path, 'rb') as tile_file:
+                etag = get_etag(tile_file.read())
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            self._file_etags[path] = stamp, etag
+        return etag
+
+
+class MBTilesETags(TileSetETags):
+    '''
+    ETags of tiles of an MBTiles file, by (x, y, zoom), saved in its manifest
+    (see `mbtiles.get_etag_key`).
+    '''
+
+    def __init__(self, reader):
+        super().__init__()
+        self.reader = reader
+
+
+    def read_version(self):
+        return self.reader.file_id
+
+
+    def read_etags(self, version):
+        manifest = self.reader.get_metadata().get('manifest')
+        try:
+            etags = json.loads(manifest).get('etags') if manifest is not None else None
+        except ValueError:
+            return None
+        if etags is None:
+            return None
+        result = dict()
+        for key, etag in etags.items():
+            zoom, x, y = map(int, key.split('/'))
+            result[(x, y, zoom)] = etag
+        return result
+
+
+    def get_tile(self, x, y, zoom):
+        '''
+        Return a tuple <data of a tile, its ETag, version of the file it was read from>,
+        or a tuple of None if there is no such tile.
+        '''
+        version, etag = self.get((x, y, zoom))
+        data = self.reader.get_tile(x, y, zoom)
+        if data is None:
+            return None, None, None
+        if etag is None or self.reader.file_id != version:
+            # The file was replaced after its ETags were computed.
+            return data, get_etag(data), self.reader.file_id
+        return data, etag, version
+
+
+class CheckedValue:
+    '''
+    A value which is computed by `compute()` again at most once per `CHECK_INTERVAL`.
+    '''
+
+    def __init__(self, compute):
+        self.compute = compute
+        self._value = None
+        self._next_check = 0
+        self._lock = threading.Lock()
+
+
+    def get(self):
+        with self._lock:
+            if time.monotonic() >= self._next_check:
+                self._value = self.compute()
+                self._next_check = time.monotonic() + CHECK_INTERVAL
+            return self._value
+
+
+class StaticAsset:
+    '''
+    A static file kept in memory, with its ETag and gzip-compressed data.
+
+    The file is read again when it changes.
+    '''
+
+    def __init__(self, path, mimetype):
+        self.path = path
+        self.mimetype = mimetype
+        # Triple <data, ETag, gzip-compressed data or None>, replaced as a whole.
+        self._contents = None
+        self._stamp = None
+        self._next_check = 0
+        self._lock = threading.Lock()
+
+
+    def refresh(self):
+        with self._lock:
+            if time.monotonic() < self._next_check:
+                return
+            stat = os.stat(self.path)
+            stamp = stat.st_size, stat.st_mtime_ns
+            if stamp != self._stamp:
+                self._contents = self._load()
+                self._stamp = stamp
+            self._next_check = time.monotonic() + CHECK_INTERVAL
+
+
+    def _load(self):
+        with open(self.path, 'rb') as asset_file:
+            data = asset_file.read()
+        gzip_data = None
+        if len(data) >= MIN_COMPRESS_SIZE:
+            gzip_data = gzip.compress(data, 9)
+            if len(gzip_data) >= len(data):
+                gzip_data = None
+        return data, get_etag(data), gzip_data
+
+
+    def get_representation(self, accept_encoding):
+        '''
+        Choose a representation for a request with the given `Accept-Encoding` header.
+
+        Returns a triple <data, ETag, content encoding or None>. Representations
+        have different ETags, as required for strong validators.
+        '''
+        self.refresh()
+        data, etag, gzip_data = self._contents
+        if gzip_data is not None and accepts_gzip(accept_encoding):
+            return gzip_data, '{}-gzip'.format(etag), 'gzip'
+        return data, etag, None
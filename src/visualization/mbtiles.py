@@ -0,0 +1,211 @@
+import os
+import os.path
+import json
+import sqlite3
+import threading
+import time
+
+from urllib.request import pathname2url
+
+import http_cache
+
+'''
+Store a whole tiling in a single SQLite file, following the MBTiles format:
+https://github.com/mapbox/mbtiles-spec/blob/master/1.3/spec.md
+
+Tens of thousands of small `x_y_z.png` files are slow to write, copy and serve,
+because every one of them costs an inode and several syscalls.
+
+Note that MBTiles numbers tile rows from the bottom (as in TMS),
+while our `y` coordinate goes from the top.
+
+ETags of tiles are saved in the manifest (`manifest` metadata entry),
+by `get_etag_key`.
+'''
+
+MBTILES_EXT = '.mbtiles'
+# Number of tiles inserted in one transaction.
+BATCH_SIZE = 512
+# How often (in seconds) a reader checks whether the file was replaced.
+RELOAD_CHECK_INTERVAL = 5.0
+
+SCHEMA = '''
+CREATE TABLE metadata (name TEXT, value TEXT);
+CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);
+'''
+
+
+def get_tile_row(y, zoom):
+    return (1 << zoom) - 1 - y
+
+
+def get_etag_key(x, y, zoom):
+    return '{}/{}/{}'.format(zoom, x, y)
+
+
+def connect_read_only(path):
+    return sqlite3.connect('file:{}?mode=ro'.format(pathname2url(os.path.abspath(path))),
+                           uri=True, check_same_thread=False)
+
+
+def read_metadata(connection):
+    return dict(connection.execute('SELECT name, value FROM metadata'))
+
+
+class MBTilesWriter:
+    """
+    Write tiles into an MBTiles file in batches.
+
+    Tiles are written to a temporary file, which replaces `path` on `commit`.
+    """
+
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        self.tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+        self.connection = sqlite3.connect(self.tmp_path, check_same_thread=False)
+        # The file is not visible to anybody until it is complete,
+        # so there is no need for a rollback journal.
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.executescript(SCHEMA)
+
+        self._lock = threading.Lock()
+        self._batch = []
+        self._old_reader = None
+        # ETags of written tiles, by `get_etag_key`.
+        self.etags = dict()
+
+
+    def load_manifest(self):
+        """
+        Load the manifest of the previous version of this file, if there is one.
+        """
+        if not os.path.isfile(self.path):
+            return None
+
+        connection = connect_read_only(self.path)
+        try:
+            manifest = read_metadata(connection).get('manifest')
+            return json.loads(manifest) if manifest is not None else None
+        finally:
+            connection.close()
+
+
+    def add_tile(self, x, y, zoom, data):
+        etag = http_cache.get_etag(data)
+        with self._lock:
+            self.etags[get_etag_key(x, y, zoom)] = etag
+            self._batch.append((zoom, x, get_tile_row(y, zoom), sqlite3.Binary(data)))
+            if len(self._batch) >= BATCH_SIZE:
+                self._flush()
+
+
+    def reuse_tiles(self, tile_coords, zoom):
+        """
+        Copy tiles from the previous version. Returns False if some of them are missing.
+        """
+        if self._old_reader is None:
+            if not os.path.isfile(self.path):
+                return False
+            self._old_reader = MBTilesReader(self.path)
+
+        tiles = [(x, y, self._old_reader.get_tile(x, y, zoom)) for x, y in tile_coords]
+        if any(data is None for _, _, data in tiles):
+            return False
+        for x, y, data in tiles:
+            self.add_tile(x, y, zoom, data)
+        return True
+
+
+    def commit(self, manifest):
+        with self._lock:
+            self._flush()
+
+        if self._old_reader is not None:
+            self._old_reader.close()
+
+        manifest['etags'] = self.etags
+        metadata = [
+            ('name', self.name),
+            ('format', 'png'),
+            ('type', 'baselayer'),
+            ('minzoom', '0'),
+            ('maxzoom', str(manifest.get('max_zoom', 0))),
+            ('manifest', json.dumps(manifest, sort_keys=True)),
+        ]
+        with self.connection:
+            self.connection.executemany('INSERT INTO metadata (name, value) VALUES (?, ?)', metadata)
+        self.connection.close()
+
+        os.chmod(self.tmp_path, 0o644)
+        os.replace(self.tmp_path, self.path)
+
+
+    def _flush(self):
+        if not self._batch:
+            return
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO tiles '
+                    '(zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)', self._batch)
+        self._batch = []
+
+
+class MBTilesReader:
+    """
+    Read tiles from an MBTiles file through one shared read-only connection.
+
+    If the file is replaced by a newer version, the connection is reopened.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._open()
+
+
+    def _open(self):
+        self.connection = connect_read_only(self.path)
+        # Changes when the file is replaced by a newer version.
+        self.file_id = self._get_file_id()
+        self._next_check = time.monotonic() + RELOAD_CHECK_INTERVAL
+
+
+    def _get_file_id(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime
+
+
+    def get_tile(self, x, y, zoom):
+        with self._lock:
+            if time.monotonic() >= self._next_check:
+                self._next_check = time.monotonic() + RELOAD_CHECK_INTERVAL
+                file_id = self._get_file_id()
+                if file_id is not None and file_id != self.file_id:
+                    self.connection.close()
+                    self._open()
+
+            row = self.connection.execute('SELECT tile_data FROM tiles '
+                    'WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                    (zoom, x, get_tile_row(y, zoom))).fetchone()
+
+        return bytes(row[0]) if row is not None else None
+
+
+    def get_metadata(self):
+        with self._lock:
+            return read_metadata(self.connection)
+
+
+    def close(self):
+        self.connection.close()
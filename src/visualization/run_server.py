@@ -1,4 +1,4 @@
-from gevent.wsgi import WSGIServer
+from gevent.pywsgi import WSGIServer
 from tile_server import app
 
 http_server = WSGIServer(('', 8000), app)
@@ -0,0 +1,227 @@
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+"""
+Per-stage profiling of tile generation, see `get_tiling.py --profile`.
+
+Each phase of rendering a metatile records its cumulative time and
+number of calls for the zoom level being rendered:
+    buckets - sorting tags into metatiles of a zoom level (`ZoomBuckets`);
+    query - finding tags inside a rectangle;
+    label_selection - choosing tags whose names are shown on low zoom levels;
+    signature - computing digests of metatiles for the manifest;
+    ellipse, text - drawing circles and labels (calls are drawn shapes);
+    crop, resize, encode - cutting a metatile into tiles, downscaling them
+        and PNG encoding with `optimize=True`;
+    write - storing encoded tiles.
+
+Work done once for all zoom levels, such as building the label index, is
+measured inside a named `section` and reported in its own row.
+
+Phases running in several threads or processes add up their time, so totals
+may exceed the wall time. When disabled (the default), a phase costs a method
+call, a check of a flag and entering a shared no-op context manager; when
+enabled, also a generator-based context manager, two `perf_counter` calls
+and a locked update.
+
+For one chosen zoom level, the profiler can also capture a full cProfile
+profile or tracemalloc statistics of its rendering.
+"""
+
+# Phases in the order they happen.
+PHASES = ('buckets', 'query', 'label_selection', 'signature', 'ellipse', 'text',
+          'crop', 'resize', 'encode', 'write')
+CAPTURE_MODES = ('cprofile', 'tracemalloc')
+# Number of functions or allocation sites in the report of a capture.
+CAPTURE_TOP = 20
+# Returned by `StageProfiler.measure` when the profiler is disabled.
+_NULL_CONTEXT = nullcontext()
+
+
+class StageProfiler:
+    """
+    Cumulative time and number of calls of each phase, per zoom level.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        # (zoom, phase) -> [seconds, calls]
+        self.stats = dict()
+        self._lock = threading.Lock()
+        # If set, phases are recorded for this name instead of their zoom level.
+        self.section_name = None
+
+        self.capture_zoom = None
+        self.capture_mode = None
+        # If set, the cProfile profile of the captured zoom level is saved there.
+        self.capture_path = None
+        self.capture = None
+        self._capturing = False
+        self._cprofile = None
+
+
+    def measure(self, zoom, phase, calls=1):
+        """
+        Return a context manager which records time spent in it for `phase` of `zoom`.
+        """
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._measure(zoom, phase, calls)
+
+
+    @contextmanager
+    def _measure(self, zoom, phase, calls):
+        if self.section_name is not None:
+            zoom = self.section_name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(zoom, phase, time.perf_counter() - start, calls)
+
+
+    @contextmanager
+    def section(self, name):
+        """
+        Record phases measured inside for `name` instead of their zoom level.
+
+        Applies to all threads, so use it only when nothing else is rendering.
+        """
+        self.section_name = name
+        try:
+            yield
+        finally:
+            self.section_name = None
+
+
+    def add(self, zoom, phase, seconds, calls=1):
+        with self._lock:
+            entry = self.stats.get((zoom, phase))
+            if entry is None:
+                entry = self.stats[(zoom, phase)] = [0.0, 0]
+            entry[0] += seconds
+            entry[1] += calls
+
+
+    def take_stats(self):
+        """
+        Return collected stats as a list and reset them, so that a worker
+        process can pass them to the main one, see `merge`.
+        """
+        with self._lock:
+            stats = [(zoom, phase, seconds, calls) for (zoom, phase), (seconds, calls) in self.stats.items()]
+            self.stats = dict()
+        return stats
+
+
+    def merge(self, stats):
+        for zoom, phase, seconds, calls in stats:
+            self.add(zoom, phase, seconds, calls)
+
+
+    def set_capture(self, zoom, mode, path=None):
+        if mode not in CAPTURE_MODES:
+            raise ValueError('Unknown capture mode: {}'.format(mode))
+        self.capture_zoom = zoom
+        self.capture_mode = mode
+        self.capture_path = path
+
+
+    def is_capturing(self):
+        return self._capturing
+
+
+    def start_zoom(self, zoom):
+        """
+        Called when rendering of a zoom level starts, and with None after the last one.
+        """
+        if self._capturing and zoom != self.capture_zoom:
+            self._stop_capture()
+        if not self._capturing and zoom is not None and zoom == self.capture_zoom:
+            self._start_capture()
+
+
+    def _start_capture(self):
+        self._capturing = True
+        if self.capture_mode == 'cprofile':
+            # Only the calling thread is profiled.
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        else:
+            tracemalloc.start()
+
+
+    def _stop_capture(self):
+        self._capturing = False
+        self.capture = {'zoom': self.capture_zoom, 'mode': self.capture_mode}
+        if self.capture_mode == 'cprofile':
+            self._cprofile.disable()
+            stats = pstats.Stats(self._cprofile)
+            if self.capture_path is not None:
+                stats.dump_stats(self.capture_path)
+                self.capture['path'] = self.capture_path
+            functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+            self.capture['functions'] = [
+                {'function': '{}:{}({})'.format(*key), 'calls': calls, 'tottime': tottime, 'cumtime': cumtime}
+                for key, (_, calls, tottime, cumtime, _) in functions[:CAPTURE_TOP]]
+            self._cprofile = None
+        else:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            # Image buffers of PIL are not allocated through Python, so they are not seen here.
+            self.capture['peak_bytes'] = peak
+            self.capture['allocations'] = [
+                {'location': str(stat.traceback[0]), 'bytes': stat.size, 'count': stat.count}
+                for stat in snapshot.statistics('lineno')[:CAPTURE_TOP]]
+
+
+    def to_dict(self):
+        zooms = dict()
+        for (zoom, phase), (seconds, calls) in self.stats.items():
+            zooms.setdefault(str(zoom), dict())[phase] = {'seconds': seconds, 'calls': calls}
+        return {'zooms': zooms, 'capture': self.capture}
+
+
+    def report(self):
+        # Zoom levels first, then sections.
+        zooms = sorted({zoom for zoom, _ in self.stats}, key=lambda zoom: (isinstance(zoom, str), zoom))
+        phases = [phase for phase in PHASES if any((zoom, phase) in self.stats for zoom in zooms)]
+        if not phases:
+            return
+
+        widths = [max(8, len(phase)) for phase in phases]
+
+        def print_row(title, values, fmt):
+            print('{:>6} '.format(title) + ' '.join(fmt.format(value, width=width)
+                                                   for value, width in zip(values, widths)))
+
+        print('Time of each phase, s:')
+        print_row('zoom', phases, '{:>{width}}')
+        for zoom in zooms:
+            print_row(zoom, [self.stats.get((zoom, phase), [0])[0] for phase in phases], '{:>{width}.3f}')
+        totals = [[sum(self.stats.get((zoom, phase), [0, 0])[i] for zoom in zooms) for i in (0, 1)]
+                  for phase in phases]
+        print_row('total', [seconds for seconds, _ in totals], '{:>{width}.3f}')
+        print_row('calls', [calls for _, calls in totals], '{:>{width}}')
+
+        if self.capture is None:
+            return
+        print('{} of zoom level {}:'.format(self.capture['mode'], self.capture['zoom']))
+        if self.capture['mode'] == 'cprofile':
+            for function in self.capture['functions']:
+                print('{:>10.3f} s {:>10} calls  {}'.format(function['cumtime'], function['calls'],
+                                                           function['function']))
+        else:
+            print('Peak traced memory: {:.1f} MiB'.format(self.capture['peak_bytes'] / (1 << 20)))
+            for allocation in self.capture['allocations']:
+                print('{:>10.1f} KiB {:>8} blocks  {}'.format(allocation['bytes'] / 1024, allocation['count'],
+                                                            allocation['location']))
+
+
+# Profiler of the current process.
+profiler = StageProfiler()
@@ -0,0 +1,139 @@
+import sys
+import bisect
+
+import numpy as np
+
+'''
+Search tags by prefix, tolerating typos.
+
+Tag names are kept sorted, so all names starting with a prefix form a
+contiguous range, found by binary search. Matches are ranked by post count.
+
+For typo tolerance we use the "symmetric delete" trick: every name is indexed
+under all variants of it with one character deleted. A query is looked up under
+its own such variants, which finds names within one insertion, deletion,
+substitution or transposition of it. Variants are stored as hashes in a sorted
+array, which takes much less memory than a dictionary of strings.
+'''
+
+DEFAULT_LIMIT = 10
+
+
+def normalize(name):
+    return name.strip().casefold()
+
+
+def get_deletes(word):
+    return {word[:i] + word[i + 1:] for i in range(len(word))} | {word}
+
+
+def is_within_one_edit(a, b):
+    """
+    Check whether `a` can be obtained from `b` by at most one insertion,
+    deletion, substitution or transposition of adjacent characters.
+    """
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+
+    prefix_len = 0
+    while prefix_len < min(len(a), len(b)) and a[prefix_len] == b[prefix_len]:
+        prefix_len += 1
+    a_rest = a[prefix_len:]
+    b_rest = b[prefix_len:]
+
+    if len(a) == len(b):
+        if a_rest[1:] == b_rest[1:]:
+            return True
+        return len(a_rest) >= 2 and a_rest[0] == b_rest[1] and a_rest[1] == b_rest[0] \
+            and a_rest[2:] == b_rest[2:]
+    if len(a) > len(b):
+        return a_rest[1:] == b_rest
+    return b_rest[1:] == a_rest
+
+
+class TagSearchIndex:
+
+    def __init__(self, names, post_counts):
+        self.names = list(names)
+        self.post_counts = np.asarray(post_counts, dtype=np.int64)
+
+        normalized = [normalize(name) for name in self.names]
+        order = sorted(range(len(normalized)), key=normalized.__getitem__)
+        self.sorted_names = [normalized[i] for i in order]
+        self.sorted_ids = np.array(order, dtype=np.int64)
+
+        delete_hashes = []
+        delete_ids = []
+        for tag_id, name in enumerate(normalized):
+            for variant in get_deletes(name):
+                delete_hashes.append(hash(variant))
+                delete_ids.append(tag_id)
+        delete_hashes = np.array(delete_hashes, dtype=np.int64)
+        delete_order = np.argsort(delete_hashes, kind='stable')
+        self.delete_hashes = delete_hashes[delete_order]
+        self.delete_ids = np.array(delete_ids, dtype=np.int64)[delete_order]
+
+
+    def get_memory_size(self):
+        """
+        Estimate memory (in bytes) taken by the index.
+        """
+        if not hasattr(self, '_names_size'):
+            self._names_size = sum(sys.getsizeof(name) for name in self.sorted_names) + \
+                               8 * len(self.sorted_names)
+        return self._names_size + self.sorted_ids.nbytes + self.post_counts.nbytes + \
+               self.delete_hashes.nbytes + self.delete_ids.nbytes
+
+
+    def get_prefix_matches(self, prefix, limit):
+        lo = bisect.bisect_left(self.sorted_names, prefix)
+        hi = bisect.bisect_left(self.sorted_names, prefix + '\U0010ffff', lo)
+        ids = self.sorted_ids[lo:hi]
+
+        if len(ids) > limit:
+            ids = ids[np.argpartition(-self.post_counts[ids], limit - 1)[:limit]]
+        return ids[np.argsort(-self.post_counts[ids], kind='stable')].tolist()
+
+
+    def get_fuzzy_matches(self, query):
+        query_hashes = np.array([hash(variant) for variant in get_deletes(query)], dtype=np.int64)
+        starts = np.searchsorted(self.delete_hashes, query_hashes, side='left')
+        ends = np.searchsorted(self.delete_hashes, query_hashes, side='right')
+
+        candidates = set()
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            candidates.update(self.delete_ids[start:end].tolist())
+
+        # Hashes may collide, so check every candidate.
+        matches = [tag_id for tag_id in candidates
+                   if is_within_one_edit(normalize(self.names[tag_id]), query)]
+        return sorted(matches, key=lambda tag_id: -self.post_counts[tag_id])
+
+
+    def complete(self, query, limit=DEFAULT_LIMIT):
+        """
+        Return ids of at most `limit` tags matching `query`.
+
+        The exact match goes first, then names starting with `query`,
+        then names within one typo of it. Inside each group, tags with
+        more posts go first.
+        """
+        query = normalize(query)
+        if not query or limit <= 0:
+            return []
+
+        exact = []
+        lo = bisect.bisect_left(self.sorted_names, query)
+        if lo < len(self.sorted_names) and self.sorted_names[lo] == query:
+            exact.append(int(self.sorted_ids[lo]))
+
+        result = exact + [tag_id for tag_id in self.get_prefix_matches(query, limit + len(exact))
+                          if tag_id not in exact]
+
+        if len(result) < limit:
+            seen = set(result)
+            result.extend(tag_id for tag_id in self.get_fuzzy_matches(query) if tag_id not in seen)
+
+        return result[:limit]
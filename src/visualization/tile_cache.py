@@ -0,0 +1,140 @@
+import os
+import os.path
+import tempfile
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import get_tiling
+import http_cache
+
+'''
+On-demand tile rendering for `tile_server.py`.
+
+Pre-rendering every tile up to a deep zoom level takes hours, while most of
+the tiles are never requested. Instead, when a tile is missing, we render
+the whole metatile containing it (this is as fast as rendering one tile),
+cut it into tiles and keep encoded PNGs in a size-bounded LRU cache.
+ETags of rendered tiles are computed once, when they are rendered.
+
+Concurrent requests for tiles from the same metatile share a single render.
+'''
+
+
+class TileCache:
+    '''
+    LRU cache of encoded tiles (pairs <PNG data, ETag>), bounded by
+    total size of PNG data in bytes.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.cur_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, key):
+        with self._lock:
+            tile = self._entries.get(key)
+            if tile is not None:
+                self._entries.move_to_end(key)
+            return tile
+
+
+    def put(self, key, tile):
+        if len(tile[0]) > self.max_bytes:
+            return
+
+        with self._lock:
+            old_tile = self._entries.pop(key, None)
+            if old_tile is not None:
+                self.cur_bytes -= len(old_tile[0])
+
+            self._entries[key] = tile
+            self.cur_bytes += len(tile[0])
+
+            while self.cur_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.cur_bytes -= len(evicted[0])
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class OnDemandRenderer:
+    '''
+    Render tiles of one tiling lazily, using a (possibly shared) `TileCache`.
+
+    If `write_dir` is given, rendered tiles are also written there, so
+    they can be served as static files next time.
+
+    Tiles are cached under `data_version`, which identifies the data `tiler`
+    was built from, so that a renderer for newer data does not get them.
+    '''
+
+    def __init__(self, suffix, tiler, cache, write_dir=None, data_version=None):
+        self.suffix = suffix
+        self.tiler = tiler
+        self.cache = cache
+        self.write_dir = write_dir
+        self.data_version = data_version
+
+        self._lock = threading.Lock()
+        self._in_flight = dict()
+
+
+    def get_tile(self, x, y, zoom):
+        '''
+        Return PNG data for tile (x, y) on the given zoom level and its ETag.
+        '''
+        tile = self.cache.get((self.suffix, self.data_version, x, y, zoom))
+        if tile is not None:
+            return tile
+
+        meta_key = (x - x % get_tiling.METATILE_SIZE, y - y % get_tiling.METATILE_SIZE, zoom)
+        with self._lock:
+            future = self._in_flight.get(meta_key)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._in_flight[meta_key] = future
+
+        if is_owner:
+            try:
+                future.set_result(self._render_metatile(*meta_key))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._in_flight[meta_key]
+
+        return future.result()[(x, y)]
+
+
+    def _render_metatile(self, meta_x, meta_y, zoom):
+        img, _ = self.tiler.get_metatile(meta_x, meta_y, zoom)
+
+        rendered = dict()
+        for x, y, image_part in get_tiling.cut_metatile(img, meta_x, meta_y, zoom):
+            data = get_tiling.encode_tile(image_part)
+            tile = data, http_cache.get_etag(data)
+            self.cache.put((self.suffix, self.data_version, x, y, zoom), tile)
+            rendered[(x, y)] = tile
+
+            if self.write_dir is not None:
+                self._write_tile(get_tiling.get_tile_name(x, y, zoom), data)
+
+        return rendered
+
+
+    def _write_tile(self, tile_name, data):
+        # Write to a temporary file first, so that nobody
+        # reads a partially written tile.
+        os.makedirs(self.write_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.write_dir, prefix='.tmp_')
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, os.path.join(self.write_dir, tile_name))
@@ -1,11 +1,18 @@
-from flask import Flask, send_from_directory, make_response
+from flask import Flask, make_response, request, jsonify
 
 import re
+import json
+from collections import namedtuple
 
 import os
 import os.path
 
 import get_tiling
+import http_cache
+import mbtiles
+import tag_search
+import tile_cache
+import tiling_registry
 
 
 app = Flask(__name__)
@@ -13,67 +20,400 @@ app = Flask(__name__)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__));
 PROCESSED_DIR = os.path.join(BASE_DIR, '../../data/processed/')
 
+# Points are read from raw t-SNE output, or from a tsv-file extracted from it, if there is one.
+RAW_POINTS_FMT = os.path.join(PROCESSED_DIR, 'raw_tsne_output_{}.txt')
 POINTS_TSV_FMT = os.path.join(BASE_DIR, 'tsne_output_{}.tsv')
 ADDITIONAL_INFO_FMT = os.path.join(PROCESSED_DIR, 'id_to_additional_info_{}.csv')
 
+# Render missing tiles when they are requested, instead of
+# requiring all of them to be generated by `get_tiling.py`.
+RENDER_ON_DEMAND = True
+# Upper bound on total size of rendered tiles kept in memory.
+TILE_CACHE_BYTES = 256 * 1024 * 1024
+# Whether to also save tiles rendered on demand into `tiles_<suffix>` directory.
+WRITE_RENDERED_TILES = False
+# Largest number of suggestions returned by `/autocomplete`.
+MAX_AUTOCOMPLETE_LIMIT = 50
+# Upper bound on estimated memory taken by loaded tilings. Tilings are loaded
+# on first use, and least recently used ones are unloaded to stay within it.
+TILINGS_MEMORY_BYTES = 1024 * 1024 * 1024
+
 
 tiling_names = []
-created_tilers = dict()
+tiling_suffixes = set()
+mbtiles_readers = dict()
+rendered_tiles_cache = tile_cache.TileCache(TILE_CACHE_BYTES)
+# ETags of pre-rendered tiles, saved by `get_tiling.py` along with them, see `http_cache.py`.
+directory_etags = dict()
+mbtiles_etags = dict()
+# Current versions of tiles (`http_cache.CheckedValue` of `TileVersion`), see `get_tile_version`.
+tile_versions = dict()
+visualizer_page = http_cache.StaticAsset(os.path.join(BASE_DIR, 'tiling_visualizer.html'), 'text/html')
+
+
+# Version of tiles of a tiling, the version of data which tiles are rendered from,
+# and the set of sources of tiles which the version describes (see `find_tile`).
+TileVersion = namedtuple('TileVersion', ['version', 'data_version', 'sources'])
+
+
+class Tiling:
+    """
+    Everything needed for serving one tiling, besides pre-rendered tiles.
+
+    `data_version` identifies the input files `tiler` was built from, see `get_data_version`.
+    """
+
+    def __init__(self, suffix, tiler, data_version):
+        self.suffix = suffix
+        self.tiler = tiler
+        self.data_version = data_version
+        columns = tiler.columns
+        self.search_index = tag_search.TagSearchIndex(columns.names, columns.post_count)
+
+        self.renderer = None
+        if RENDER_ON_DEMAND:
+            write_dir = 'tiles_{}'.format(suffix) if WRITE_RENDERED_TILES else None
+            self.renderer = tile_cache.OnDemandRenderer(suffix, tiler, rendered_tiles_cache, write_dir,
+                                                        data_version)
+
+
+    def get_memory_size(self):
+        return self.tiler.get_memory_size() + self.search_index.get_memory_size()
+
+
+def load_saved_label_index(tiling_name, tiler):
+    """
+    Reuse the label index saved by `get_tiling.py`, if it was computed for the same data.
+    """
+    tiling_suffix = tiling_name[len('tiles_'):]
+    if tiling_suffix in mbtiles_readers:
+        manifest = mbtiles_readers[tiling_suffix].get_metadata().get('manifest')
+        manifest = json.loads(manifest) if manifest is not None else None
+    else:
+        manifest = get_tiling.load_manifest(tiling_name)
+
+    if manifest is None or 'labels' not in manifest:
+        return
+    if manifest.get('global') != tiler.get_global_signature():
+        return
+    tiler.set_label_index(get_tiling.LabelIndex.from_dict(manifest['labels']))
+
+
+def get_points_path(tiling_suffix):
+    tsv_path = POINTS_TSV_FMT.format(tiling_suffix)
+    if os.path.isfile(tsv_path):
+        return tsv_path
+    return RAW_POINTS_FMT.format(tiling_suffix)
+
+
+def get_data_version(tiling_suffix):
+    """
+    Return a digest of paths, sizes and modification times of input files of a tiling.
+    """
+    source_paths = [get_points_path(tiling_suffix), ADDITIONAL_INFO_FMT.format(tiling_suffix)]
+    description = [source_paths, get_tiling.get_source_stamps(source_paths)]
+    return http_cache.get_etag(json.dumps(description).encode('utf-8'))
+
+
+def has_tiling_data(tiling_suffix):
+    if os.path.isdir(get_tiling.get_snapshot_dir(tiling_suffix)):
+        return True
+    return os.path.isfile(get_points_path(tiling_suffix)) and \
+           os.path.isfile(ADDITIONAL_INFO_FMT.format(tiling_suffix))
+
+
+def load_tiling(tiling_suffix):
+    """
+    Build a Tiling, preferably from the snapshot saved by `get_tiling.py`.
+    """
+    # Taken before reading, so that data changed meanwhile is read again.
+    data_version = get_data_version(tiling_suffix)
+    columns = get_tiling.load_tag_columns(get_points_path(tiling_suffix),
+                                          ADDITIONAL_INFO_FMT.format(tiling_suffix),
+                                          get_tiling.get_snapshot_dir(tiling_suffix))
+    tiler = get_tiling.Tiler(columns)
+    load_saved_label_index('tiles_{}'.format(tiling_suffix), tiler)
+    print('Loaded tiles_{}.'.format(tiling_suffix))
+    return Tiling(tiling_suffix, tiler, data_version)
+
+
+tilings = tiling_registry.TilingRegistry(load_tiling, TILINGS_MEMORY_BYTES)
+
+
+def get_loaded_tiling(suffix):
+    """
+    Return the loaded Tiling of a suffix, loading it again if its input files changed.
+    """
+    tiling = tilings.get(suffix)
+    if tiling.data_version != tile_versions[suffix].get().data_version:
+        tilings.discard(suffix, tiling)
+        tiling = tilings.get(suffix)
+    return tiling
 
 
 @app.before_first_request
 def initialize():
-    global tiling_names
+    """
+    Find available tilings. They are loaded lazily, see `tilings`.
+    """
+    global tiling_names, tiling_suffixes
     lst_files = os.listdir()
-    # Search for directories starting with 'tiles_' substring.
+    # Search for directories and MBTiles files starting with 'tiles_' substring.
     for dirname in lst_files:
-        if not os.path.isdir(dirname):
-            continue
         if not dirname.startswith('tiles_'):
             continue
 
-        tiling_names.append(dirname)
+        if os.path.isfile(dirname) and dirname.endswith(mbtiles.MBTILES_EXT):
+            tiling_name = dirname[:-len(mbtiles.MBTILES_EXT)]
+            reader = mbtiles.MBTilesReader(dirname)
+            mbtiles_readers[tiling_name[len('tiles_'):]] = reader
+            mbtiles_etags[tiling_name[len('tiles_'):]] = http_cache.MBTilesETags(reader)
+        elif os.path.isdir(dirname):
+            tiling_name = dirname
+        else:
+            continue
 
-    functioning_names = []
-    for tiling_name in tiling_names:
-        tiling_suffix = tiling_name[len('tiles_'):]
-        tsv_concrete_name = POINTS_TSV_FMT.format(tiling_suffix)
-        additional_info_concrete_name = ADDITIONAL_INFO_FMT.format(tiling_suffix)
+        if tiling_name not in tiling_names:
+            tiling_names.append(tiling_name)
 
-        if not os.path.isfile(tsv_concrete_name) or not os.path.isfile(additional_info_concrete_name):
-            continue
+    if RENDER_ON_DEMAND:
+        # Tiles can be rendered on demand for any tiling we have points for.
+        points_files = [(BASE_DIR, 'tsne_output_', '.tsv'), (PROCESSED_DIR, 'raw_tsne_output_', '.txt')]
+        for points_dir, prefix, ext in points_files:
+            if not os.path.isdir(points_dir):
+                continue
+            for filename in os.listdir(points_dir):
+                if not filename.startswith(prefix) or not filename.endswith(ext):
+                    continue
 
-        points_data = get_tiling.get_tags_data(tsv_concrete_name, additional_info_concrete_name)
-        created_tilers[tiling_suffix] = get_tiling.Tiler(points_data)
+                tiling_name = 'tiles_{}'.format(filename[len(prefix):-len(ext)])
+                if tiling_name not in tiling_names:
+                    tiling_names.append(tiling_name)
 
-        functioning_names.append(tiling_name)
-        print('Loaded {}.'.format(tiling_name))
+    tiling_names = sorted(tiling_name for tiling_name in tiling_names
+                          if has_tiling_data(tiling_name[len('tiles_'):]))
+    tiling_suffixes = {tiling_name[len('tiles_'):] for tiling_name in tiling_names}
+    for suffix in tiling_suffixes:
+        directory_etags[suffix] = http_cache.DirectoryETags('tiles_{}'.format(suffix), get_tiling.MANIFEST_NAME)
+        tile_versions[suffix] = http_cache.CheckedValue(lambda suffix=suffix: read_tile_version(suffix))
 
-    tiling_names = sorted(functioning_names)
 
+def read_tile_version(suffix):
+    """
+    Compute the TileVersion of a tiling. The version is a digest of ETags
+    of pre-rendered tiles and of the data which other tiles are rendered from.
+    """
+    tile_sets = [('directory', directory_etags[suffix])]
+    if suffix in mbtiles_etags:
+        tile_sets.append(('mbtiles', mbtiles_etags[suffix]))
+    description = []
+    sources = set()
+    for kind, tile_set in tile_sets:
+        set_version, digest = tile_set.get_state()
+        description.append(digest)
+        sources.add((kind, set_version))
+    if RENDER_ON_DEMAND:
+        description.append(get_tiling.RENDER_VERSION)
+    # Point tiles are always made from the data.
+    description.append(get_tiling.POINT_TILE_VERSION)
+    data_version = get_data_version(suffix)
+    description.append(data_version)
+    sources.add(('data', data_version))
+    version = http_cache.get_etag(json.dumps(description).encode('utf-8'))
+    return TileVersion(version, data_version, frozenset(sources))
 
-@app.route('/search/<suffix>/<name>')
-def search(suffix, name):
-    if suffix not in created_tilers:
+
+def get_tile_version(suffix):
+    """
+    Return the version of tiles of a tiling, checked at most once per `http_cache.CHECK_INTERVAL`.
+    """
+    return tile_versions[suffix].get().version
+
+
+def make_cached_response(data, etag, mimetype, cache_control, content_encoding=None):
+    """
+    Make a response with validators, or `304 Not Modified` if the client has the same data.
+    """
+    if http_cache.is_not_modified(request.headers.get('If-None-Match'), etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(data)
+        response.mimetype = mimetype
+        if content_encoding is not None:
+            response.headers['Content-Encoding'] = content_encoding
+    response.headers['ETag'] = http_cache.quote_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
+def get_search_result(suffix, name):
+    """
+    Return normalized position of a tag with the exact name, as text, or an empty string.
+    """
+    if suffix not in tiling_suffixes:
         return ''
 
-    tiler = created_tilers[suffix]
+    tiler = get_loaded_tiling(suffix).tiler
     return ' '.join(map(str, tiler.search(name)))
 
 
+def get_suggestions(suffix, query, limit):
+    """
+    Return a list of tags completing `query`, with their normalized positions on the map.
+    `limit` is a string, as given in the request.
+    """
+    if suffix not in tiling_suffixes:
+        return []
+
+    try:
+        limit = int(limit) if limit is not None else tag_search.DEFAULT_LIMIT
+    except ValueError:
+        limit = tag_search.DEFAULT_LIMIT
+    limit = max(0, min(limit, MAX_AUTOCOMPLETE_LIMIT))
+
+    tiling = get_loaded_tiling(suffix)
+    columns = tiling.tiler.columns
+    suggestions = []
+    for tag_id in tiling.search_index.complete(query, limit):
+        name = columns.names[tag_id]
+        x, y = tiling.tiler.get_normpos(tag_id)
+        suggestions.append({'name': name, 'x': x, 'y': y,
+                            'post_count': int(columns.post_count[tag_id])})
+    return suggestions
+
+
+def get_tile_cache_control(suffix, version, source):
+    """
+    Return `Cache-Control` for a tile requested with `version` (`v` parameter, or None)
+    and taken from `source` (see `find_tile`).
+    """
+    # Tiles of an outdated version, or taken from a set of tiles or data which
+    # that version does not describe, are not cached forever under its URL.
+    current = tile_versions[suffix].get()
+    if version is not None and version == current.version and source in current.sources:
+        return http_cache.IMMUTABLE_CACHE_CONTROL
+    return http_cache.REVALIDATE_CACHE_CONTROL
+
+
+def find_tile(suffix, x, y, z):
+    """
+    Find a tile of a known tiling, rendering it if needed.
+
+    Returns a tuple <path to the tile file, tile data, ETag, source>: a pre-rendered file
+    is given by its path (and data is None), other tiles by their data. The source
+    is a pair <kind, version> of the set of tiles or the data the tile was taken from.
+    If there is no such tile, all of them are None.
+    """
+    if suffix in mbtiles_etags:
+        data, etag, set_version = mbtiles_etags[suffix].get_tile(x, y, z)
+        if data is not None:
+            return None, data, etag, ('mbtiles', set_version)
+
+    tile_path, etag, set_version = directory_etags[suffix].get_tile(get_tiling.get_tile_name(x, y, z))
+    if tile_path is not None:
+        return tile_path, None, etag, ('directory', set_version)
+    if not RENDER_ON_DEMAND or z > get_tiling.MAX_ZOOM or x >= (1 << z) or y >= (1 << z):
+        return None, None, None, None
+
+    # The Tiler is loaded only when a tile has to be rendered.
+    tiling = get_loaded_tiling(suffix)
+    data, etag = tiling.renderer.get_tile(x, y, z)
+    return None, data, etag, ('data', tiling.data_version)
+
+
+def find_point_tile(suffix, x, y, z):
+    """
+    Return a point tile of a known tiling as JSON, its ETag and source (see `find_tile`),
+    or a tuple of None if there is no such tile. See `get_tiling.Tiler.get_point_tile`.
+    """
+    if z > get_tiling.MAX_ZOOM or x >= (1 << z) or y >= (1 << z):
+        return None, None, None
+
+    # Point tiles share the cache with rendered tiles, under the version of the data.
+    data_version = tile_versions[suffix].get().data_version
+    tile = rendered_tiles_cache.get((suffix, data_version, x, y, z, 'points'))
+    if tile is None:
+        tiling = get_loaded_tiling(suffix)
+        data_version = tiling.data_version
+        point_tile = tiling.tiler.get_point_tile(x, y, z)
+        data = json.dumps(point_tile, separators=(',', ':')).encode('utf-8')
+        tile = data, http_cache.get_etag(data)
+        rendered_tiles_cache.put((suffix, data_version, x, y, z, 'points'), tile)
+    data, etag = tile
+    return data, etag, ('data', data_version)
+
+
+@app.route('/search/<suffix>/<name>')
+def search(suffix, name):
+    return get_search_result(suffix, name)
+
+
+@app.route('/autocomplete/<suffix>')
+def autocomplete(suffix):
+    """
+    Suggest tags for a partially typed name, given as `q` parameter.
+
+    Returns a JSON list of tags with their normalized positions on the map.
+    """
+    return jsonify(get_suggestions(suffix, request.args.get('q', ''), request.args.get('limit')))
+
+
 @app.route('/get_tile_variants')
 def tile_variants():
     return '<br>'.join(tiling_names)
 
 
+@app.route('/tile_version/<suffix>')
+def tile_version(suffix):
+    """
+    Return the current version of tiles of a tiling. Tile URLs with it
+    (`?v=<version>`) are cached by browsers forever.
+    """
+    if suffix not in tiling_suffixes:
+        return ''
+    return get_tile_version(suffix)
+
+
 @app.route('/tiles_<suffix>/<int:x>_<int:y>_<int:z>.png')
 def serve_tile(suffix, x, y, z):
-    if suffix not in created_tilers:
+    if suffix not in tiling_suffixes:
+        return ""
+
+    tile_path, data, etag, source = find_tile(suffix, x, y, z)
+    if tile_path is None and data is None:
+        return make_response('', 404)
+    cache_control = get_tile_cache_control(suffix, request.args.get('v'), source)
+
+    if tile_path is not None:
+        # The tile is read only when the client does not have it.
+        if http_cache.is_not_modified(request.headers.get('If-None-Match'), etag):
+            return make_cached_response(None, etag, 'image/png', cache_control)
+        with open(tile_path, 'rb') as tile_file:
+            data = tile_file.read()
+
+    return make_cached_response(data, etag, 'image/png', cache_control)
+
+
+@app.route('/points_<suffix>/<int:x>_<int:y>_<int:z>')
+def serve_point_tile(suffix, x, y, z):
+    """
+    Return tags drawn on a tile as JSON, so that the browser can draw
+    the tile itself, see `tiling_visualizer.html`.
+    """
+    if suffix not in tiling_suffixes:
         return ""
 
-    return send_from_directory('', 'tiles_{}/{}_{}_{}.png'.format(suffix, x, y, z))
+    data, etag, source = find_point_tile(suffix, x, y, z)
+    if data is None:
+        return make_response('', 404)
+    cache_control = get_tile_cache_control(suffix, request.args.get('v'), source)
+    return make_cached_response(data, etag, 'application/json', cache_control)
 
 
 @app.route('/')
 def show_visualization():
-    return send_from_directory('', 'tiling_visualizer.html')
+    data, etag, content_encoding = visualizer_page.get_representation(request.headers.get('Accept-Encoding'))
+    response = make_cached_response(data, etag, visualizer_page.mimetype,
+                                    http_cache.REVALIDATE_CACHE_CONTROL, content_encoding)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
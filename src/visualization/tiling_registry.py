@@ -0,0 +1,96 @@
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import Future
+
+'''
+Lazy loading of tilings for `tile_server.py`.
+
+Every tiling (a map for one posts date) needs a Tiler, a search index and
+so on, which take time to build and memory to keep. A tiling is loaded only
+when it is first needed. When loaded tilings take more memory than allowed,
+the least recently used ones are unloaded; they are loaded again on demand.
+
+Concurrent requests for a tiling that is being loaded wait for a single load.
+'''
+
+
+class TilingRegistry:
+    '''
+    LRU collection of loaded tilings, bounded by their estimated memory size.
+
+    `load_tiling(suffix)` builds a tiling, which must have a `get_memory_size()`
+    method. The most recently used tiling is never unloaded.
+    '''
+
+    def __init__(self, load_tiling, max_bytes):
+        self.load_tiling = load_tiling
+        self.max_bytes = max_bytes
+
+        self._loaded = OrderedDict()
+        self._in_flight = dict()
+        self._lock = threading.Lock()
+
+
+    def get(self, suffix):
+        with self._lock:
+            tiling = self._loaded.get(suffix)
+            if tiling is not None:
+                self._loaded.move_to_end(suffix)
+                return tiling
+
+            future = self._in_flight.get(suffix)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._in_flight[suffix] = future
+
+        if is_owner:
+            try:
+                tiling = self.load_tiling(suffix)
+                with self._lock:
+                    self._loaded[suffix] = tiling
+                    self._evict()
+                future.set_result(tiling)
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._in_flight[suffix]
+
+        return future.result()
+
+
+    def discard(self, suffix, tiling):
+        '''
+        Unload `tiling` (e.g. when its data changed), unless it was already replaced.
+        '''
+        with self._lock:
+            if self._loaded.get(suffix) is tiling:
+                del self._loaded[suffix]
+
+
+    def _evict(self):
+        sizes = OrderedDict((suffix, tiling.get_memory_size())
+                            for suffix, tiling in self._loaded.items())
+        cur_bytes = sum(sizes.values())
+        for suffix, size in sizes.items():
+            if cur_bytes <= self.max_bytes or len(self._loaded) <= 1:
+                break
+            del self._loaded[suffix]
+            cur_bytes -= size
+            print('Unloaded tiles_{} ({:.1f} MiB).'.format(suffix, size / (1 << 20)))
+
+
+    def get_loaded(self):
+        with self._lock:
+            return list(self._loaded)
+
+
+    def __contains__(self, suffix):
+        with self._lock:
+            return suffix in self._loaded
+
+
+    def __len__(self):
+        return len(self._loaded)